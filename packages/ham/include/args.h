@@ -17,14 +17,16 @@ namespace ham {
 class Args {
 public:
   Args(int argc, const char * argv[]);
+  void ReadInfile();  // (re-)read the per-query info from infile()
+  void SetBatch(string infile, string outfile, string cachefile);  // point a --worker process at a new batch of queries, and read its infile
   // void Check();  // make sure everything's the same length (i.e. the input file had all the expected columns)
 
   string hmmdir() { return hmmdir_arg_.getValue(); }
   string datadir() { return datadir_arg_.getValue(); }
-  string infile() { return infile_arg_.getValue(); }
-  string outfile() { return outfile_arg_.getValue(); }
+  string infile() { return infile_; }
+  string outfile() { return outfile_; }
   string annotationfile() { return annotationfile_arg_.getValue(); }
-  string cachefile() { return cachefile_arg_.getValue(); }
+  string cachefile() { return cachefile_; }
   float hamming_fraction_bound_lo() { return hamming_fraction_bound_lo_arg_.getValue(); }
   float hamming_fraction_bound_hi() { return hamming_fraction_bound_hi_arg_.getValue(); }
   float logprob_ratio_threshold() { return logprob_ratio_threshold_arg_.getValue(); }
@@ -46,6 +48,7 @@ public:
   bool cache_naive_hfracs() { return cache_naive_hfracs_arg_.getValue(); }
   bool only_cache_new_vals() { return only_cache_new_vals_arg_.getValue(); }
   bool write_logprob_for_each_partition() { return write_logprob_for_each_partition_arg_.getValue(); }
+  bool worker() { return worker_arg_.getValue(); }
  
   // command line arguments
   vector<string> algo_strings_;
@@ -56,7 +59,10 @@ public:
   ValueArg<float> hamming_fraction_bound_lo_arg_, hamming_fraction_bound_hi_arg_, logprob_ratio_threshold_arg_, max_logprob_drop_arg_;
   ValueArg<int> debug_arg_, smc_particles_arg_, naive_hamming_cluster_arg_, biggest_naive_seq_cluster_to_calculate_arg_, biggest_logprob_cluster_to_calculate_arg_, n_partitions_to_write_arg_;
   ValueArg<unsigned> random_seed_arg_;
-  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_;
+  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_, worker_arg_;
+
+  // files for the current batch (set from the command line, or, with --worker, from stdin)
+  string infile_, outfile_, cachefile_;
 
   // arguments read from csv input file
   map<string, vector<string> > strings_;
@@ -10,8 +10,8 @@ Args::Args(int argc, const char * argv[]):
   debug_vals_(debug_ints_),
   hmmdir_arg_("", "hmmdir", "directory in which to look for hmm model files", true, "", "string"),
   datadir_arg_("", "datadir", "directory in which to look for non-sample-specific data (eg human germline seqs)", true, "", "string"),
-  infile_arg_("", "infile", "input (whitespace-separated) file", true, "", "string"),
-  outfile_arg_("", "outfile", "output csv file", true, "", "string"),
+  infile_arg_("", "infile", "input (whitespace-separated) file (required unless --worker)", false, "", "string"),
+  outfile_arg_("", "outfile", "output csv file (required unless --worker)", false, "", "string"),
   annotationfile_arg_("", "annotationfile", "if specified, write annotations for each cluster to here", false, "", "string"),
   cachefile_arg_("", "cachefile", "input (and output) cache log prob csv file", false, "", "string"),
   algorithm_arg_("", "algorithm", "algorithm to run", true, "", &algo_vals_),
@@ -35,6 +35,7 @@ Args::Args(int argc, const char * argv[]):
   cache_naive_hfracs_arg_("", "cache-naive-hfracs", "cache naive hamming fraction between sequence sets (in addition to log probs and naive seqs)", false),
   only_cache_new_vals_arg_("", "only-cache-new-vals", "only write sequence sets with newly-calculated values to cache file", false),
   write_logprob_for_each_partition_arg_("", "write-logprob-for-each-partition", "By default, we don't know the total logprob of each partition (since many merges are by naive hfrac). This argument tells us that this is the last time through (with one process) and we want to know the total probability of each partition.", false),
+  worker_arg_("", "worker", "stay resident, reading one batch per line (\"<infile> <outfile> [<cachefile>]\") from stdin until eof", false),
   str_headers_ {},
   int_headers_ {"k_v_min", "k_v_max", "k_d_min", "k_d_max"},
   float_headers_ {},
@@ -71,6 +72,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(write_logprob_for_each_partition_arg_);
     cmd.add(partition_arg_);
     cmd.add(dont_rescale_emissions_arg_);
+    cmd.add(worker_arg_);
 
     cmd.parse(argc, argv);
 
@@ -79,6 +81,35 @@ Args::Args(int argc, const char * argv[]):
     throw;
   }
 
+  infile_ = infile_arg_.getValue();
+  outfile_ = outfile_arg_.getValue();
+  cachefile_ = cachefile_arg_.getValue();
+  if(worker())  // batches come in on stdin
+    return;
+  if(infile_ == "" || outfile_ == "")
+    throw runtime_error("args.cc: --infile and --outfile are required (unless running with --worker)\n");
+  ReadInfile();
+
+  // Check();
+}
+
+// ----------------------------------------------------------------------------------------
+void Args::SetBatch(string infile, string outfile, string cachefile) {
+  infile_ = infile;
+  outfile_ = outfile;
+  cachefile_ = cachefile;
+  ReadInfile();
+}
+
+// ----------------------------------------------------------------------------------------
+void Args::ReadInfile() {
+  strings_.clear();
+  integers_.clear();
+  floats_.clear();
+  str_lists_.clear();
+  int_lists_.clear();
+  float_lists_.clear();
+
   for(auto & head : str_headers_)
     strings_[head] = vector<string>();
   for(auto & head : int_headers_)
@@ -131,8 +162,6 @@ Args::Args(int argc, const char * argv[]):
       }
     }
   }
-
-  // Check();
 }
 
 // // ----------------------------------------------------------------------------------------
@@ -23,6 +23,8 @@ using namespace std;
 // ----------------------------------------------------------------------------------------
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk);
 void run_algorithm(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args &args);
+void run_batch(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk);
+void run_worker(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk);
 
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
@@ -30,27 +32,67 @@ int main(int argc, const char * argv[]) {
   Args args(argc, argv);
   if(args.smc_particles() > 1)
     assert(0);  // see commented code below
-  srand(args.random_seed());
 
   // init some infrastructure
   vector<string> characters {"A", "C", "G", "T"};
   Track track("NUKES", characters, args.ambig_base());
   GermLines gl(args.datadir());
   HMMHolder hmms(args.hmmdir(), gl, &track);
-  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, &track));
+
+  if(args.worker()) {
+    run_worker(hmms, gl, args, &track);
+    return 0;
+  }
+
+  run_batch(hmms, gl, args, &track);
+
+  printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+// run on the queries in args.infile(), writing to args.outfile()
+void run_batch(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk) {
+  srand(args.random_seed());  // reset for each batch, so a --worker gives the same results as a fresh process
+  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, trk));
 
   if(args.cache_naive_seqs()) {
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.CacheNaiveSeqs();
   } else if(args.partition()) {  // NOTE this is kind of hackey -- there's some code duplication between Glomerator and the loop below... but only a little, and they're doing fairly different things, so screw it for the time being
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.Cluster();
   } else {
     run_algorithm(hmms, gl, qry_seq_list, args);
   }
+}
 
-  printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
-  return 0;
+// ----------------------------------------------------------------------------------------
+// stay resident (so we only read the hmms and germline info once), and run one batch for each line "<infile> <outfile> [<cachefile>]" on stdin.
+// After each batch, we print a line starting with "bcrham-worker:" so the caller knows we're finished with it.
+void run_worker(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk) {
+  string line;
+  while(getline(cin, line)) {
+    if(line.size() == 0)
+      continue;
+    clock_t batch_start(clock());
+    stringstream ss(line);
+    string infile, outfile, cachefile;
+    ss >> infile >> outfile >> cachefile;  // cachefile is optional
+    bool ok(true);
+    try {
+      args.SetBatch(infile, outfile, cachefile);
+      run_batch(hmms, gl, args, trk);
+    } catch(exception &e) {
+      cerr << "ERROR bcrham worker failed on batch '" << line << "': " << e.what() << endl;
+      ok = false;
+    }
+    printf("        time: bcrham %.1f\n", ((clock() - batch_start) / (double)CLOCKS_PER_SEC));
+    printf("bcrham-worker: %s\n", ok ? "done" : "failed");
+    fflush(stdout);
+    cout.flush();
+    cerr.flush();
+  }
 }
 
 // ----------------------------------------------------------------------------------------
@@ -1,9 +1,8 @@
 import time
-import math
 import os
 import operator
-import scipy
 import glob
+import numpy
 
 import fraction_uncertainty
 from mutefreqer import MuteFreqer
@@ -53,8 +52,8 @@ class AlleleFinder(object):
         self.finalized = False
 
     # ----------------------------------------------------------------------------------------
-    def increment(self, info):
-        self.mfreqer.increment(info)
+    def increment(self, info, multiplicity=1):
+        self.mfreqer.increment(info, multiplicity=multiplicity)
 
         for region in utils.regions:
             regional_freq, len_excluding_ambig = utils.get_mutation_rate(info, restrict_to_region=region, return_len_excluding_ambig=True)
@@ -67,7 +66,7 @@ class AlleleFinder(object):
             if gene not in self.counts:
                 self.counts[gene] = {}
                 self.gene_obs_counts[gene] = 0
-            self.gene_obs_counts[gene] += 1
+            self.gene_obs_counts[gene] += multiplicity
 
             gcts = self.counts[gene]  # shorthand name
 
@@ -89,62 +88,123 @@ class AlleleFinder(object):
                 if utils.get_region(gene) == 'v':
                     if n_mutes not in gcts[igl]:
                         gcts[igl][n_mutes] = {n : 0 for n in ['muted', 'total'] + utils.nukes}
-                    gcts[igl][n_mutes]['total'] += 1
+                    gcts[igl][n_mutes]['total'] += multiplicity
                     if query_seq[ipos] != germline_seq[ipos]:  # if this position is mutated
-                        gcts[igl][n_mutes]['muted'] += 1  # mark that we saw this germline position mutated once in a sequence with <n_mutes> regional mutation frequency
-                    gcts[igl][n_mutes][query_seq[ipos]] += 1  # only used to work out what the snp'd base is if there's a new allele
+                        gcts[igl][n_mutes]['muted'] += multiplicity  # mark that we saw this germline position mutated once in a sequence with <n_mutes> regional mutation frequency
+                    gcts[igl][n_mutes][query_seq[ipos]] += multiplicity  # only used to work out what the snp'd base is if there's a new allele
 
     # ----------------------------------------------------------------------------------------
-    def get_residual_sum(self, xvals, yvals, errs, slope, intercept):
-        def expected(x):
-            return slope * x + intercept
-        residual_sum = sum([(y - expected(x))**2 / err**2 for x, y, err in zip(xvals, yvals, errs)])
-        return residual_sum
+    def merge(self, other):
+        """ add the counts from <other> (e.g. from a different shard of the same sample) to ours """
+        if self.finalized or other.finalized:
+            raise Exception('can\'t merge finalized allele finders')
+        self.mfreqer.merge(other.mfreqer)
+        for gene, ocounts in other.counts.items():
+            if gene not in self.counts:
+                self.counts[gene] = {}
+                self.gene_obs_counts[gene] = 0
+            self.gene_obs_counts[gene] += other.gene_obs_counts[gene]
+            gcts = self.counts[gene]
+            for igl, ipcounts in ocounts.items():
+                if igl not in gcts:
+                    gcts[igl] = {}
+                for n_mutes, ocountfo in ipcounts.items():
+                    if n_mutes not in gcts[igl]:
+                        gcts[igl][n_mutes] = {n : 0 for n in ['muted', 'total'] + utils.nukes}
+                    for key, count in ocountfo.items():
+                        gcts[igl][n_mutes][key] += count
 
     # ----------------------------------------------------------------------------------------
-    def get_curvefit(self, n_mutelist, freqs, errs, y_icpt_bounds=None):
-        def func(x, slope, y_icpt):
-            return slope*x + y_icpt
-
-        bounds = (-float('inf'), float('inf'))
-        if y_icpt_bounds is not None:
-            bounds = [[s, y] for s, y in zip(self.default_slope_bounds, y_icpt_bounds)]
-        params, cov = scipy.optimize.curve_fit(func, n_mutelist, freqs, sigma=errs, bounds=bounds)
-        slope, slope_err = params[0], math.sqrt(cov[0][0])
-        y_icpt, y_icpt_err = params[1], math.sqrt(cov[1][1])
-        residual_sum = self.get_residual_sum(n_mutelist, freqs, errs, slope, y_icpt)
-        ndof = len(n_mutelist) - 1
-        fitfo = {
-            'slope'  : slope,
-            'y_icpt' : y_icpt,
-            'slope_err'  : slope_err,
-            'y_icpt_err' : y_icpt_err,
-            'residuals_over_ndof' : float(residual_sum) / ndof,
-            'print_str' : '    %9.3f +/- %-9.3f   %7.4f +/- %7.4f    %7.4f' % (y_icpt, y_icpt_err, slope, slope_err, float(residual_sum) / ndof),
-            'n_mutelist' : n_mutelist,
-            'freqs' : freqs,
-            'errs' : errs
-        }
-
-        return fitfo
+    def get_linear_fits(self, xvals, yvals, weights, y_icpt_bounds):
+        """
+        Weighted least squares fits of y = slope * x + y_icpt for each row of the 2d arrays <xvals>, <yvals>, <weights> (pad the rows with zero weights), with the slope within self.default_slope_bounds and the intercept within <y_icpt_bounds>.
+        Since the chi-square is quadratic in the parameters, its minimum is either the unconstrained solution or on one of the edges of the box, so we work them all out in closed form and take the best one.
+        Returns a dict of arrays, one entry per row. Uncertainties are scaled by the residuals, like scipy's curve_fit() (which this replaces).
+        """
+        sw = weights.sum(axis=1)
+        sx, sy = (weights * xvals).sum(axis=1), (weights * yvals).sum(axis=1)
+        sxx, sxy = (weights * xvals * xvals).sum(axis=1), (weights * xvals * yvals).sum(axis=1)
+        det = sw * sxx - sx * sx
+        slope_bounds = self.default_slope_bounds
+
+        def chi2(slope, y_icpt):
+            return (weights * (yvals - slope[:, None] * xvals - y_icpt[:, None])**2).sum(axis=1)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            candidates = []
+            slope, y_icpt = (sw * sxy - sx * sy) / det, (sxx * sy - sx * sxy) / det  # unconstrained solution
+            allowed = (det > 0) & (slope >= slope_bounds[0]) & (slope <= slope_bounds[1]) & (y_icpt >= y_icpt_bounds[0]) & (y_icpt <= y_icpt_bounds[1])
+            candidates.append((numpy.where(allowed, slope, 0.), numpy.where(allowed, y_icpt, 0.), allowed))
+            for icpt_bound in y_icpt_bounds:  # intercept fixed at one of its bounds
+                icpt = numpy.full(len(sw), icpt_bound)
+                candidates.append((numpy.clip(numpy.nan_to_num((sxy - icpt * sx) / sxx), *slope_bounds), icpt, numpy.ones(len(sw), dtype=numpy.bool_)))
+            for slope_bound in slope_bounds:  # slope fixed at one of its bounds
+                slp = numpy.full(len(sw), slope_bound)
+                candidates.append((slp, numpy.clip(numpy.nan_to_num((sy - slp * sx) / sw), *y_icpt_bounds), numpy.ones(len(sw), dtype=numpy.bool_)))
+
+        chi2s = numpy.array([numpy.where(allowed, chi2(slp, icpt), numpy.inf) for slp, icpt, allowed in candidates])
+        ibest = numpy.argmin(chi2s, axis=0)
+        irows = numpy.arange(len(sw))
+        slope = numpy.array([slp for slp, _, _ in candidates])[ibest, irows]
+        y_icpt = numpy.array([icpt for _, icpt, _ in candidates])[ibest, irows]
+        residual_sum = chi2s[ibest, irows]
+
+        n_points = (weights > 0).sum(axis=1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            scale = residual_sum / (n_points - 2)  # reduced chi-square
+            slope_err, y_icpt_err = numpy.sqrt(sw / det * scale), numpy.sqrt(sxx / det * scale)
+            residuals_over_ndof = residual_sum / (n_points - 1)
+
+        return {'slope' : slope, 'y_icpt' : y_icpt, 'slope_err' : slope_err, 'y_icpt_err' : y_icpt_err, 'residuals_over_ndof' : residuals_over_ndof}
 
     # ----------------------------------------------------------------------------------------
-    def get_allele_finding_xyvals(self, gene, position):
-        gpcounts = self.counts[gene][position]
-        iterinfo = gpcounts.items()
-
-        obs = [d['muted'] for nm, d in iterinfo if nm < self.n_max_mutations_per_segment]
-
-        lohis = [fraction_uncertainty.err(d['muted'], d['total'], use_beta=True) for nm, d in iterinfo if nm < self.n_max_mutations_per_segment]
-        errs = [(hi - lo) / 2 for lo, hi, _ in lohis]
-        weights = [1./(e*e) for e in errs]
-
-        freqs = [float(d['muted']) / d['total'] if d['total'] > 0 else 0. for nm, d in iterinfo if nm < self.n_max_mutations_per_segment]
-        total = [d['total'] for nm, d in iterinfo if nm < self.n_max_mutations_per_segment]
-
-        n_mutelist = [nm for nm in gpcounts.keys() if nm < self.n_max_mutations_per_segment]
+    def get_window_residuals(self, positions, xyvals):
+        """ zero- and big-intercept fit residuals for each position in <positions> over the window starting at each <istart>, with all the fits done at once """
+        keys, lengths = [], []
+        xvals, yvals, weights = [numpy.zeros(((self.n_max_snps - 1) * len(positions), self.max_fit_length)) for _ in range(3)]
+        for istart in range(1, self.n_max_snps):
+            for pos in positions:
+                ikey = len(keys)
+                n_mutelist = xyvals[pos]['n_mutelist'][istart : istart + self.max_fit_length]
+                xvals[ikey, : len(n_mutelist)] = n_mutelist
+                yvals[ikey, : len(n_mutelist)] = xyvals[pos]['freqs'][istart : istart + self.max_fit_length]
+                weights[ikey, : len(n_mutelist)] = xyvals[pos]['weights'][istart : istart + self.max_fit_length]
+                keys.append((istart, pos))
+                lengths.append(len(n_mutelist))
+
+        zero_icpt_fits = self.get_linear_fits(xvals, yvals, weights, y_icpt_bounds=(0. - self.small_number, 0. + self.small_number))
+        big_icpt_fits = self.get_linear_fits(xvals, yvals, weights, y_icpt_bounds=self.big_y_icpt_bounds)
+
+        window_residuals = {istart : {} for istart in range(1, self.n_max_snps)}
+        for ikey, (istart, pos) in enumerate(keys):
+            if lengths[ikey] < 3:  # fit_istart() skips these anyway
+                continue
+            window_residuals[istart][pos] = {'zero_icpt' : float(zero_icpt_fits['residuals_over_ndof'][ikey]), 'big_icpt' : float(big_icpt_fits['residuals_over_ndof'][ikey])}
+        return window_residuals
 
-        return {'obs' : obs, 'total' : total, 'n_mutelist' : n_mutelist, 'freqs' : freqs, 'errs' : errs, 'weights' : weights}
+    # ----------------------------------------------------------------------------------------
+    def get_allele_finding_xyvals(self, gene, positions):
+        """ x/y values (and uncertainties) to fit for each of <positions> in <gene>, with the uncertainties for all positions calculated at once """
+        xyvals = {}
+        for position in positions:
+            iterinfo = [(nm, d) for nm, d in self.counts[gene][position].items() if nm < self.n_max_mutations_per_segment]
+            xyvals[position] = {'obs' : [d['muted'] for nm, d in iterinfo],
+                                'total' : [d['total'] for nm, d in iterinfo],
+                                'n_mutelist' : [nm for nm, d in iterinfo],
+                                'freqs' : [float(d['muted']) / d['total'] if d['total'] > 0 else 0. for nm, d in iterinfo]}
+
+        all_obs = [o for pos in positions for o in xyvals[pos]['obs']]
+        all_total = [t for pos in positions for t in xyvals[pos]['total']]
+        lo, hi, _ = fraction_uncertainty.errs(numpy.array(all_obs, dtype=numpy.int64), numpy.array(all_total, dtype=numpy.int64), use_beta=True)
+        all_errs = ((hi - lo) / 2).tolist()
+        istart = 0
+        for position in positions:
+            errs = all_errs[istart : istart + len(xyvals[position]['obs'])]
+            istart += len(errs)
+            xyvals[position]['errs'] = errs
+            xyvals[position]['weights'] = [1./(e*e) for e in errs]
+
+        return xyvals
 
     # ----------------------------------------------------------------------------------------
     def is_a_candidate(self, gene, fitfo, istart, debug=False):
@@ -167,8 +227,8 @@ class AlleleFinder(object):
     def get_positions_to_fit(self, gene, gene_results, debug=False):
         self.fitted_positions[gene] = set()
 
-        positions = sorted(self.mfreqer.counts[gene].keys())
-        xyvals = {pos : self.get_allele_finding_xyvals(gene, pos) for pos in positions}
+        positions = self.mfreqer.get_positions(gene)
+        xyvals = self.get_allele_finding_xyvals(gene, positions)
         positions_to_try_to_fit = [pos for pos in positions if sum(xyvals[pos]['obs']) > self.n_muted_min or sum(xyvals[pos]['total']) > self.n_total_min]  # ignore positions with neither enough mutations or total observations
         if len(positions_to_try_to_fit) < self.n_max_snps - 1 + self.min_non_candidate_positions_to_fit:
             gene_results['not_enough_obs_to_fit'].add(gene)
@@ -185,7 +245,7 @@ class AlleleFinder(object):
         return positions_to_try_to_fit, xyvals
 
     # ----------------------------------------------------------------------------------------
-    def fit_istart(self, gene, istart, positions_to_try_to_fit, subxyvals, fitfo, debug=False):
+    def fit_istart(self, gene, istart, positions_to_try_to_fit, subxyvals, fitfo, window_residuals, debug=False):
         residuals = {}
         for pos in positions_to_try_to_fit:
             # skip positions that are too close to the 5' end of V (misassigned insertions look like snps)
@@ -203,10 +263,7 @@ class AlleleFinder(object):
             if len(subxyvals[pos]['n_mutelist']) < 3:
                 continue
 
-            zero_icpt_fit = self.get_curvefit(subxyvals[pos]['n_mutelist'], subxyvals[pos]['freqs'], subxyvals[pos]['errs'], y_icpt_bounds=(0. - self.small_number, 0. + self.small_number))
-            big_icpt_fit = self.get_curvefit(subxyvals[pos]['n_mutelist'], subxyvals[pos]['freqs'], subxyvals[pos]['errs'], y_icpt_bounds=self.big_y_icpt_bounds)
-
-            residuals[pos] = {'zero_icpt' : zero_icpt_fit['residuals_over_ndof'], 'big_icpt' : big_icpt_fit['residuals_over_ndof']}
+            residuals[pos] = window_residuals[pos]  # already did the fits for all windows in get_window_residuals()
 
             self.fitted_positions[gene].add(pos)  # if we already did the fit for another <istart>, it'll already be in there
 
@@ -249,7 +306,7 @@ class AlleleFinder(object):
         for pos in sorted(fitfo['candidates'][n_candidate_snps]):
             obs_counts = {nuke : self.counts[gene][pos][n_candidate_snps][nuke] for nuke in utils.nukes}  # NOTE it's super important to only use the counts from sequences with <n_candidate_snps> total mutations
             sorted_obs_counts = sorted(obs_counts.items(), key=operator.itemgetter(1), reverse=True)
-            original_nuke = self.mfreqer.counts[gene][pos]['gl_nuke']
+            original_nuke = self.mfreqer.get_gl_nuke(gene, pos)
             new_nuke = None
             for nuke, _ in sorted_obs_counts:  # take the most common one that isn't the existing gl nuke
                 if nuke != original_nuke:
@@ -283,7 +340,7 @@ class AlleleFinder(object):
         gene_results = {'not_enough_obs_to_fit' : set(), 'didnt_find_anything_with_fit' : set(), 'new_allele' : set()}
         if debug:
             print '\nlooking for new alleles:'
-        for gene in sorted(self.mfreqer.counts):
+        for gene in sorted(self.mfreqer.get_genes()):
             if utils.get_region(gene) != 'v':
                 continue
             if debug:
@@ -294,6 +351,7 @@ class AlleleFinder(object):
                 continue
 
             fitfo = {n : {} for n in ('min_snp_ratios', 'candidates')}
+            window_residuals = self.get_window_residuals(positions_to_try_to_fit, xyvals)
             for istart in range(1, self.n_max_snps):
                 if debug:
                     if istart == 1:
@@ -302,7 +360,7 @@ class AlleleFinder(object):
                     print '  %d %s' % (istart, utils.plural_str('snp', istart))
 
                 subxyvals = {pos : {k : v[istart : istart + self.max_fit_length] for k, v in xyvals[pos].items()} for pos in positions_to_try_to_fit}
-                self.fit_istart(gene, istart, positions_to_try_to_fit, subxyvals, fitfo, debug=debug)
+                self.fit_istart(gene, istart, positions_to_try_to_fit, subxyvals, fitfo, window_residuals[istart], debug=debug)
                 if istart not in fitfo['candidates']:  # if it didn't get filled, we didn't have enough observations to do the fit
                     break
 
@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import select
+from subprocess import Popen, PIPE
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class BcrhamWorkerPool(object):
+    """
+    Keep a set of bcrham processes running in --worker mode between partition steps, so we only pay for hmm yaml parsing and process startup once (rather than once per step).
+    Each worker is fed one batch (infile, outfile, cachefile) at a time over its stdin, and tells us it's done by printing a 'bcrham-worker:' line.
+    """
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.cmd_str = None  # command (minus the per-batch files) with which the current workers were started
+        self.procs = []
+        self.sentinel = 'bcrham-worker:'
+        self.max_tries = 5
+
+    # ----------------------------------------------------------------------------------------
+    def __del__(self):
+        self.close()
+
+    # ----------------------------------------------------------------------------------------
+    def static_cmd_str(self, cmd_str):
+        """ remove the per-batch file arguments from <cmd_str> """
+        strlist = cmd_str.split()
+        for argname in ('--infile', '--outfile', '--cachefile'):
+            if argname in strlist:
+                iarg = strlist.index(argname)
+                strlist = strlist[:iarg] + strlist[iarg + 2:]
+        return ' '.join(strlist + ['--worker', ])
+
+    # ----------------------------------------------------------------------------------------
+    def errfname(self, iproc):
+        return self.workdir + '/bcrham-worker-' + str(iproc) + '.err'
+
+    # ----------------------------------------------------------------------------------------
+    def start_worker(self, iproc):
+        errfile = open(self.errfname(iproc), 'a')  # append mode, so truncating it after each batch works even though the worker keeps it open
+        proc = Popen(self.cmd_str, shell=True, stdin=PIPE, stdout=PIPE, stderr=errfile, close_fds=True)
+        errfile.close()
+        return proc
+
+    # ----------------------------------------------------------------------------------------
+    def stop_worker(self, iproc):
+        proc = self.procs[iproc]
+        if proc.poll() is None:
+            proc.stdin.close()  # worker exits when it hits eof on stdin
+        proc.wait()
+        if os.path.exists(self.errfname(iproc)):
+            os.remove(self.errfname(iproc))
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        for iproc in range(len(self.procs)):
+            self.stop_worker(iproc)
+        self.procs = []
+        self.cmd_str = None
+
+    # ----------------------------------------------------------------------------------------
+    def resize(self, cmd_str, n_procs):
+        """ make sure we have exactly <n_procs> workers that were started with (the static part of) <cmd_str> """
+        if self.static_cmd_str(cmd_str) != self.cmd_str:  # arguments changed (e.g. different algorithm, or seed uid removed), so we need new workers
+            self.close()
+            self.cmd_str = self.static_cmd_str(cmd_str)
+        while len(self.procs) > n_procs:  # n procs only ever decreases during partitioning, so don't keep unused workers (and their memory) around
+            self.stop_worker(len(self.procs) - 1)
+            self.procs.pop()
+        while len(self.procs) < n_procs:
+            self.procs.append(self.start_worker(len(self.procs)))
+
+    # ----------------------------------------------------------------------------------------
+    def read_err(self, iproc):
+        with open(self.errfname(iproc)) as errfile:
+            err = errfile.read()
+        open(self.errfname(iproc), 'w').close()
+        return err
+
+    # ----------------------------------------------------------------------------------------
+    def send(self, iproc, batch):
+        self.procs[iproc].stdin.write(' '.join([f for f in batch if f is not None]) + '\n')
+        self.procs[iproc].stdin.flush()
+
+    # ----------------------------------------------------------------------------------------
+    def run(self, cmd_str, batches, infos):
+        """
+        Run each of <batches> (list of (infile, outfile, cachefile) tuples, one for each process) on its own worker, filling the corresponding entry in <infos> with the calcd/time info from stdout.
+        Returns as soon as all batches have finished (we block on the workers' stdout pipes, rather than polling), with the list of wall times for each batch.
+        """
+        self.resize(cmd_str, len(batches))
+
+        n_tries = [1 for _ in batches]
+        outstrs = ['' for _ in batches]
+        start_times = [time.time() for _ in batches]
+        wall_times = [None for _ in batches]
+        fd_procs = {}  # map from stdout file descriptor to iproc for workers that are still busy
+        for iproc in range(len(batches)):
+            self.send(iproc, batches[iproc])
+            fd_procs[self.procs[iproc].stdout.fileno()] = iproc
+
+        while len(fd_procs) > 0:
+            readable, _, _ = select.select(fd_procs.keys(), [], [])
+            for fd in readable:
+                iproc = fd_procs[fd]
+                chunk = os.read(fd, 65536)
+                outstrs[iproc] += chunk
+                finished = self.sentinel + ' ' in outstrs[iproc]
+                if chunk != '' and not finished:
+                    continue
+
+                del fd_procs[fd]
+                out = outstrs[iproc]
+                outstrs[iproc] = ''
+                status = None
+                if finished:
+                    out, status = out.split(self.sentinel + ' ')
+                    status = status.strip()
+                err = self.read_err(iproc)
+                outfname = batches[iproc][1]
+                if status == 'done' and os.path.exists(outfname):
+                    utils.process_out_err(out, err, extra_str='' if len(batches) == 1 else str(iproc), info=infos[iproc])
+                    wall_times[iproc] = time.time() - start_times[iproc]
+                    continue
+
+                if n_tries[iproc] > self.max_tries:
+                    raise Exception('exceeded max number of tries for batch %s with bcrham worker command\n    %s\nerr:\n%s' % (' '.join([f for f in batches[iproc] if f is not None]), self.cmd_str, err))
+                print '    rerunning proc %d (%s' % (iproc, 'worker died' if status is None else 'worker batch ' + status),
+                if not os.path.exists(outfname):
+                    print ', output %s d.n.e.' % outfname,
+                print ')'
+                if err.strip() != '':
+                    print err
+                if status is None:  # worker process itself is gone, so start a new one
+                    self.procs[iproc].wait()
+                    self.procs[iproc] = self.start_worker(iproc)
+                self.send(iproc, batches[iproc])
+                start_times[iproc] = time.time()
+                fd_procs[self.procs[iproc].stdout.fileno()] = iproc
+                n_tries[iproc] += 1
+            sys.stdout.flush()
+
+        return wall_times
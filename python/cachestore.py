@@ -0,0 +1,107 @@
+import os
+import csv
+import sqlite3
+
+# ----------------------------------------------------------------------------------------
+def is_cachestore_fname(fname):
+    """ do we treat <fname> as a sqlite cache store (rather than a csv cache file)? """
+    return os.path.splitext(fname)[1] in ('.db', '.sqlite')
+
+# ----------------------------------------------------------------------------------------
+def get_member_rows(keys):
+    """ (cluster, uid) pair for each unique id in each cluster key in <keys> """
+    for key in keys:
+        for uid in key.split(':'):
+            yield key, uid
+
+# ----------------------------------------------------------------------------------------
+class CacheStore(object):
+    """
+    Persistent cache of bcrham's per-cluster info (log probs, naive seqs, etc.) in a sqlite file, keyed by the colon-separated list of unique ids.
+    Lets several partis processes share one cache (sqlite does the locking, and we use write-ahead logging so readers don't block on writers),
+    and lets us add new info, or look up single clusters, without copying or sorting the whole file.
+    NOTE all values are stored as the strings bcrham wrote, so what we write back out is identical to what went in.
+    We also keep an indexed table with a row for each (cluster, unique id) pair, so we can pick out the clusters made up of a given set of ids without reading the whole cache.
+    """
+    def __init__(self, fname, headers):
+        self.fname = fname
+        self.headers = list(headers)  # first header is the key
+        self.key = self.headers[0]
+        self.conn = sqlite3.connect(self.fname, timeout=600)  # wait up to ten minutes for other processes to finish writing
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache (%s TEXT PRIMARY KEY, %s)' % (self.key, ', '.join([h + ' TEXT' for h in self.headers[1:]])))
+            have_members = self.conn.execute('SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' AND name = \'members\'').fetchone()[0] > 0
+            self.conn.execute('CREATE TABLE IF NOT EXISTS members (cluster TEXT, uid TEXT, PRIMARY KEY (cluster, uid)) WITHOUT ROWID')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS members_uid ON members (uid)')
+            if not have_members:  # cache file from before we kept the members table
+                keys = (row[0] for row in self.conn.execute('SELECT %s FROM cache' % self.key).fetchall())
+                self.conn.executemany('INSERT OR IGNORE INTO members (cluster, uid) VALUES (?, ?)', get_member_rows(keys))
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # ----------------------------------------------------------------------------------------
+    def lookup(self, key):
+        """ return dict of cached info for the cluster <key> (colon-separated unique ids), or None if we don't have it """
+        row = self.conn.execute('SELECT %s FROM cache WHERE %s = ?' % (', '.join(self.headers), self.key), (key, )).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.headers, row))
+
+    # ----------------------------------------------------------------------------------------
+    def write_csv(self, outfname, queries=None):
+        """
+        Write the cache to csv file <outfname> (which is what bcrham reads).
+        If <queries> is set, only write clusters all of whose ids are in <queries> (bcrham will never look up the others).
+        Returns the number of clusters written.
+        """
+        columns = ', '.join(['cache.' + h for h in self.headers])
+        if queries is None:
+            select_str = 'SELECT %s FROM cache' % columns
+        else:  # put the queries in a temporary table, then keep the clusters for which the number of members that are queries is the number of members (CROSS JOIN tells sqlite to loop over the queries, looking each up in the members index)
+            with self.conn:
+                self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS queries (uid TEXT PRIMARY KEY)')
+                self.conn.execute('DELETE FROM queries')
+                self.conn.executemany('INSERT OR IGNORE INTO queries (uid) VALUES (?)', ((q, ) for q in queries))
+            matched_str = 'SELECT m.cluster AS cluster FROM queries q CROSS JOIN members m ON m.uid = q.uid GROUP BY m.cluster HAVING COUNT(*) = (SELECT COUNT(*) FROM members WHERE cluster = m.cluster)'
+            select_str = 'SELECT %s FROM cache JOIN (%s) matched ON cache.%s = matched.cluster ORDER BY cache.rowid' % (columns, matched_str, self.key)
+        n_written = 0
+        with open(outfname, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(self.headers)
+            for row in self.conn.execute(select_str):
+                writer.writerow(row)
+                n_written += 1
+        return n_written
+
+    # ----------------------------------------------------------------------------------------
+    def add_from_csv(self, infname):
+        """
+        Add info from csv file <infname> (written by bcrham).
+        New clusters are inserted, and for existing clusters we fill in any values that we didn't have before (e.g. a logprob for a cluster for which we'd only cached the naive seq).
+        Returns the number of lines read.
+        """
+        if not os.path.exists(infname) or os.stat(infname).st_size == 0:
+            return 0
+        with open(infname) as infile:
+            reader = csv.DictReader(infile)
+            if set(reader.fieldnames) != set(self.headers):
+                raise Exception('unexpected header list %s in %s (expected %s)' % (reader.fieldnames, infname, self.headers))
+            rows = [[line[h] for h in self.headers] for line in reader]
+
+        with self.conn:  # one transaction (commits at the end, or rolls back if something goes wrong)
+            self.conn.executemany('INSERT OR IGNORE INTO cache (%s) VALUES (%s)' % (', '.join(self.headers), ', '.join(['?' for _ in self.headers])), rows)
+            update_str = ', '.join(['%s = CASE WHEN %s = \'\' THEN ? ELSE %s END' % (h, h, h) for h in self.headers[1:]])
+            self.conn.executemany('UPDATE cache SET %s WHERE %s = ?' % (update_str, self.key), [row[1:] + row[:1] for row in rows])
+            self.conn.executemany('INSERT OR IGNORE INTO members (cluster, uid) VALUES (?, ?)', get_member_rows(row[0] for row in rows))
+
+        return len(rows)
@@ -2,9 +2,189 @@ import os
 import sys
 import math
 import csv
+import bisect
 
 import utils
+import columnar
+import partitionmetrics
 from opener import opener
+from uidregistry import registry
+
+# ----------------------------------------------------------------------------------------
+class PartitionList(object):
+    """
+    List of partitions that stores each distinct cluster only once (as a packed string of uid indices from the uid registry), and most partitions only as the clusters that were removed from and added to the previous partition (i.e. the merges).
+    Each cluster in a partition is an entry (an integer pointing to the cluster), and each step is either the full list of entries, or a delta from the previous partition:
+    a tuple (removed entries, list of (new entry, entry it comes after [None if it's first])). Every so often (once the deltas add up to as much as a whole partition) we store
+    the full list, and we apply deltas to a linked list, so rebuilding a partition takes time linear in its size plus the size of the deltas.
+    Partitions are rebuilt (and converted back to uids) when you ask for them, but we remember the last one, so going through them in order is fast.
+    """
+    def __init__(self):
+        self.clusters = []  # each distinct (packed) cluster we've seen
+        self.cluster_indices = {}  # index in <self.clusters> of each packed cluster
+        self.entry_clusters = []  # index in <self.clusters> for each entry
+        self.steps = []  # for each partition, either a list of entries or a delta from the previous partition (see above)
+        self.n_last_clusters = 0  # number of clusters in the last partition
+        self.delta_size_since_full = 0  # total size of the deltas since the last full list
+        self.last = None  # (partition index, list of entries) for the last partition we rebuilt
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.steps)
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, ip):
+        return [registry.unpack_cluster(self.clusters[self.entry_clusters[entry]]) for entry in self.get_entries(ip)]
+
+    # ----------------------------------------------------------------------------------------
+    def __iter__(self):
+        for ip in range(len(self.steps)):
+            yield self[ip]
+
+    # ----------------------------------------------------------------------------------------
+    def get_packed_partition(self, ip):
+        """ the <ip>th partition, but with each cluster still packed (see uidregistry) """
+        return [self.clusters[self.entry_clusters[entry]] for entry in self.get_entries(ip)]
+
+    # ----------------------------------------------------------------------------------------
+    def get_n_clusters(self, ip):
+        return len(self.get_entries(ip))
+
+    # ----------------------------------------------------------------------------------------
+    def get_cluster_index(self, packed_cluster):
+        if packed_cluster not in self.cluster_indices:
+            self.cluster_indices[packed_cluster] = len(self.clusters)
+            self.clusters.append(packed_cluster)
+        return self.cluster_indices[packed_cluster]
+
+    # ----------------------------------------------------------------------------------------
+    def add_entry(self, packed_cluster):
+        """ return a new entry for <packed_cluster> """
+        self.entry_clusters.append(self.get_cluster_index(packed_cluster))
+        return len(self.entry_clusters) - 1
+
+    # ----------------------------------------------------------------------------------------
+    def get_packed_cluster(self, entry):
+        return self.clusters[self.entry_clusters[entry]]
+
+    # ----------------------------------------------------------------------------------------
+    def get_entries(self, ip):
+        """ list of entries in the <ip>th partition """
+        if ip < 0:
+            ip += len(self.steps)
+        if ip < 0 or ip >= len(self.steps):
+            raise IndexError('partition index %d out of range (have %d)' % (ip, len(self.steps)))
+        if self.last is not None and self.last[0] <= ip:
+            istart, entries = self.last
+        else:
+            istart = ip
+            while isinstance(self.steps[istart], tuple):  # go back to the last full list
+                istart -= 1
+            entries = self.steps[istart]
+        deltas = []
+        for istep in range(istart + 1, ip + 1):
+            if isinstance(self.steps[istep], tuple):
+                deltas.append(self.steps[istep])
+            else:
+                entries, deltas = self.steps[istep], []
+        if len(deltas) > 0:
+            entries = self.apply_deltas(entries, deltas)
+        self.last = (ip, entries)
+        return entries
+
+    # ----------------------------------------------------------------------------------------
+    def get_delta(self, previous, entries):
+        """ return the delta from <previous> to <entries>, or None if it can't be expressed as removing and adding entries (i.e. if the ones we kept got reordered) """
+        previous_set = set(previous)
+        entry_set = set(entries)
+        removed = tuple(entry for entry in previous if entry not in entry_set)
+        if [entry for entry in entries if entry in previous_set] != [entry for entry in previous if entry in entry_set]:
+            return None
+        added = [(entries[pos], entries[pos - 1] if pos > 0 else None) for pos in range(len(entries)) if entries[pos] not in previous_set]
+        return (removed, added)
+
+    # ----------------------------------------------------------------------------------------
+    def get_delta_to(self, ip):
+        """ delta from the partition before <ip> to <ip>, or None if it can't be expressed as one """
+        step = self.steps[ip]
+        if isinstance(step, tuple):
+            return step
+        if ip == 0:
+            return None
+        return self.get_delta(self.get_entries(ip - 1), step)
+
+    # ----------------------------------------------------------------------------------------
+    def apply_deltas(self, entries, deltas):
+        """ apply each of <deltas> in turn to the partition <entries> """
+        nexts = dict(zip([None, ] + entries, entries + [None, ]))  # linked list, with None as both the head and the tail
+        prevs = dict(zip(entries, [None, ] + entries[:-1]))
+        for removed, added in deltas:
+            for entry in removed:
+                prv, nxt = prevs.pop(entry), nexts.pop(entry)
+                nexts[prv] = nxt
+                if nxt is not None:
+                    prevs[nxt] = prv
+            for entry, after in added:  # each one comes after either a kept entry or one we already added
+                nxt = nexts[after]
+                nexts[after], nexts[entry], prevs[entry] = entry, nxt, after
+                if nxt is not None:
+                    prevs[nxt] = entry
+        entries = []
+        entry = nexts[None]
+        while entry is not None:
+            entries.append(entry)
+            entry = nexts[entry]
+        return entries
+
+    # ----------------------------------------------------------------------------------------
+    def append(self, partition):
+        """ add <partition> (list of clusters), reusing the previous partition's entries for any clusters that are still there """
+        previous = self.get_entries(-1) if len(self.steps) > 0 else []
+        available = {}  # previous entries for each cluster index
+        for entry in previous:
+            available.setdefault(self.entry_clusters[entry], []).append(entry)
+        entries = []
+        for cluster in partition:
+            packed_cluster = registry.pack_cluster(cluster)
+            icluster = self.get_cluster_index(packed_cluster)
+            if len(available.get(icluster, [])) > 0:
+                entries.append(available[icluster].pop(0))
+            else:
+                entries.append(self.add_entry(packed_cluster))
+        self.append_step(self.get_delta(previous, entries) if len(self.steps) > 0 else entries, entries=entries)
+
+    # ----------------------------------------------------------------------------------------
+    def append_step(self, step, entries=None):
+        """ add the partition given by <step>: either a list of entries, or a delta from the last partition (or None if it can't be expressed as one). If you have the list of entries handy, pass it as <entries> """
+        if isinstance(step, tuple):
+            delta_size = len(step[0]) + len(step[1])
+            n_clusters = self.n_last_clusters - len(step[0]) + len(step[1])
+            if self.delta_size_since_full + delta_size <= n_clusters:
+                self.steps.append(step)
+                self.delta_size_since_full += delta_size
+                self.n_last_clusters = n_clusters
+                if entries is not None:
+                    self.last = (len(self.steps) - 1, entries)
+                return
+            if entries is None:  # time for a full list
+                entries = self.apply_deltas(self.get_entries(-1), [step, ])
+        elif step is not None:
+            entries = step
+        self.steps.append(entries)
+        self.delta_size_since_full = 0
+        self.n_last_clusters = len(entries)
+        self.last = (len(self.steps) - 1, entries)
+
+    # ----------------------------------------------------------------------------------------
+    def pop(self, ip):
+        assert ip == 0  # only need to remove the first one a.t.m.
+        if len(self.steps) > 1 and isinstance(self.steps[1], tuple):  # the new first partition needs to be a full list
+            self.steps[1] = self.get_entries(1)
+        self.steps.pop(0)
+        if self.last is not None and self.last[0] > 0:
+            self.last = (self.last[0] - 1, self.last[1])
+        else:
+            self.last = None
 
 # ----------------------------------------------------------------------------------------
 class ClusterPath(object):
@@ -12,7 +192,7 @@ class ClusterPath(object):
         self.initial_path_index = initial_path_index  # NOTE this is set to None if it's nonsensical, e.g. if we're merging several paths with different indices
 
         # NOTE make *damn* sure if you add another list here that you also take care of it in remove_first_partition()
-        self.partitions = []  # it would of course be damn nice to glomph these into a class at some point
+        self.partitions = PartitionList()  # NOTE each partition is rebuilt (as a new list of lists of uids) when you index it, so if you're using one a lot, hang on to it
         self.logprobs = []
         self.n_procs = []
         self.ccfs = []  # pair of floats (not just a float) for each partition
@@ -21,9 +201,11 @@ class ClusterPath(object):
 
         self.best_minus = 30.  # rewind by this many units of log likelihood when merging separate processes (note that this should really depend on the number of sequences)
         self.i_best, self.i_best_minus_x = None, None
+        self.logprob_maxes = {}  # for each n_procs, (partition indices, running max of their logprobs), so we can find the best-minus-x partition without going through all of them
         self.we_have_a_ccf = False  # did we read in at least one adj mi value from a file?
 
         self.seed_unique_id = seed_unique_id
+        self.column_types = {'logprob' : 'float', 'n_clusters' : 'int', 'n_procs' : 'int', 'partition' : 'list-of-lists:str', 'path_index' : 'int', 'logweight' : 'float', 'n_true_clusters' : 'int', 'ccf_under' : 'float', 'ccf_over' : 'float', 'seed_unique_id' : 'str', 'bad_clusters' : 'list:str'}  # for columnar output
 
     # ----------------------------------------------------------------------------------------
     def get_headers(self, is_data, smc_particles):
@@ -42,23 +224,40 @@ class ClusterPath(object):
         if math.isinf(self.logprobs[self.i_best]):  # if logprob is infinite, set best and best minus x to the latest one
             self.i_best_minus_x = self.i_best
             return
-        for ip in range(len(self.partitions)):  # they should be in order of increasing logprob (at least within a give number of procs)
-            if self.n_procs[ip] != self.n_procs[self.i_best]:  # only consider partitions with the same number of procs (e.g. if best partition is for 1 proc, we want the best-minus-x to also be for 1 proc)
-                continue
-            if self.logprobs[ip] > self.logprobs[self.i_best] - self.best_minus:  # pick the first one that is above threshold
-                self.i_best_minus_x = ip
-                break
+        # they should be in order of increasing logprob (at least within a give number of procs), but in any case we pick the first one that is above threshold
+        indices, maxes = self.logprob_maxes[self.n_procs[self.i_best]]  # only consider partitions with the same number of procs (e.g. if best partition is for 1 proc, we want the best-minus-x to also be for 1 proc)
+        ifirst = bisect.bisect_right(maxes, self.logprobs[self.i_best] - self.best_minus)  # first one whose running max is above threshold is the first one that's above threshold
+        if ifirst < len(indices):
+            self.i_best_minus_x = indices[ifirst]
+
+    # ----------------------------------------------------------------------------------------
+    def add_logprob_max(self, ip):
+        indices, maxes = self.logprob_maxes.setdefault(self.n_procs[ip], ([], []))
+        indices.append(ip)
+        maxes.append(self.logprobs[ip] if len(maxes) == 0 else max(maxes[-1], self.logprobs[ip]))
 
     # ----------------------------------------------------------------------------------------
     def add_partition(self, partition, logprob, n_procs, logweight=None, ccfs=[None, None]):
         # NOTE you typically want to allow duplicate (in terms of log prob) partitions, since they can have different n procs
-        self.partitions.append(partition)  # NOTE not deep copied
+        self.partitions.append(partition)
+        self.add_partition_info(logprob, n_procs, logweight=logweight, ccfs=ccfs)
+
+    # ----------------------------------------------------------------------------------------
+    def add_partition_step(self, step, logprob, n_procs, logweight=None, ccfs=[None, None]):
+        """ same as add_partition(), but with the partition given as a list of entries in self.partitions, or as a delta from the previous partition (see PartitionList) """
+        self.partitions.append_step(step)
+        self.add_partition_info(logprob, n_procs, logweight=logweight, ccfs=ccfs)
+
+    # ----------------------------------------------------------------------------------------
+    def add_partition_info(self, logprob, n_procs, logweight=None, ccfs=[None, None]):
+        """ add the info for the partition that was just appended to self.partitions, and update the best partition """
         self.logprobs.append(logprob)
         self.n_procs.append(n_procs)
         self.logweights.append(logweight)
         if len(ccfs) != 2:
             raise Exception('tried to add partition with ccfs of length %d (%s)' % (len(ccfs), ccfs))
         self.ccfs.append(ccfs)
+        self.add_logprob_max(len(self.logprobs) - 1)
         # set this as the best partition if 1) we haven't set i_best yet 2) this partition is more likely than i_best 3) i_best is set for a larger number of procs or 4) logprob is infinite (i.e. it's probably point/vsearch partis)
         # NOTE we always treat the most recent partition with infinite logprob as the best
         if self.i_best is None or logprob > self.logprobs[self.i_best] or n_procs < self.n_procs[self.i_best] or math.isinf(logprob):
@@ -75,6 +274,9 @@ class ClusterPath(object):
         self.ccfs.pop(0)
         self.logweights.pop(0)
         assert self.n_lists == 5  # make sure we didn't add another list and forget to put it in here
+        self.logprob_maxes = {}
+        for ip in range(len(self.logprobs)):
+            self.add_logprob_max(ip)
 
     # ----------------------------------------------------------------------------------------
     def readfile(self, fname):
@@ -82,6 +284,9 @@ class ClusterPath(object):
             raise Exception('can\'t read NoneType partition file')
         if os.stat(fname).st_size == 0:
             raise Exception('partition file %s has size zero' % fname)
+        if columnar.is_columnar_fname(fname):
+            self.readlines(columnar.read_rows(fname, table='partitions'))
+            return
         with opener('r')(fname) as infile:
             reader = csv.DictReader(infile)
             lines = [line for line in reader]
@@ -93,24 +298,23 @@ class ClusterPath(object):
             if 'path_index' in line and int(line['path_index']) != self.initial_path_index:  # if <lines> contains more than one path_index, that means they represent more than one path, so you need to use glomerator, not just one ClusterPath
                 raise Exception('path index in lines %d doesn\'t match my initial path index %d' % (int(line['path_index']), self.initial_path_index))
             partitionstr = line['partition'] if 'partition' in line else line['clusters']  # backwards compatibility -- used to be 'clusters' and there's still a few old files floating around
-            partition = [cluster_str.split(':') for cluster_str in partitionstr.split(';')]
+            if isinstance(partitionstr, list):  # columnar files give us the partition directly
+                partition = partitionstr
+            else:
+                partition = [cluster_str.split(':') for cluster_str in partitionstr.split(';')]
             ccfs = [None, None]
-            if 'ccf_under' in line and 'ccf_over' in line and line['ccf_under'] != '' and line['ccf_over'] != '':
+            if 'ccf_under' in line and 'ccf_over' in line and line['ccf_under'] not in ('', None) and line['ccf_over'] not in ('', None):
                 ccfs = [float(line['ccf_under']), float(line['ccf_over'])]
                 self.we_have_a_ccf = True
-            self.add_partition(partition, float(line['logprob']), int(line.get('n_procs', 1)), logweight=float(line.get('logweight', 0)), ccfs=ccfs)
+            self.add_partition(partition, float(line['logprob']), int(line.get('n_procs', 1)), logweight=float(line.get('logweight') or 0), ccfs=ccfs)
 
     # ----------------------------------------------------------------------------------------
     def calculate_missing_values(self, reco_info, only_ip=None):
-        for ip in range(len(self.partitions)):
-            if only_ip is not None and ip != only_ip:
-                continue
-
-            if self.ccfs[ip][0] is not None and self.ccfs[ip][1] is not None:  # already have them
-                continue
-
-            true_partition = utils.get_true_partition(reco_info, ids=[uid for cluster in self.partitions[ip] for uid in cluster])
-            self.ccfs[ip] = utils.new_ccfs_that_need_better_names(self.partitions[ip], true_partition, reco_info, seed_unique_id=self.seed_unique_id)
+        """ calculate ccfs for any partitions that don't have them, using a true partition made from the reco ids of each partition's uids """
+        ips = [ip for ip in range(len(self.partitions)) if (only_ip is None or ip == only_ip) and (self.ccfs[ip][0] is None or self.ccfs[ip][1] is None)]
+        packed_partitions = (self.partitions.get_packed_partition(ip) for ip in ips)
+        for ip, ccfs in zip(ips, partitionmetrics.path_ccfs(packed_partitions, reco_info, seed_unique_id=self.seed_unique_id)):
+            self.ccfs[ip] = ccfs
             self.we_have_a_ccf = True
 
     # ----------------------------------------------------------------------------------------
@@ -130,7 +334,8 @@ class ClusterPath(object):
             delta_str = '%.1f' % (self.logprobs[ip] - self.logprobs[ip-1])
         else:
             delta_str = ''
-        print '      %s  %-12.2f%-7s   %-5d  %4d' % (extrastr, self.logprobs[ip], delta_str, len(self.partitions[ip]), self.n_procs[ip]),
+        partition = self.partitions[ip]
+        print '      %s  %-12.2f%-7s   %-5d  %4d' % (extrastr, self.logprobs[ip], delta_str, len(partition), self.n_procs[ip]),
 
         # logweight (and inverse of number of potential parents)
         if self.logweights[ip] is not None and smc_print:
@@ -146,7 +351,7 @@ class ClusterPath(object):
             print '   %10s    %8s   ' % (way_str, logweight_str),
 
         # clusters
-        for cluster in self.partitions[ip]:
+        for cluster in partition:
             if abbreviate:
                 cluster_str = ':'.join(['o' if len(uid) > 3 else uid for uid in cluster])
             else:
@@ -213,12 +418,13 @@ class ClusterPath(object):
         """ Return the parent clusters that were merged to form the <ipart>th partition. """
         if ipart == 0:
             raise Exception('get_parent_clusters got ipart of zero... that don\'t make no sense yo')
-        if len(self.partitions[ipart - 1]) <= len(self.partitions[ipart]):
+        previous_partition, partition = self.partitions[ipart - 1], self.partitions[ipart]
+        if len(previous_partition) <= len(partition):
             return None  # this step isn't a merging step -- it's a synthetic rewinding step due to multiple processes
 
         parents = []
-        for cluster in self.partitions[ipart - 1]:  # find all clusters in the previous partition that aren't in the current one
-            if cluster not in self.partitions[ipart]:
+        for cluster in previous_partition:  # find all clusters in the previous partition that aren't in the current one
+            if cluster not in partition:
                 parents.append(cluster)
         assert len(parents) == 2  # there should've been two -- those're the two that were merged to form the new cluster
         return parents
@@ -235,16 +441,19 @@ class ClusterPath(object):
                 combifactor = 1
             return combifactor
 
-        for ip in range(len(self.partitions)):
+        for ip, partition in enumerate(self.partitions):
             if ip == 0:
                 last_logweight = 0.
             else:
                 last_logweight = self.logweights[ip-1]
-            this_logweight = last_logweight + math.log(1. / potential_n_parents(self.partitions[ip]))
+            this_logweight = last_logweight + math.log(1. / potential_n_parents(partition))
             self.logweights[ip] = this_logweight
 
     # ----------------------------------------------------------------------------------------
     def init_outfile(self, outfname, is_data, smc_particles=1):
+        if columnar.is_columnar_fname(outfname):  # the writer is also the file (i.e. it has a close() method)
+            writer = columnar.ColumnarWriter(outfname, self.get_headers(is_data, smc_particles), table='partitions', column_types=self.column_types)
+            return writer, writer
         outfile = open(outfname, 'w')
         writer = csv.DictWriter(outfile, self.get_headers(is_data, smc_particles))
         writer.writeheader()
@@ -292,11 +501,14 @@ class ClusterPath(object):
         headers = self.get_headers(is_data, smc_particles)
         for ipart in self.get_surrounding_partitions(n_partitions=n_to_write):
             part = self.partitions[ipart]
-            cluster_str = ''
-            for ic in range(len(part)):
-                if ic > 0:
-                    cluster_str += ';'
-                cluster_str += ':'.join(part[ic])
+            if isinstance(writer, columnar.ColumnarWriter):
+                cluster_str = part
+            else:
+                cluster_str = ''
+                for ic in range(len(part)):
+                    if ic > 0:
+                        cluster_str += ';'
+                    cluster_str += ':'.join(part[ic])
 
             row = {'logprob' : self.logprobs[ipart],
                    'n_clusters' : len(part),
@@ -310,7 +522,7 @@ class ClusterPath(object):
             if 'n_true_clusters' in headers:
                 row['n_true_clusters'] = len(true_partition)
             if 'bad_clusters' in headers:
-                row['bad_clusters'] = ';'.join(get_bad_clusters(part))
+                row['bad_clusters'] = get_bad_clusters(part) if isinstance(writer, columnar.ColumnarWriter) else ';'.join(get_bad_clusters(part))
             if 'path_index' in headers:
                 row['path_index'] = path_index
                 row['logweight'] = self.logweights[ipart]
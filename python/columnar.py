@@ -0,0 +1,252 @@
+""" optional binary columnar (hdf5) output for annotations, cluster paths, and parameter counts """
+import os
+import ast
+import numpy
+from collections import OrderedDict
+
+import utils
+
+# column types:
+#   int, float, bool, str: one value per row
+#   literal: python literal (e.g. indelfos), stored as its repr()
+#   list:<base>: list of <base> values per row (e.g. unique_ids, mut_freqs)
+#   list-of-lists:<base>: list of lists per row (e.g. a partition)
+#   pairs: list of (string, float) pairs per row (e.g. per-gene support)
+# Each column is an hdf5 group within the file's table group, with flat datasets for the values (plus a 'lengths' dataset for each level of nesting), and a 'missing' mask.
+# Each dataset is chunked and (by default) compressed separately, so readers only decompress the columns they ask for.
+extra_column_types = {'padlefts' : 'list:int', 'padrights' : 'list:int'}  # not in utils.column_configs, since they're written to csv as python lists
+fill_values = {'int' : -1, 'float' : float('nan'), 'bool' : False, 'str' : ''}
+
+# ----------------------------------------------------------------------------------------
+def is_columnar_fname(fname):
+    """ do we write/read <fname> as a columnar (hdf5) file (rather than csv)? """
+    return os.path.splitext(fname)[1] in ('.h5', '.hdf5')
+
+# ----------------------------------------------------------------------------------------
+def import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise Exception('columnar (.h5/.hdf5) output requires h5py (e.g. pip install h5py), or you can use a .csv output file')
+    return h5py
+
+# ----------------------------------------------------------------------------------------
+def get_column_type(column):
+    """ type for <column> from utils.column_configs (which is what we use to convert the same columns to and from csv) """
+    ccfg = utils.column_configs
+    if column in extra_column_types:
+        return extra_column_types[column]
+    if column in ccfg['lists-of-string-float-pairs']:
+        return 'pairs'
+    if column in ccfg['literals']:
+        return 'literal'
+    base = 'str'
+    for tname, ctype in (('ints', 'int'), ('floats', 'float'), ('bools', 'bool')):
+        if column in ccfg[tname]:
+            base = ctype
+    if column in ccfg['lists']:
+        return 'list:' + base
+    return base
+
+# ----------------------------------------------------------------------------------------
+def get_dtype(base):
+    if base == 'int':
+        return numpy.int64
+    elif base == 'float':
+        return numpy.float64
+    elif base == 'bool':
+        return numpy.bool_
+    elif base == 'str':
+        return import_h5py().special_dtype(vlen=str)
+    else:
+        raise Exception('unexpected column base type %s' % base)
+
+# ----------------------------------------------------------------------------------------
+def infer_type(values):
+    """ column type for a list of (non-nested) python values, for tables we write all at once (so we don't need to know the types in advance) """
+    pytypes = set([type(v) for v in values if v is not None])
+    if len(pytypes) == 0 or pytypes - set([bool, int, long, float]):
+        return 'str'
+    if pytypes == set([bool, ]):
+        return 'bool'
+    if pytypes <= set([int, long]):
+        return 'int'
+    return 'float'
+
+# ----------------------------------------------------------------------------------------
+def flatten_column(values, ctype):
+    """ convert the <values> for one column to a dict of flat numpy arrays, one for each dataset in the column's group """
+    arrays = {'missing' : numpy.array([v is None for v in values], dtype=numpy.bool_)}
+    if ctype in fill_values:
+        arrays['data'] = numpy.array([fill_values[ctype] if v is None else v for v in values], dtype=get_dtype(ctype) if ctype != 'str' else object)
+    elif ctype == 'literal':
+        arrays['data'] = numpy.array(['' if v is None else repr(v) for v in values], dtype=object)
+    elif ctype == 'pairs':
+        values = [[] if v is None else (v.items() if hasattr(v, 'items') else v) for v in values]
+        arrays['keys'] = numpy.array([k for pairs in values for k, _ in pairs], dtype=object)
+        arrays['values'] = numpy.array([p for pairs in values for _, p in pairs], dtype=numpy.float64)
+        arrays['lengths'] = numpy.array([len(pairs) for pairs in values], dtype=numpy.int64)
+    elif ctype.split(':')[0] == 'list':
+        base = ctype.split(':')[1]
+        values = [[] if v is None else v for v in values]
+        arrays['values'] = numpy.array([x for vlist in values for x in vlist], dtype=get_dtype(base) if base != 'str' else object)
+        arrays['lengths'] = numpy.array([len(vlist) for vlist in values], dtype=numpy.int64)
+    elif ctype.split(':')[0] == 'list-of-lists':
+        base = ctype.split(':')[1]
+        values = [[] if v is None else v for v in values]
+        arrays['values'] = numpy.array([x for vlists in values for vlist in vlists for x in vlist], dtype=get_dtype(base) if base != 'str' else object)
+        arrays['inner_lengths'] = numpy.array([len(vlist) for vlists in values for vlist in vlists], dtype=numpy.int64)
+        arrays['lengths'] = numpy.array([len(vlists) for vlists in values], dtype=numpy.int64)
+    else:
+        raise Exception('unexpected column type %s' % ctype)
+    return arrays
+
+# ----------------------------------------------------------------------------------------
+def split_by_lengths(values, lengths):
+    sublists = []
+    istart = 0
+    for length in lengths:
+        sublists.append(values[istart : istart + length])
+        istart += length
+    return sublists
+
+# ----------------------------------------------------------------------------------------
+def unflatten_column(h5group):
+    """ inverse of flatten_column(): read the datasets in <h5group> and return a list of python values (None for missing values) """
+    ctype = h5group.attrs['type']
+    missing = h5group['missing'][:].tolist()
+    if ctype in fill_values or ctype == 'literal':
+        values = h5group['data'][:].tolist()
+        if ctype == 'literal':
+            values = [ast.literal_eval(v) if v != '' else None for v in values]
+    elif ctype == 'pairs':
+        lengths = h5group['lengths'][:].tolist()
+        keys = split_by_lengths(h5group['keys'][:].tolist(), lengths)
+        probs = split_by_lengths(h5group['values'][:].tolist(), lengths)
+        values = [OrderedDict(zip(k, p)) for k, p in zip(keys, probs)]
+    elif ctype.split(':')[0] == 'list':
+        values = split_by_lengths(h5group['values'][:].tolist(), h5group['lengths'][:].tolist())
+    elif ctype.split(':')[0] == 'list-of-lists':
+        inner = split_by_lengths(h5group['values'][:].tolist(), h5group['inner_lengths'][:].tolist())
+        values = split_by_lengths(inner, h5group['lengths'][:].tolist())
+    else:
+        raise Exception('unexpected column type %s' % ctype)
+    return [None if miss else val for val, miss in zip(values, missing)]
+
+# ----------------------------------------------------------------------------------------
+class ColumnarWriter(object):
+    """
+    Write rows of (typed, i.e. not converted to strings) python values to table <table> in hdf5 file <fname>, <chunk_size> rows at a time (so we never have the whole table in memory).
+    Has the same writeheader()/writerow() interface as csv.DictWriter, so it can be dropped in where we'd otherwise write csv.
+    Column types come from <column_types> if they're there, and otherwise from utils.column_configs. <compression> is either a single hdf5 filter for all columns, or a dict keyed by column (missing columns are uncompressed).
+    With <mode> 'a', other tables already in <fname> are left alone (but an existing <table> is replaced).
+    """
+    def __init__(self, fname, headers, table='annotations', column_types=None, compression='gzip', chunk_size=1000, mode='w'):
+        h5py = import_h5py()
+        self.headers = list(headers)
+        self.column_types = OrderedDict([(h, column_types[h] if column_types is not None and h in column_types else get_column_type(h)) for h in self.headers])
+        self.compression = compression if hasattr(compression, 'get') else {h : compression for h in self.headers}
+        self.chunk_size = chunk_size
+        self.buffer = {h : [] for h in self.headers}
+        self.n_rows = 0
+        self.h5file = h5py.File(fname, mode)  # use mode 'a' to add a table to an existing file
+        if table in self.h5file:
+            del self.h5file[table]
+        self.group = self.h5file.create_group(table)
+        self.group.attrs['headers'] = ','.join(self.headers)
+        for column, ctype in self.column_types.items():
+            colgroup = self.group.create_group(column)
+            colgroup.attrs['type'] = ctype
+            for dsname, arr in flatten_column([], ctype).items():  # create the (empty) datasets now, so empty tables are still readable
+                colgroup.create_dataset(dsname, shape=(0, ), maxshape=(None, ), dtype=arr.dtype if arr.dtype != object else get_dtype('str'), chunks=(max(1, self.chunk_size), ), compression=self.compression.get(column))
+
+    # ----------------------------------------------------------------------------------------
+    def writeheader(self):
+        pass  # headers are written when we open the file
+
+    # ----------------------------------------------------------------------------------------
+    def writerow(self, row):
+        for key in row:
+            if key not in self.column_types:
+                raise Exception('unexpected column %s not among %s' % (key, self.headers))
+        for column in self.headers:
+            self.buffer[column].append(row.get(column))
+        if len(self.buffer[self.headers[0]]) >= self.chunk_size:
+            self.flush()
+
+    # ----------------------------------------------------------------------------------------
+    def flush(self):
+        n_new_rows = len(self.buffer[self.headers[0]]) if len(self.headers) > 0 else 0
+        if n_new_rows == 0:
+            return
+        for column, ctype in self.column_types.items():
+            colgroup = self.group[column]
+            for dsname, arr in flatten_column(self.buffer[column], ctype).items():
+                dset = colgroup[dsname]
+                n_before = dset.shape[0]
+                dset.resize((n_before + len(arr), ))
+                if len(arr) > 0:
+                    dset[n_before :] = arr
+            self.buffer[column] = []
+        self.n_rows += n_new_rows
+        self.group.attrs['n_rows'] = self.n_rows
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        if self.h5file is None:
+            return
+        self.flush()
+        self.group.attrs['n_rows'] = self.n_rows
+        self.h5file.close()
+        self.h5file = None
+
+# ----------------------------------------------------------------------------------------
+def write_table(fname, table, columns, column_types=None, compression='gzip', mode='w'):
+    """ write all of <columns> (OrderedDict of lists of values, keyed by header) at once, inferring any column types not in <column_types> from the values """
+    column_types = dict(column_types) if column_types is not None else {}
+    for column, values in columns.items():
+        if column not in column_types:
+            column_types[column] = infer_type(values)
+    n_rows = set([len(values) for values in columns.values()])
+    if len(n_rows) > 1:
+        raise Exception('columns of different lengths %s in table %s' % (sorted(n_rows), table))
+    writer = ColumnarWriter(fname, columns.keys(), table=table, column_types=column_types, compression=compression, chunk_size=max(1, max(n_rows) if len(n_rows) > 0 else 1), mode=mode)
+    for irow in range(max(n_rows) if len(n_rows) > 0 else 0):
+        writer.writerow({column : values[irow] for column, values in columns.items()})
+    writer.close()
+
+# ----------------------------------------------------------------------------------------
+def get_tables(fname):
+    h5py = import_h5py()
+    with h5py.File(fname, 'r') as h5file:
+        return list(h5file.keys())
+
+# ----------------------------------------------------------------------------------------
+def get_headers(fname, table='annotations'):
+    h5py = import_h5py()
+    with h5py.File(fname, 'r') as h5file:
+        if table not in h5file:
+            raise Exception('table %s not in %s (choices: %s)' % (table, fname, ' '.join(h5file.keys())))
+        headerstr = str(h5file[table].attrs['headers'])
+        return headerstr.split(',') if headerstr != '' else []
+
+# ----------------------------------------------------------------------------------------
+def read_columns(fname, columns=None, table='annotations'):
+    """ read <columns> (default: all of them) from <table> in <fname>, returning an OrderedDict of lists of python values keyed by column (only the requested columns are read from disk) """
+    h5py = import_h5py()
+    headers = get_headers(fname, table=table)
+    if columns is None:
+        columns = headers
+    for column in columns:
+        if column not in headers:
+            raise Exception('column %s not in table %s in %s (choices: %s)' % (column, table, fname, ' '.join(headers)))
+    with h5py.File(fname, 'r') as h5file:
+        return OrderedDict([(column, unflatten_column(h5file[table][column])) for column in columns])
+
+# ----------------------------------------------------------------------------------------
+def read_rows(fname, columns=None, table='annotations'):
+    """ same as read_columns(), but return a list of dicts (one for each row, like csv.DictReader) """
+    coldata = read_columns(fname, columns=columns, table=table)
+    if len(coldata) == 0:
+        return []
+    return [dict(zip(coldata.keys(), rowvals)) for rowvals in zip(*coldata.values())]
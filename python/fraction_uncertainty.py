@@ -1,6 +1,28 @@
-import cached_uncertainties
+import os
+import math
+import numpy
 from scipy.stats import beta
 
+# precalculated (lo, hi) for each <obs> and <total> (nan where we didn't cache it), memory-mapped when we first need it
+cache_fname = os.path.dirname(os.path.realpath(__file__)) + '/cached-uncertainties.npy'
+cached_errs = None
+uncached_errs = {}  # ones we've had to calculate, keyed by (obs, total, use_beta, for_paper)
+
+# ----------------------------------------------------------------------------------------
+def get_cached_err(obs, total):
+    """ return (lo, hi) from the table of precalculated uncertainties, or None if it isn't there """
+    global cached_errs
+    if cached_errs is None:
+        cached_errs = numpy.load(cache_fname, mmap_mode='r')
+    if not isinstance(obs, (int, long, numpy.integer)) or not isinstance(total, (int, long, numpy.integer)):  # the table only has integer counts
+        return None
+    if obs < 0 or obs >= cached_errs.shape[0] or total >= cached_errs.shape[1]:
+        return None
+    lo, hi = cached_errs[obs, total]
+    if math.isnan(lo):
+        return None
+    return float(lo), float(hi)
+
 # ----------------------------------------------------------------------------------------
 def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
     """ Return uncertainty on the ratio n / total """
@@ -8,10 +30,18 @@ def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
     if total == 0.0:
         return (0.0, 0.0, False)
 
-    key = str(obs) + '/' + str(total)
-    if use_cache and key in cached_uncertainties.errs:
-        return cached_uncertainties.errs[key] + (True, )
+    if use_cache:
+        cached = get_cached_err(obs, total)
+        if cached is not None:
+            return cached + (True, )
 
+    key = (obs, total, use_beta, for_paper)
+    if key not in uncached_errs:
+        uncached_errs[key] = calculate_err(obs, total, use_beta=use_beta, for_paper=for_paper)
+    return uncached_errs[key] + (False, )
+
+# ----------------------------------------------------------------------------------------
+def calculate_err(obs, total, use_beta=True, for_paper=False):
     frac = float(obs) / total
     if use_beta or frac == 0.0 or frac == 1.0:  # still need to use beta for 0 and 1 'cause the sqrt thing below gives garbage for those cases
         if for_paper:  # total volume of confidence interval
@@ -35,4 +65,61 @@ def err(obs, total, use_beta=True, use_cache=True, for_paper=False):
 
     assert lo < frac or frac == 0.0
     assert frac < hi or frac == 1.0
-    return (lo, hi) + (False, )
+    return (lo, hi)
+
+# ----------------------------------------------------------------------------------------
+def errs(obs, total, use_beta=True, use_cache=True, for_paper=False):
+    """ same as err(), but for arrays (or lists) of <obs> and <total>, calculating all the uncached ones with one (vectorized) beta.ppf call. Returns arrays (lo, hi, cached) """
+    integer_counts = numpy.asarray(obs).dtype.kind in 'iu' and numpy.asarray(total).dtype.kind in 'iu'  # the cache only has integer counts
+    obs, total = numpy.asarray(obs, dtype=numpy.float64), numpy.asarray(total, dtype=numpy.float64)
+    assert (obs <= total).all()
+    lo, hi = numpy.zeros(len(obs)), numpy.zeros(len(obs))
+    cached = numpy.zeros(len(obs), dtype=numpy.bool_)
+    todo = total != 0.
+
+    if use_cache and integer_counts:
+        global cached_errs
+        if cached_errs is None:
+            cached_errs = numpy.load(cache_fname, mmap_mode='r')
+        in_table = todo & (obs >= 0) & (obs < cached_errs.shape[0]) & (total < cached_errs.shape[1])
+        iobs, itotal = obs[in_table].astype(numpy.int64), total[in_table].astype(numpy.int64)
+        table_vals = cached_errs[iobs, itotal]
+        found = numpy.logical_not(numpy.isnan(table_vals[:, 0]))
+        ifound = numpy.flatnonzero(in_table)[found]
+        lo[ifound], hi[ifound] = table_vals[found, 0], table_vals[found, 1]
+        cached[ifound] = True
+        todo &= numpy.logical_not(cached)
+
+    obs, total = obs[todo], total[todo]
+    frac = obs / numpy.where(total > 0, total, 1.)
+    if use_beta:
+        beta_mask = numpy.ones(len(obs), dtype=numpy.bool_)
+    else:
+        beta_mask = (frac == 0.) | (frac == 1.)  # still need to use beta for 0 and 1 'cause the sqrt thing below gives garbage for those cases
+    if for_paper:
+        vol, cpr = 0.95, 0.5
+    else:
+        vol, cpr = 2./3, 1.
+    a, b = cpr + obs, cpr + total - obs
+    tlo, thi = numpy.zeros(len(obs)), numpy.zeros(len(obs))
+    if beta_mask.any():
+        ib = numpy.flatnonzero(beta_mask)
+        blo, bhi = beta.ppf((1. - vol)/2, a[ib], b[ib]), beta.ppf((1. + vol)/2, a[ib], b[ib])
+        low_frac = frac[ib] < blo  # if k/n very small (probably zero), take a one-sided c.i. with 2/3 (0.95) the mass
+        if low_frac.any():
+            blo[low_frac] = 0.
+            bhi[low_frac] = beta.ppf(vol, a[ib][low_frac], b[ib][low_frac])
+        high_frac = frac[ib] > bhi  # same deal if k/n very large (probably one)
+        if high_frac.any():
+            blo[high_frac] = beta.ppf(1. - vol, a[ib][high_frac], b[ib][high_frac])
+            bhi[high_frac] = 1.
+        tlo[ib], thi[ib] = blo, bhi
+    isq = numpy.flatnonzero(numpy.logical_not(beta_mask))
+    if len(isq) > 0:  # square root shenaniganery
+        sqerr = (1. / (total[isq] * total[isq])) * (numpy.sqrt(obs[isq]) * total[isq] - obs[isq] * numpy.sqrt(total[isq]))
+        tlo[isq], thi[isq] = frac[isq] - sqerr, frac[isq] + sqerr
+
+    assert ((tlo < frac) | (frac == 0.)).all()
+    assert ((frac < thi) | (frac == 1.)).all()
+    lo[todo], hi[todo] = tlo, thi
+    return lo, hi, cached
@@ -1,11 +1,13 @@
-import itertools
 import os
 import sys
 import math
 import csv
 import time
+import heapq
+import numpy
 
 import utils
+import hamming
 from opener import opener
 from clusterpath import ClusterPath
 
@@ -16,61 +18,97 @@ class Glomerator(object):
         self.reco_info = reco_info
         self.paths = None
         self.seed_unique_id = seed_unique_id
+        self.n_max_exact_glomerate = 2000  # in naive_seq_glomerate(), above this many sequences we use approximate nearest neighbors
+        self.n_glomerate_neighbors = 20
 
     # ----------------------------------------------------------------------------------------
     def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
         """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
+        names = naive_seqs.keys()
+        n_seqs = len(names)
 
-        seqs_per_cluster = float(len(clusters)) / n_clusters
+        seqs_per_cluster = float(n_seqs) / n_clusters
         max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
-
-        # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
+        # find the unique naive sequences, since otherwise big families fill up each other's neighbor lists, and we never see the edges between families
+        unique_seqs, seq_names = [], {}
+        for name in names:
+            if naive_seqs[name] not in seq_names:
+                seq_names[naive_seqs[name]] = []
+                unique_seqs.append(naive_seqs[name])
+            seq_names[naive_seqs[name]].append(name)
+        n_unique = len(unique_seqs)
+        names = [name for seq in unique_seqs for name in seq_names[seq]]  # reorder so each sequence's names are together
+        group_lens = numpy.array([len(seq_names[seq]) for seq in unique_seqs], dtype=int)  # number of names for each unique sequence
+        ilasts = numpy.cumsum(group_lens) - 1  # index in <names> of the last name for each unique sequence
+
+        # single-linkage agglomeration is equivalent to going through the sequence pairs in order of increasing distance, merging the clusters on either side of each pair (i.e. kruskal's algorithm).
+        # But we only need the short edges, so we only look at each unique sequence's nearest neighbors (or, for large samples, at approximate nearest neighbors, to avoid calculating all pairwise distances)
+        if n_unique <= self.n_max_exact_glomerate:
+            ipairs, jpairs, fracs = hamming.nearest_neighbors(unique_seqs, self.n_glomerate_neighbors)
+        else:
+            ipairs, jpairs, fracs = hamming.banded_neighbors(unique_seqs)
+
+        # Each name is still its own node, though, with zero-distance edges joining the names with the same sequence, so identical sequences get split up when they hit the size cap.
+        # We join them in a binary tree (pairs of names, then pairs of pairs, etc.), so they end up in clusters of similar size. These edges come first, so they also go first among any other zero-distance edges.
+        positions = numpy.arange(n_seqs) - numpy.repeat(ilasts + 1 - group_lens, group_lens)  # position of each name among its sequence's names
+        group_sizes = numpy.repeat(group_lens, group_lens)
+        ichains, jchains, stride = [numpy.zeros(0, dtype=int)], [numpy.zeros(0, dtype=int)], 1
+        while stride < max(group_lens.tolist() + [1]):
+            ichain = numpy.flatnonzero((positions % (2 * stride) == 0) & (positions + stride < group_sizes))
+            ichains.append(ichain)
+            jchains.append(ichain + stride)
+            stride *= 2
+        ichain, jchain = numpy.concatenate(ichains), numpy.concatenate(jchains)
+        ipairs, jpairs = numpy.concatenate([ichain, ilasts[ipairs]]), numpy.concatenate([jchain, ilasts[jpairs]])  # join neighboring sequences at their last names, which are the most likely to be in clusters with room
+        fracs = numpy.concatenate([numpy.zeros(len(ichain)), fracs])
+
+        parents = range(n_seqs)  # union-find forest, with each root's members in <members>
+        members = {i : [names[i], ] for i in range(n_seqs)}
+
+        def find_root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        def merge_pairs(ipairs, jpairs, pairlist, merge_whatever_you_got):
+            skipped = []  # pairs that we skipped because their merged cluster would've been too big
+            for ipair in pairlist:
+                if len(members) <= n_clusters:
+                    break
+                root_a, root_b = find_root(ipairs[ipair]), find_root(jpairs[ipair])
+                if root_a == root_b:
                     continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+                if len(members[root_a]) + len(members[root_b]) > max_per_cluster and not merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
+                    skipped.append(ipair)
+                    continue
+                if len(members[root_a]) < len(members[root_b]):
+                    root_a, root_b = root_b, root_a
+                parents[root_b] = root_a
+                members[root_a] += members.pop(root_b)
+            return skipped
+
+        def glomerate(ipairs, jpairs, fracs):
+            pair_order = numpy.argsort(fracs, kind='mergesort')
+            ipairs, jpairs = ipairs.tolist(), jpairs.tolist()  # python ints are a lot faster to index with
+            skipped = merge_pairs(ipairs, jpairs, pair_order, merge_whatever_you_got=False)
+            if len(members) > n_clusters:  # if we didn't find enough suitable pairs, merge the best ones regardless of size
+                if debug:
+                    print '    didn\'t find shiznitz (skipped %d)' % len(skipped)
+                merge_pairs(ipairs, jpairs, skipped, merge_whatever_you_got=True)
 
-        # ----------------------------------------------------------------------------------------
-        def glomerate():
+        glomerate(ipairs, jpairs, fracs)
+        if len(members) > n_clusters:  # the neighbor graph was disconnected, so add the shortest edges between its components, and keep going
             if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
-                if debug:
-                    print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                print '    connecting %d components' % len(members)
+            icomponents, jcomponents, component_fracs = self.get_component_edges(unique_seqs, [find_root(i) for i in ilasts])  # (all the names for each sequence are in the same component by now)
+            glomerate(ilasts[icomponents], ilasts[jcomponents], component_fracs)
+
+        clusters = [members[root] for root in sorted(members)]
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -90,12 +128,6 @@ class Glomerator(object):
                 print '    sorted ', ' '.join([str(len(cl)) for cl in clusters])
 
         # ----------------------------------------------------------------------------------------
-        # da bizniz
-        glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
-
-        while len(clusters) > n_clusters:
-            glomerate()
-        
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -112,6 +144,36 @@ class Glomerator(object):
         print '    divvy time: %.3f' % (time.time()-start)
         return clusters
 
+    # ----------------------------------------------------------------------------------------
+    def get_component_edges(self, seqs, roots):
+        """
+        Return arrays (i, j, fraction) of the edges in the minimum spanning tree between the components (labeled by <roots>) of <seqs>, i.e. the edges that single linkage would use to merge them.
+        For small samples we look at every sequence (boruvka's algorithm), while for large ones we only look at one sequence from each component.
+        """
+        roots = numpy.array(roots)
+        if len(seqs) > self.n_max_exact_glomerate:
+            _, iseqs = numpy.unique(roots, return_index=True)
+            seqs, roots = [seqs[i] for i in iseqs], roots[iseqs]
+        else:
+            iseqs = numpy.arange(len(seqs))
+        labels = numpy.unique(roots, return_inverse=True)[1]
+        ilist, jlist, fraclist = [], [], []
+        while len(numpy.unique(labels)) > 1:
+            nearest, nearest_fracs = hamming.nearest_in_other_group(seqs, labels)
+            best = {}  # shortest edge out of each component
+            for iseq in numpy.argsort(nearest_fracs, kind='mergesort'):
+                if nearest[iseq] >= 0 and labels[iseq] not in best:
+                    best[labels[iseq]] = iseq
+            for label, iseq in sorted(best.items()):
+                label_a, label_b = labels[iseq], labels[nearest[iseq]]
+                if label_a == label_b:  # already joined by another component's edge this round
+                    continue
+                ilist.append(iseqs[iseq])
+                jlist.append(iseqs[nearest[iseq]])
+                fraclist.append(nearest_fracs[iseq])
+                labels[labels == label_b] = label_a
+        return numpy.array(ilist, dtype=int), numpy.array(jlist, dtype=int), numpy.array(fraclist)
+
     # ----------------------------------------------------------------------------------------
     def print_true_partition(self):
         print '  true partition'
@@ -147,8 +209,8 @@ class Glomerator(object):
         for cp in paths:
             if cp is None:
                 raise Exception('None type path read from %s' % infname)
-            for ptn in cp.partitions:
-                if len(ptn) == 0:
+            for ip in range(len(cp.partitions)):
+                if cp.partitions.get_n_clusters(ip) == 0:
                     raise Exception('zero length partition read from %s' % infname)
 
         return paths
@@ -197,39 +259,50 @@ class Glomerator(object):
                     fileinfos[ifile][ipath].print_partitions(self.reco_info, extrastr=('%d' % (ifile)))
                     print ''
 
-            # merge all the steps in each path
-            def last_one():
-                last = True
-                for ifile in range(len(fileinfos)):  # we're finished when all the files are out of glomeration steps (i.e. they all only have one [the last] line left)
-                    last &= len(fileinfos[ifile][ipath].partitions) == 1
-                return last
+            # merge all the steps in each path: each global step advances the file whose next step has the largest logprob increase (ties go to the lowest file index)
+            paths = [fileinfos[ifile][ipath] for ifile in range(len(fileinfos))]
+            merged_path = self.paths[ipath]
+            ips = [0 for _ in paths]  # current partition in each file
+            entry_maps = [{} for _ in paths]  # for each file, the entry in <merged_path> for each of the file's entries
 
-            def remove_one_of_the_first_partitions():
-                maxdelta, ibestfile = None, None
-                for ifile in range(len(fileinfos)):
-                    if len(fileinfos[ifile][ipath].partitions) == 1:  # if this is the last line (i.e. there aren't any more glomeration steps in this file), leave it alone
-                        continue
-                    thisdelta = fileinfos[ifile][ipath].logprobs[1] - fileinfos[ifile][ipath].logprobs[0]  # logprob difference between the next partition and this one
-                    if maxdelta is None or thisdelta > maxdelta:
-                        maxdelta = thisdelta
-                        ibestfile = ifile
-                # print '    ibest %d with %f - %f = %f' % (ibestfile, fileinfos[ibestfile][ipath].logprobs[1], fileinfos[ibestfile][ipath].logprobs[0], fileinfos[ibestfile][ipath].logprobs[1] - fileinfos[ibestfile][ipath].logprobs[0])
-                fileinfos[ibestfile][ipath].remove_first_partition()
-
-            def add_next_global_partition():
-                global_partition = []
-                global_logprob = 0.
-                for ifile in range(len(fileinfos)):  # combine the first line in each file to make a global partition
-                    for cluster in fileinfos[ifile][ipath].partitions[0]:
-                        global_partition.append(list(cluster))
-                    global_logprob += fileinfos[ifile][ipath].logprobs[0]
-                self.paths[ipath].add_partition(global_partition, global_logprob, n_procs=len(fileinfos), logweight=0.)  # don't know the logweight yet (or maybe at all!)
-
-            while not last_one():
-                add_next_global_partition()
-                remove_one_of_the_first_partitions()
-            add_next_global_partition()
+            def get_merged_entry(ifile, entry):
+                if entry not in entry_maps[ifile]:
+                    entry_maps[ifile][entry] = merged_path.partitions.add_entry(paths[ifile].partitions.get_packed_cluster(entry))
+                return entry_maps[ifile][entry]
 
+            def add_next_global_partition(step):  # the global partition is the current partition in each file, one after another
+                global_logprob = 0.
+                for ifile in range(len(paths)):
+                    global_logprob += paths[ifile].logprobs[ips[ifile]]
+                merged_path.add_partition_step(step, global_logprob, n_procs=len(paths), logweight=0.)  # don't know the logweight yet (or maybe at all!)
+
+            heap = []  # (minus logprob increase of next step, file index) for each file with steps left
+            def push_next_step(ifile):
+                if ips[ifile] < len(paths[ifile].partitions) - 1:  # if this is the last line (i.e. there aren't any more glomeration steps in this file), leave it alone
+                    heapq.heappush(heap, (-(paths[ifile].logprobs[ips[ifile] + 1] - paths[ifile].logprobs[ips[ifile]]), ifile))
+
+            tails = []  # <merged_path> entry for the last cluster in each file's current partition
+            first_step = []
+            for ifile in range(len(paths)):
+                entries = [get_merged_entry(ifile, entry) for entry in paths[ifile].partitions.get_entries(0)]
+                first_step += entries
+                tails.append(entries[-1])
+                push_next_step(ifile)
+            add_next_global_partition(first_step)
+
+            while len(heap) > 0:
+                _, ifile = heapq.heappop(heap)
+                ips[ifile] += 1
+                delta = paths[ifile].partitions.get_delta_to(ips[ifile])
+                entries = paths[ifile].partitions.get_entries(ips[ifile])
+                if delta is None:  # the file's clusters got reordered, so remove them all and add them back in the new order
+                    delta = (paths[ifile].partitions.get_entries(ips[ifile] - 1), [(entries[i], entries[i - 1] if i > 0 else None) for i in range(len(entries))])
+                removed, added = delta  # translate the file's delta to the global partition (anything that came first in the file comes after the previous file's last cluster)
+                head = tails[ifile - 1] if ifile > 0 else None
+                step = (tuple(get_merged_entry(ifile, entry) for entry in removed), [(get_merged_entry(ifile, entry), head if after is None else get_merged_entry(ifile, after)) for entry, after in added])
+                tails[ifile] = get_merged_entry(ifile, entries[-1])
+                add_next_global_partition(step)
+                push_next_step(ifile)
 
             if smc_particles > 1:
                 self.paths[ipath].set_synthetic_logweight_history(self.reco_info)
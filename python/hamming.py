@@ -0,0 +1,230 @@
+""" numpy-backed (ambiguity-aware) hamming distances: one pair, one-vs-many, or all pairs at once """
+import numpy
+
+import utils
+
+encode_cache = {}  # lookup tables for each set of extra bases
+
+# ----------------------------------------------------------------------------------------
+def get_tables(extra_bases=None):
+    """ return (list of valid characters, boolean lookup table for valid characters, boolean lookup table for ambiguous characters) """
+    key = None if extra_bases is None else tuple(extra_bases)
+    if key not in encode_cache:
+        alphabet = utils.nukes + utils.ambiguous_bases
+        if extra_bases is not None:
+            alphabet += list(extra_bases)
+        valid = numpy.zeros(256, dtype=numpy.bool_)
+        ambig = numpy.zeros(256, dtype=numpy.bool_)
+        for ch in alphabet:
+            valid[ord(ch)] = True
+        for ch in utils.ambiguous_bases:
+            ambig[ord(ch)] = True
+        encode_cache[key] = (alphabet, valid, ambig)
+    return encode_cache[key]
+
+# ----------------------------------------------------------------------------------------
+def encode(seq, extra_bases=None, other_seq=None):
+    """ convert <seq> to a uint8 array, checking that all characters are in the expected alphabet (<other_seq> is just for the error message) """
+    if isinstance(seq, numpy.ndarray):  # already encoded
+        return seq
+    arr = numpy.frombuffer(str(seq), dtype=numpy.uint8)
+    alphabet, valid, _ = get_tables(extra_bases)
+    if not valid[arr].all():
+        ch = chr(arr[numpy.logical_not(valid[arr])][0])
+        raise Exception('unexpected character \'%s\' not among %s in hamming_fraction() with input:\n  %s\n  %s' % (ch, alphabet, seq, other_seq if other_seq is not None else ''))
+    return arr
+
+# ----------------------------------------------------------------------------------------
+def encode_many(seqs, extra_bases=None):
+    """ convert list of same-length sequences to a 2d uint8 array (one row per sequence) """
+    if isinstance(seqs, numpy.ndarray):
+        return seqs
+    if len(seqs) == 0:
+        return numpy.zeros((0, 0), dtype=numpy.uint8)
+    if len(set([len(s) for s in seqs])) > 1:
+        raise Exception('sequences must all be the same length (got lengths %s)' % sorted(set([len(s) for s in seqs])))
+    return numpy.vstack([encode(s, extra_bases=extra_bases) for s in seqs])
+
+# ----------------------------------------------------------------------------------------
+def hamming_fraction(seq1, seq2, return_len_excluding_ambig=False, extra_bases=None):
+    """ fraction of positions at which <seq1> and <seq2> differ, skipping positions at which either is ambiguous """
+    assert len(seq1) == len(seq2)
+    if len(seq1) == 0:
+        if return_len_excluding_ambig:
+            return 0., 0
+        else:
+            return 0.
+
+    arr1 = encode(seq1, extra_bases=extra_bases, other_seq=seq2)
+    arr2 = encode(seq2, extra_bases=extra_bases, other_seq=seq1)
+    ambig = get_tables(extra_bases)[2]
+    unambig = numpy.logical_not(ambig[arr1] | ambig[arr2])
+    len_excluding_ambig = int(numpy.count_nonzero(unambig))
+    distance = int(numpy.count_nonzero((arr1 != arr2) & unambig))
+
+    fraction = 0.
+    if len_excluding_ambig > 0:
+        fraction = distance / float(len_excluding_ambig)
+    if return_len_excluding_ambig:
+        return fraction, len_excluding_ambig
+    else:
+        return fraction
+
+# ----------------------------------------------------------------------------------------
+def one_vs_many(seq, seqs, return_len_excluding_ambig=False, extra_bases=None):
+    """ hamming fractions between <seq> and each of <seqs> (all the same length), as a numpy array """
+    arr = encode(seq, extra_bases=extra_bases)
+    arrs = encode_many(seqs, extra_bases=extra_bases)
+    ambig = get_tables(extra_bases)[2]
+    unambig = numpy.logical_not(ambig[arrs] | ambig[arr])
+    lens = numpy.count_nonzero(unambig, axis=1)
+    distances = numpy.count_nonzero((arrs != arr) & unambig, axis=1)
+    fractions = distances / numpy.maximum(lens, 1).astype(float)
+    if return_len_excluding_ambig:
+        return fractions, lens
+    else:
+        return fractions
+
+# ----------------------------------------------------------------------------------------
+def pairwise(seqs, extra_bases=None, max_block_entries=int(1e7)):
+    """
+    Hamming fractions between all pairs in <seqs> (all the same length), as a condensed distance array (i.e. same order as scipy.spatial.distance.pdist: (0, 1), (0, 2), ..., (1, 2), ...).
+    We one-hot encode the unambiguous characters, so the number of matching positions for every pair is a matrix product. This is done for one block of rows against one chunk of columns at a time,
+    encoding each block as we need it, so apart from the input and the output, no array has more than about <max_block_entries> entries.
+    """
+    arrs = encode_many(seqs, extra_bases=extra_bases)
+    n_seqs, seqlen = arrs.shape
+    if n_seqs < 2:
+        return numpy.zeros(0)
+    alphabet, _, ambig = get_tables(extra_bases)
+    unambig_chars = [ord(ch) for ch in alphabet if ch not in utils.ambiguous_bases]
+
+    def encode_onehot(rows):  # float32 is exact for these counts, and twice as fast
+        return numpy.hstack([(rows == char).astype(numpy.float32) for char in unambig_chars]), numpy.logical_not(ambig[rows]).astype(numpy.float32)
+
+    row_block_size = max(1, max_block_entries / max(n_seqs, len(unambig_chars) * seqlen))
+    col_block_size = max(1, max_block_entries / max(row_block_size, len(unambig_chars) * seqlen))
+    condensed = numpy.zeros(n_seqs * (n_seqs - 1) / 2)
+    iout = 0
+    for istart in range(0, n_seqs - 1, row_block_size):
+        istop = min(n_seqs - 1, istart + row_block_size)  # (the last sequence doesn't have any pairs of its own)
+        row_onehot, row_unambig = encode_onehot(arrs[istart : istop])
+        fracs = numpy.zeros((istop - istart, n_seqs - istart - 1))  # column j is sequence istart + 1 + j
+        for jstart in range(istart + 1, n_seqs, col_block_size):
+            jstop = min(n_seqs, jstart + col_block_size)
+            col_onehot, col_unambig = encode_onehot(arrs[jstart : jstop])
+            lens = numpy.dot(row_unambig, col_unambig.T).astype(numpy.float64)
+            fracs[:, jstart - istart - 1 : jstop - istart - 1] = (lens - numpy.dot(row_onehot, col_onehot.T)) / numpy.maximum(lens, 1.)
+        for irow in range(istart, istop):
+            rowfracs = fracs[irow - istart, irow - istart :]
+            condensed[iout : iout + len(rowfracs)] = rowfracs
+            iout += len(rowfracs)
+    return condensed
+
+# ----------------------------------------------------------------------------------------
+def condensed_index(n_seqs, i, j):
+    """ index in the condensed array from pairwise() of the pair (<i>, <j>) """
+    if i > j:
+        i, j = j, i
+    assert i != j
+    return n_seqs * i - i * (i + 1) / 2 + j - i - 1
+
+# ----------------------------------------------------------------------------------------
+def nearest_neighbors(seqs, n_neighbors, extra_bases=None, max_block_entries=int(2e7)):
+    """
+    For each sequence in <seqs> (all the same length), find its <n_neighbors> nearest neighbors.
+    Returns arrays (i, j, fraction) of the resulting pairs, each with i < j and each pair listed once.
+    Like pairwise(), but only keeps O(n * <n_neighbors>) distances, so memory doesn't blow up for large samples.
+    """
+    arrs = encode_many(seqs, extra_bases=extra_bases)
+    n_seqs = arrs.shape[0]
+    n_neighbors = min(n_neighbors, n_seqs - 1)
+    if n_neighbors < 1:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+    alphabet, _, ambig = get_tables(extra_bases)
+    onehot = numpy.hstack([(arrs == ord(ch)).astype(numpy.float32) for ch in alphabet if ch not in utils.ambiguous_bases])  # float32 is exact for these counts, and twice as fast
+    unambig = numpy.logical_not(ambig[arrs]).astype(numpy.float32)
+
+    block_size = max(1, max_block_entries / n_seqs)
+    ilist, jlist, fraclist = [], [], []
+    for istart in range(0, n_seqs, block_size):
+        istop = min(n_seqs, istart + block_size)
+        lens = numpy.dot(unambig[istart : istop], unambig.T)
+        fracs = (lens - numpy.dot(onehot[istart : istop], onehot.T)) / numpy.maximum(lens, 1.)
+        fracs[numpy.arange(istop - istart), numpy.arange(istart, istop)] = numpy.inf  # don't want anybody to be their own neighbor
+        nearest = numpy.argpartition(fracs, n_neighbors - 1, axis=1)[:, : n_neighbors]
+        ilist.append(numpy.repeat(numpy.arange(istart, istop), n_neighbors))
+        jlist.append(nearest.flatten())
+        fraclist.append(fracs[numpy.arange(istop - istart)[:, None], nearest].flatten().astype(numpy.float64))
+
+    iarr, jarr, fracarr = numpy.concatenate(ilist), numpy.concatenate(jlist), numpy.concatenate(fraclist)
+    iarr, jarr = numpy.minimum(iarr, jarr), numpy.maximum(iarr, jarr)
+    _, iunique = numpy.unique(iarr * n_seqs + jarr, return_index=True)  # remove pairs that showed up from both sides
+    return iarr[iunique], jarr[iunique], fracarr[iunique]
+
+# ----------------------------------------------------------------------------------------
+def nearest_in_other_group(seqs, groups, extra_bases=None, max_block_entries=int(2e7)):
+    """
+    For each sequence in <seqs> (all the same length), find the nearest sequence with a different label in <groups> (an integer array).
+    Returns arrays (j, fraction), with j -1 (and fraction inf) for sequences that have no such sequence.
+    """
+    arrs = encode_many(seqs, extra_bases=extra_bases)
+    n_seqs = arrs.shape[0]
+    alphabet, _, ambig = get_tables(extra_bases)
+    onehot = numpy.hstack([(arrs == ord(ch)).astype(numpy.float32) for ch in alphabet if ch not in utils.ambiguous_bases])
+    unambig = numpy.logical_not(ambig[arrs]).astype(numpy.float32)
+
+    jarr, fracarr = numpy.full(n_seqs, -1, dtype=int), numpy.full(n_seqs, numpy.inf)
+    block_size = max(1, max_block_entries / max(1, n_seqs))
+    for istart in range(0, n_seqs, block_size):
+        istop = min(n_seqs, istart + block_size)
+        lens = numpy.dot(unambig[istart : istop], unambig.T)
+        fracs = ((lens - numpy.dot(onehot[istart : istop], onehot.T)) / numpy.maximum(lens, 1.)).astype(numpy.float64)
+        fracs[groups[istart : istop, None] == groups[None, :]] = numpy.inf  # includes each sequence itself
+        nearest = numpy.argmin(fracs, axis=1)
+        nearest_fracs = fracs[numpy.arange(istop - istart), nearest]
+        found = nearest_fracs < numpy.inf
+        jarr[istart : istop][found] = nearest[found]
+        fracarr[istart : istop][found] = nearest_fracs[found]
+    return jarr, fracarr
+
+# ----------------------------------------------------------------------------------------
+def pair_fractions(arrs, iarr, jarr, extra_bases=None, max_block_entries=int(2e7)):
+    """ hamming fractions between rows <iarr> and <jarr> of the encoded array <arrs> """
+    ambig = get_tables(extra_bases)[2]
+    fracs = numpy.zeros(len(iarr))
+    block_size = max(1, max_block_entries / max(1, arrs.shape[1]))
+    for istart in range(0, len(iarr), block_size):
+        rows_a, rows_b = arrs[iarr[istart : istart + block_size]], arrs[jarr[istart : istart + block_size]]
+        unambig = numpy.logical_not(ambig[rows_a] | ambig[rows_b])
+        lens = numpy.count_nonzero(unambig, axis=1)
+        fracs[istart : istart + block_size] = numpy.count_nonzero((rows_a != rows_b) & unambig, axis=1) / numpy.maximum(lens, 1).astype(float)
+    return fracs
+
+# ----------------------------------------------------------------------------------------
+def banded_neighbors(seqs, n_bands=20, extra_bases=None):
+    """
+    Approximate, but linear time, version of nearest_neighbors() for large samples (locality-sensitive hashing by banding).
+    We split the sequences into <n_bands> bands: sequences that are identical over a band are candidate neighbors, and within each group of such sequences we pair up
+    those that are adjacent in sorted order. Returns arrays (i, j, fraction) for the (unique) candidate pairs, with i < j.
+    """
+    arrs = encode_many(seqs, extra_bases=extra_bases)
+    n_seqs, seqlen = arrs.shape
+    if n_seqs < 2:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+    seq_ranks = numpy.argsort(numpy.argsort(arrs.view('S%d' % seqlen).flatten(), kind='mergesort'), kind='mergesort')  # rank of each sequence in sorted order
+    ilist, jlist = [], []
+    band_edges = numpy.linspace(0, seqlen, min(n_bands, seqlen) + 1).astype(int)
+    for bstart, bstop in zip(band_edges[:-1], band_edges[1:]):
+        band = numpy.ascontiguousarray(arrs[:, bstart : bstop]).view('S%d' % (bstop - bstart)).flatten()
+        _, band_ids = numpy.unique(band, return_inverse=True)
+        order = numpy.lexsort((seq_ranks, band_ids))  # group by band contents, and within each group by the whole sequence
+        same_band = band_ids[order[:-1]] == band_ids[order[1:]]
+        ilist.append(order[:-1][same_band])
+        jlist.append(order[1:][same_band])
+
+    iarr, jarr = numpy.concatenate(ilist), numpy.concatenate(jlist)
+    iarr, jarr = numpy.minimum(iarr, jarr), numpy.maximum(iarr, jarr)
+    _, iunique = numpy.unique(iarr * n_seqs + jarr, return_index=True)
+    iarr, jarr = iarr[iunique], jarr[iunique]
+    return iarr, jarr, pair_fractions(arrs, iarr, jarr, extra_bases=extra_bases)
@@ -1,6 +1,7 @@
 import csv
 import math
 import os
+import bisect
 from opener import opener
 from utils import is_normed
 
@@ -108,9 +109,7 @@ class Hist(object):
         elif value >= self.low_edges[self.n_bins + 1]:  # or above the low edge of the overflow?
             return self.n_bins + 1
         else:
-            for ib in range(self.n_bins + 2):  # loop over all the bins (including under/overflow)
-                if value >= self.low_edges[ib] and value < self.low_edges[ib+1]:  # NOTE <ib> never gets to <n_bins> + 1 because we already get all the overflows above (which is good 'cause this'd fail with an IndexError)
-                    return ib
+            return bisect.bisect_right(self.low_edges, value) - 1  # i.e. the last bin whose low edge is <= <value> (NOTE never gets to <n_bins> + 1 because we already got all the overflows above)
 
     # ----------------------------------------------------------------------------------------
     def fill(self, value, weight=1.0):
@@ -7,11 +7,11 @@ import yaml
 from scipy.stats import norm
 import csv
 import time
+import hashlib
 
 import utils
 from opener import opener
-import paramutils
-from hist import Hist
+from parameterset import ParameterSet
 
 # ----------------------------------------------------------------------------------------
 def get_bin_list(values, bin_type):
@@ -166,14 +166,124 @@ class HMM(object):
         state.check()
         self.states.append(state)
 
+region_insertions = {'v' : ['fv'], 'd' : ['vd'], 'j' : ['dj', 'jf']}  # insertions that get written into each region's hmms
+input_hash_fname = 'input-hashes.csv'  # in the hmm dir, with the hash of the inputs from which we wrote each gene's hmm
+
+# ----------------------------------------------------------------------------------------
+class InputHasher(object):
+    """
+    Content hashes of everything that goes into each gene's hmm, so we can skip rewriting hmms whose inputs haven't changed:
+    the germline sequence (and conserved codon position), the lines from the erosion and insertion files for this gene (or for its replacement genes, if we didn't see it enough),
+    its count and the region total from the gene probs file, the insertion content and overall mean mute freq files, its (or its replacement genes') mute freq files,
+    the relevant command line args, and the source of the code that reads them.
+    """
+    def __init__(self, base_indir, glfo, args):
+        self.indir = base_indir
+        self.glfo = glfo
+        self.args = args
+        self.file_contents = {}  # cache the contents of each file, since most of them are used for every gene in a region
+        sha = hashlib.sha1()
+        for module in ('hmmwriter', 'parameterset', 'paramutils', 'utils', 'hist'):  # code that affects what goes into the hmms (utils has e.g. the replacement gene logic, and eps). The glfo info we use is hashed directly in get_hash(), so we don't need glutils
+            with open(os.path.dirname(os.path.realpath(__file__)) + '/' + module + '.py') as srcfile:
+                sha.update(srcfile.read())
+        self.source_hash = sha.hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def read_file(self, fname):
+        """ return (contents, list of csv lines) for <fname> (both None if it d.n.e.) """
+        if fname not in self.file_contents:
+            if os.path.exists(self.indir + '/' + fname):
+                with opener('r')(self.indir + '/' + fname) as infile:
+                    contents = infile.read()
+                self.file_contents[fname] = (contents, list(csv.DictReader(contents.splitlines())))
+            else:
+                self.file_contents[fname] = (None, None)
+        return self.file_contents[fname]
+
+    # ----------------------------------------------------------------------------------------
+    def get_hash(self, gene):
+        region = utils.get_region(gene)
+        sha = hashlib.sha1()
+
+        def add(name, value):
+            sha.update('%s:%s\n' % (name, value))
+
+        add('source', self.source_hash)
+        add('gene', gene)
+        add('seq', self.glfo['seqs'][region][gene])
+        if region == 'v':
+            add('cyst', self.glfo['cyst-positions'][gene])
+        elif region == 'j':
+            add('tryp', self.glfo['tryp-positions'][gene])
+        add('min_observations_to_write', self.args.min_observations_to_write)
+
+        _, gplines = self.read_file(region + '_gene-probs.csv')
+        if gplines is None:
+            raise Exception('gene probs file %s d.n.e.' % (self.indir + '/' + region + '_gene-probs.csv'))
+        count = sum([int(line['count']) for line in gplines if line[region + '_gene'] == gene])
+        add('count', count)
+        add('total', sum([int(line['count']) for line in gplines]))
+        approved_genes = [gene, ]
+        if count < self.args.min_observations_to_write:
+            approved_genes = utils.find_replacement_genes(self.indir, self.args.min_observations_to_write, gene, single_gene=False)
+        add('approved_genes', ':'.join(approved_genes))
+
+        fnames = [utils.get_parameter_fname(column=erosion + '_del', deps=utils.column_dependencies[erosion + '_del']) for erosion in utils.real_erosions + utils.effective_erosions if erosion[0] == region]
+        fnames += [utils.get_parameter_fname(column=insertion + '_insertion', deps=utils.column_dependencies[insertion + '_insertion']) for insertion in region_insertions[region]]
+        for fname in fnames:  # only the lines for <approved_genes>, in the same way as read_erosion_info() and read_insertion_info()
+            _, lines = self.read_file(fname)
+            if lines is None:
+                add(fname, None)
+                continue
+            for line in lines:
+                if region + '_gene' in line and line[region + '_gene'] not in approved_genes:
+                    continue
+                add(fname, ','.join([k + '=' + line[k] for k in sorted(line)]))
+
+        fnames = [insertion + '_insertion_content.csv' for insertion in region_insertions[region]] + ['all-mean-mute-freqs.csv', ]
+        fnames += ['mute-freqs/' + utils.sanitize_name(g) + '.csv' for g in approved_genes]
+        for fname in fnames:  # whole files
+            add(fname, self.read_file(fname)[0])
+
+        return sha.hexdigest()
+
+# ----------------------------------------------------------------------------------------
+def read_input_hashes(hmm_dir):
+    """ return dict of input hashes for the hmms in <hmm_dir> (empty if we haven't written any) """
+    if not os.path.exists(hmm_dir + '/' + input_hash_fname):
+        return {}
+    with open(hmm_dir + '/' + input_hash_fname) as hashfile:
+        return {line['gene'] : line['hash'] for line in csv.DictReader(hashfile)}
+
+# ----------------------------------------------------------------------------------------
+def write_input_hashes(hmm_dir, input_hashes):
+    with open(hmm_dir + '/' + input_hash_fname, 'w') as hashfile:
+        writer = csv.DictWriter(hashfile, ('gene', 'hash'))
+        writer.writeheader()
+        for gene in sorted(input_hashes):
+            writer.writerow({'gene' : gene, 'hash' : input_hashes[gene]})
+
+# ----------------------------------------------------------------------------------------
+worker_info = {}  # set in each pool worker by init_worker(), so we only send the germline info and args once per process
+
+def init_worker(base_indir, outdir, glfo, args):
+    worker_info.update({'base_indir' : base_indir, 'outdir' : outdir, 'glfo' : glfo, 'args' : args, 'pset' : ParameterSet(base_indir)})
+
+def write_gene_hmm(gene):
+    """ pool worker function: write the hmm for <gene> """
+    writer = HmmWriter(worker_info['base_indir'], worker_info['outdir'], gene, worker_info['glfo'], worker_info['args'], pset=worker_info['pset'])
+    writer.write()
+    return gene
+
 # ----------------------------------------------------------------------------------------
 class HmmWriter(object):
-    def __init__(self, base_indir, outdir, gene_name, glfo, args):
+    def __init__(self, base_indir, outdir, gene_name, glfo, args, pset=None):  # pass in <pset> (a ParameterSet for <base_indir>) if you're writing more than one gene
         self.region = utils.get_region(gene_name)
         self.raw_name = gene_name  # i.e. unsanitized
         self.germline_seqs = glfo['seqs']  # all germline alleles
         self.germline_seq = self.germline_seqs[self.region][gene_name]  # germline sequence for this hmm
         self.indir = base_indir
+        self.pset = pset if pset is not None else ParameterSet(base_indir)
         self.args = args
         self.cyst_positions = glfo['cyst-positions']
         self.tryp_positions = glfo['tryp-positions']
@@ -193,37 +303,30 @@ class HmmWriter(object):
         self.smallest_entry_index = -1  # keeps track of the first state that has a chance of being entered from init -- we want to start writing (with add_internal_state) from there
 
         # self.insertions = [ insert for insert in utils.index_keys if re.match(self.region + '._insertion', insert) or re.match('.' + self.region + '_insertion', insert)]  OOPS that's not what I want to do
-        self.insertions = []
-        if self.region == 'v':
-            self.insertions.append('fv')
-        elif self.region == 'd':
-            self.insertions.append('vd')
-        elif self.region == 'j':
-            self.insertions.append('dj')
-            self.insertions.append('jf')
+        self.insertions = list(region_insertions[self.region])
 
         self.erosion_probs = {}
         self.insertion_probs = {}
         self.insertion_content_probs = {}
 
-        self.n_occurences = utils.read_overall_gene_probs(self.indir, only_gene=gene_name, normalize=False)  # how many times did we observe this gene in data?
+        self.n_occurences = self.pset.get_gene_count(gene_name)  # how many times did we observe this gene in data?
         replacement_genes = None
         if self.n_occurences < self.args.min_observations_to_write:  # if we didn't see it enough, average over all the genes that find_replacement_genes() gives us
             if self.args.debug:
                 print '    only saw it %d times, use info from other genes' % self.n_occurences
-            replacement_genes = utils.find_replacement_genes(self.indir, self.args.min_observations_to_write, gene_name, single_gene=False, debug=self.args.debug)
+            replacement_genes = self.pset.find_replacement_genes(self.args.min_observations_to_write, gene_name, single_gene=False, debug=self.args.debug)
 
         self.read_erosion_info(gene_name, replacement_genes)  # try this exact gene, but...
 
         self.read_insertion_info(gene_name, replacement_genes)
 
-        self.mute_freqs, self.mute_obs = paramutils.read_mute_info(self.indir, this_gene=gene_name, approved_genes=replacement_genes)
+        self.mute_freqs, self.mute_obs = self.pset.get_mute_info(this_gene=gene_name, approved_genes=replacement_genes)
 
         self.track = Track('nukes', utils.nukes)
         self.saniname = utils.sanitize_name(gene_name)
         self.hmm = HMM(self.saniname, self.track.getdict())  # pass the track as a dict rather than a Track object to keep the yaml file a bit more readable
-        self.hmm.extras['gene_prob'] = max(self.eps, utils.read_overall_gene_probs(self.indir, only_gene=gene_name))  # if we really didn't see this gene at all, take pity on it and kick it an eps
-        mean_freq_hist = Hist(fname=self.indir + '/all-mean-mute-freqs.csv')
+        self.hmm.extras['gene_prob'] = max(self.eps, self.pset.get_gene_count(gene_name, normalize=True, expect_zero_counts=True))  # if we really didn't see this gene at all, take pity on it and kick it an eps
+        mean_freq_hist = self.pset.get_mean_mute_hist('all')
         self.hmm.extras['overall_mute_freq'] = mean_freq_hist.get_mean()
 
     # ----------------------------------------------------------------------------------------
@@ -332,25 +435,22 @@ class HmmWriter(object):
             if erosion[0] != self.region:
                 continue
             self.erosion_probs[erosion] = {}
-            deps = utils.column_dependencies[erosion + '_del']
-            with opener('r')(self.indir + '/' + utils.get_parameter_fname(column=erosion + '_del', deps=deps)) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
-                    # then skip nonsense erosions that're too long for this gene, but were ok for another
-                    if int(line[erosion + '_del']) >= len(self.germline_seq):
+            for gene, counts in self.pset.get_table(erosion + '_del').items():
+                # first see if we want to use this gene's counts (if the key is None, this erosion doesn't depend on gene version)
+                if gene is not None and gene not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
+                    continue
+                for n_eroded, count in counts.items():
+                    # skip nonsense erosions that're too long for this gene, but were ok for another
+                    if n_eroded >= len(self.germline_seq):
                         continue
 
                     # then add in this erosion's counts
-                    n_eroded = int(line[erosion + '_del'])
                     if n_eroded not in self.erosion_probs[erosion]:
                         self.erosion_probs[erosion][n_eroded] = 0.0
-                    self.erosion_probs[erosion][n_eroded] += float(line['count'])
+                    self.erosion_probs[erosion][n_eroded] += count
 
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+                    if gene is not None:
+                        genes_used.add(gene)
 
             assert len(self.erosion_probs[erosion]) > 0
 
@@ -386,23 +486,19 @@ class HmmWriter(object):
         genes_used = set()
         for insertion in self.insertions:
             self.insertion_probs[insertion] = {}
-            deps = utils.column_dependencies[insertion + '_insertion']
-            with opener('r')(self.indir + '/' + utils.get_parameter_fname(column=insertion + '_insertion', deps=deps)) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    # first see if we want to use this line (if <region>_gene isn't in the line, this erosion doesn't depend on gene version)
-                    if self.region + '_gene' in line and line[self.region + '_gene'] not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
-                        continue
+            for gene, counts in self.pset.get_table(insertion + '_insertion').items():
+                # first see if we want to use this gene's counts (if the key is None, this insertion doesn't depend on gene version)
+                if gene is not None and gene not in approved_genes:  # NOTE you'll need to change this if you want it to depend on another region's genes
+                    continue
 
-                    # then add in this insertion's counts
-                    n_inserted = 0
-                    n_inserted = int(line[insertion + '_insertion'])
+                # then add in this insertion's counts
+                for n_inserted, count in counts.items():
                     if n_inserted not in self.insertion_probs[insertion]:
                         self.insertion_probs[insertion][n_inserted] = 0.0
-                    self.insertion_probs[insertion][n_inserted] += float(line['count'])
+                    self.insertion_probs[insertion][n_inserted] += count
 
-                    if self.region + '_gene' in line:
-                        genes_used.add(line[self.region + '_gene'])
+                    if gene is not None:
+                        genes_used.add(gene)
 
             assert len(self.insertion_probs[insertion]) > 0
 
@@ -444,22 +540,18 @@ class HmmWriter(object):
     def read_insertion_content(self, insertion):
         self.insertion_content_probs[insertion] = {}
         if insertion in utils.boundaries:  # just return uniform probs for fv and jf insertions
-            with opener('r')(self.indir + '/' + insertion + '_insertion_content.csv') as icfile:
-                reader = csv.DictReader(icfile)
-                total = 0
-                for line in reader:
-                    self.insertion_content_probs[insertion][line[insertion + '_insertion_content']] = int(line['count'])
-                    total += int(line['count'])
+            self.insertion_content_probs[insertion] = dict(self.pset.get_insertion_content(insertion))
+            total = sum(self.insertion_content_probs[insertion].values())
+            if total == 0.:
+                print '\n    WARNING zero insertion content probs read from %s, so setting to uniform distribution' % self.indir + '/' + insertion + '_insertion_content.csv'
+            for nuke in utils.nukes:
                 if total == 0.:
-                    print '\n    WARNING zero insertion content probs read from %s, so setting to uniform distribution' % self.indir + '/' + insertion + '_insertion_content.csv'
-                for nuke in utils.nukes:
-                    if total == 0.:
-                        self.insertion_content_probs[insertion][nuke] = 1. / len(utils.nukes)
-                    else:
-                        if nuke not in self.insertion_content_probs[insertion]:
-                            print '    %s not in insertion content probs, adding with zero' % nuke
-                            self.insertion_content_probs[insertion][nuke] = 0
-                        self.insertion_content_probs[insertion][nuke] /= float(total)
+                    self.insertion_content_probs[insertion][nuke] = 1. / len(utils.nukes)
+                else:
+                    if nuke not in self.insertion_content_probs[insertion]:
+                        print '    %s not in insertion content probs, adding with zero' % nuke
+                        self.insertion_content_probs[insertion][nuke] = 0
+                    self.insertion_content_probs[insertion][nuke] /= float(total)
         else:
             self.insertion_content_probs[insertion] = {n : 0.25 for n in utils.nukes}
 
@@ -1,5 +1,7 @@
 import csv
 import os
+import math
+import numpy
 
 import fraction_uncertainty
 from hist import Hist
@@ -7,13 +9,27 @@ from opener import opener
 import utils
 import plotting
 
+nuke_indices = numpy.full(256, -1, dtype=numpy.int64)  # index in utils.nukes of each (upper case) character code, or -1
+for inuke, nuke in enumerate(utils.nukes):
+    nuke_indices[ord(nuke)] = inuke
+ambiguous_table = numpy.zeros(256, dtype=numpy.bool_)
+for ambig in utils.ambiguous_bases:
+    ambiguous_table[ord(ambig)] = True
+
 # ----------------------------------------------------------------------------------------
 class MuteFreqer(object):
+    """
+    Per-gene, per-position mutation counts, backed by a numpy array of counts for each region (genes x positions x nucleotides).
+    Batches of sequences can be counted at once with increment_many(), and counts from several MuteFreqers (e.g. one for each subset of the sequences) combined with merge().
+    """
     def __init__(self, glfo, calculate_uncertainty=True):
         self.glfo = glfo
         self.calculate_uncertainty = calculate_uncertainty
 
-        self.counts, self.freqs = {}, {}
+        self.gene_indices = {r : {} for r in utils.regions}  # index of each gene in the first dimension of its region's arrays
+        self.counts = {r : numpy.zeros((0, 0, len(utils.nukes)), dtype=numpy.int64) for r in utils.regions}  # number of times we've observed each base at each position in each gene
+        self.gl_nukes = {r : numpy.zeros((0, 0), dtype=numpy.uint8) for r in utils.regions}  # germline base at each position (as a character code, zero for positions we haven't observed)
+        self.freqs = {}
         n_bins, xmin, xmax = 200, 0., 1.
         self.mean_rates = {n : Hist(n_bins, xmin, xmax) for n in ['all', ] + utils.regions}
 
@@ -21,71 +37,141 @@ class MuteFreqer(object):
         self.n_cached, self.n_not_cached = 0, 0
 
     # ----------------------------------------------------------------------------------------
-    def increment(self, info):
-        self.mean_rates['all'].fill(utils.get_mutation_rate(info))  # mean freq over whole sequence (excluding insertions)
-
-        for region in utils.regions:
-            # first do mean freqs
-            regional_freq = utils.get_mutation_rate(info, restrict_to_region=region)
-            self.mean_rates[region].fill(regional_freq)  # per-region mean freq
+    def get_gene_index(self, region, gene, length=0):
+        """ index of <gene> in <region>'s arrays, adding it (and making sure the arrays have at least <length> positions) if necessary """
+        if gene not in self.gene_indices[region]:
+            self.gene_indices[region][gene] = len(self.gene_indices[region])
+        n_genes, n_positions = max(len(self.gene_indices[region]), self.counts[region].shape[0]), max(length, self.counts[region].shape[1])
+        if (n_genes, n_positions) != self.counts[region].shape[:2]:  # grow the arrays (by at least a factor of two, so we don't do it too often)
+            if n_genes > self.counts[region].shape[0]:
+                n_genes = max(n_genes, 2 * self.counts[region].shape[0])
+            if n_positions > self.counts[region].shape[1]:
+                n_positions = max(n_positions, 2 * self.counts[region].shape[1])
+            old_counts, old_gl_nukes = self.counts[region], self.gl_nukes[region]
+            self.counts[region] = numpy.zeros((n_genes, n_positions, len(utils.nukes)), dtype=numpy.int64)
+            self.gl_nukes[region] = numpy.zeros((n_genes, n_positions), dtype=numpy.uint8)
+            self.counts[region][: old_counts.shape[0], : old_counts.shape[1]] = old_counts
+            self.gl_nukes[region][: old_gl_nukes.shape[0], : old_gl_nukes.shape[1]] = old_gl_nukes
+        return self.gene_indices[region][gene]
 
-            # then do per-gene per-position freqs
-            gene = info[region + '_gene']
+    # ----------------------------------------------------------------------------------------
+    def get_genes(self):
+        return [g for r in utils.regions for g in self.gene_indices[r]]
 
-            if gene not in self.counts:
-                self.counts[gene] = {}
-            gcts = self.counts[gene]  # shorthand name
+    # ----------------------------------------------------------------------------------------
+    def get_count_array(self, gene):
+        """ positions x nucleotides array of counts for <gene> """
+        region = utils.get_region(gene)
+        return self.counts[region][self.gene_indices[region][gene]]
 
-            germline_seq = info[region + '_gl_seq']
-            query_seq = info[region + '_qr_seq']
-            assert len(germline_seq) == len(query_seq)
+    # ----------------------------------------------------------------------------------------
+    def get_positions(self, gene):
+        """ sorted list of the positions in <gene> at which we've observed any (unambiguous) bases """
+        return numpy.flatnonzero(self.get_count_array(gene).sum(axis=1) > 0).tolist()
 
-            for ipos in range(len(germline_seq)):
-                igl = ipos + int(info[region + '_5p_del'])  # account for left-side deletions in the indexing
+    # ----------------------------------------------------------------------------------------
+    def get_gl_nuke(self, gene, position):
+        """ germline base at <position> in <gene> (from the first sequence in which we observed it) """
+        region = utils.get_region(gene)
+        return chr(self.gl_nukes[region][self.gene_indices[region][gene], position])
 
-                if germline_seq[ipos] in utils.ambiguous_bases or query_seq[ipos] in utils.ambiguous_bases:  # skip if either germline or query sequence is ambiguous at this position
-                    continue
+    # ----------------------------------------------------------------------------------------
+    def increment(self, info, multiplicity=1):
+        self.increment_many([info, ], multiplicities=[multiplicity, ])
 
-                if igl not in gcts:  # if we have not yet observed this position in a query sequence, initialize it
-                    gcts[igl] = {n : 0 for n in utils.nukes + ['total', ]}
-                    gcts[igl]['gl_nuke'] = germline_seq[ipos]
+    # ----------------------------------------------------------------------------------------
+    def increment_many(self, infos, multiplicities=None):
+        """ count each of <infos> (the i-th one <multiplicities[i]> times, e.g. if it stands for several identical sequences) """
+        if multiplicities is None:
+            multiplicities = [1 for _ in infos]
+        for info, multiplicity in zip(infos, multiplicities):
+            for _ in range(multiplicity):  # (hists use sqrt(n) errors, so fill them once for each sequence rather than with a weight)
+                self.mean_rates['all'].fill(utils.get_mutation_rate(info))  # mean freq over whole sequence (excluding insertions)
+                for region in utils.regions:
+                    self.mean_rates[region].fill(utils.get_mutation_rate(info, restrict_to_region=region))  # per-region mean freq
+
+        # then do per-gene per-position counts, for all the sequences at once
+        for region in utils.regions:
+            igenes, positions, inukes, weights = [], [], [], []
+            for info, multiplicity in zip(infos, multiplicities):
+                germline_seq = info[region + '_gl_seq']
+                query_seq = info[region + '_qr_seq']
+                assert len(germline_seq) == len(query_seq)
+                offset = int(info[region + '_5p_del'])  # account for left-side deletions in the indexing
+                igene = self.get_gene_index(region, info[region + '_gene'], length=offset + len(germline_seq))
+
+                gl_arr, qr_arr = numpy.frombuffer(germline_seq, dtype=numpy.uint8), numpy.frombuffer(query_seq, dtype=numpy.uint8)
+                unambig = numpy.logical_not(ambiguous_table[gl_arr] | ambiguous_table[qr_arr])  # skip positions at which either germline or query sequence is ambiguous
+                these_positions = numpy.flatnonzero(unambig) + offset
+                these_inukes = nuke_indices[qr_arr[unambig]]
+                if (these_inukes < 0).any():
+                    raise Exception('unexpected base in %s (expected one of %s)' % (query_seq, utils.nukes + utils.ambiguous_bases))
+
+                gl_nukes = self.gl_nukes[region][igene]  # set the germline base for positions we haven't yet observed
+                unset = gl_nukes[these_positions] == 0
+                gl_nukes[these_positions[unset]] = gl_arr[unambig][unset]
+
+                igenes.append(numpy.full(len(these_positions), igene, dtype=numpy.int64))
+                positions.append(these_positions)
+                inukes.append(these_inukes)
+                weights.append(numpy.full(len(these_positions), multiplicity, dtype=numpy.int64))
+            if len(igenes) > 0:
+                numpy.add.at(self.counts[region], (numpy.concatenate(igenes), numpy.concatenate(positions), numpy.concatenate(inukes)), numpy.concatenate(weights))
 
-                gcts[igl]['total'] += 1
-                gcts[igl][query_seq[ipos]] += 1  # note that if <query_seq[ipos]> isn't among <utils.nukes>, this will toss a key error
+    # ----------------------------------------------------------------------------------------
+    def merge(self, other):
+        """ add the counts from <other> (another MuteFreqer, e.g. for a different subset of sequences) to ours """
+        assert not self.finalized and not other.finalized
+        for region in utils.regions:
+            for gene, iother in sorted(other.gene_indices[region].items(), key=lambda p: p[1]):  # keep the other's gene order, so merging in order gives the same arrays as counting everything here
+                other_counts, other_gl_nukes = other.counts[region][iother], other.gl_nukes[region][iother]
+                igene = self.get_gene_index(region, gene, length=other_counts.shape[0])
+                self.counts[region][igene, : other_counts.shape[0]] += other_counts
+                gl_nukes = self.gl_nukes[region][igene, : other_counts.shape[0]]
+                unset = gl_nukes == 0
+                gl_nukes[unset] = other_gl_nukes[unset]
+        for rtype, hist in self.mean_rates.items():
+            hist.add(other.mean_rates[rtype])
+            hist.errors = [math.sqrt(c) for c in hist.bin_contents]  # same as if we'd filled them all here
 
     # ----------------------------------------------------------------------------------------
-    def get_uncertainty(self, obs, total):
+    def get_uncertainties(self, obs, total):
+        """ arrays of (lo, hi) uncertainties for each of the ratios <obs> / <total> """
         if self.calculate_uncertainty:  # it's kinda slow
-            errs = fraction_uncertainty.err(obs, total)
-            if errs[2]:
-                self.n_cached += 1
-            else:
-                self.n_not_cached += 1
+            lo, hi, cached = fraction_uncertainty.errs(obs, total)
+            n_cached = int(numpy.count_nonzero(cached))
+            self.n_cached += n_cached
+            self.n_not_cached += len(cached) - n_cached
         else:
-            errs = 0., 1.
+            lo, hi = numpy.zeros(len(obs)), numpy.ones(len(obs))
 
-        return errs[0], errs[1]
+        return lo, hi
 
     # ----------------------------------------------------------------------------------------
     def finalize(self):
         """ convert from counts to mut freqs """
         assert not self.finalized
 
-        for gene in self.counts:
-            freqs = {position : {} for position in self.counts[gene]}
-            for position in sorted(self.counts[gene].keys()):
-                n_conserved, n_mutated = 0, 0
-                for nuke in utils.nukes:
-                    ncount, total = self.counts[gene][position][nuke], self.counts[gene][position]['total']
-                    nuke_freq = float(ncount) / total
-                    freqs[position][nuke] = nuke_freq
-                    freqs[position][nuke + '_lo_err'], freqs[position][nuke + '_hi_err'] = self.get_uncertainty(ncount, total)
-                    if nuke == self.counts[gene][position]['gl_nuke']:
-                        n_conserved += ncount
-                    else:
-                        n_mutated += ncount  # sum over A,C,G,T
-                freqs[position]['freq'] = float(n_mutated) / total
-                freqs[position]['freq_lo_err'], freqs[position]['freq_hi_err'] = self.get_uncertainty(n_mutated, total)
+        for gene in self.get_genes():
+            positions = self.get_positions(gene)
+            gcounts = self.get_count_array(gene)[positions]  # positions x nukes
+            totals = gcounts.sum(axis=1)
+            gl_inukes = nuke_indices[self.gl_nukes[utils.get_region(gene)][self.gene_indices[utils.get_region(gene)][gene], positions]]
+            n_mutated = totals - gcounts[numpy.arange(len(positions)), gl_inukes]  # sum over A,C,G,T that aren't the germline base
+
+            # uncertainties for each nuke, then for the overall freq, all in one call
+            all_obs = numpy.concatenate([gcounts[:, inuke] for inuke in range(len(utils.nukes))] + [n_mutated, ])
+            all_lo, all_hi = self.get_uncertainties(all_obs, numpy.tile(totals, len(utils.nukes) + 1))
+            all_freqs = all_obs / totals.astype(numpy.float64)[numpy.tile(numpy.arange(len(positions)), len(utils.nukes) + 1)]
+            all_freqs, all_lo, all_hi = [arr.reshape(len(utils.nukes) + 1, len(positions)).tolist() for arr in (all_freqs, all_lo, all_hi)]
+
+            freqs = {position : {} for position in positions}
+            for ipos, position in enumerate(positions):
+                for inuke, nuke in enumerate(utils.nukes):
+                    freqs[position][nuke] = all_freqs[inuke][ipos]
+                    freqs[position][nuke + '_lo_err'], freqs[position][nuke + '_hi_err'] = all_lo[inuke][ipos], all_hi[inuke][ipos]
+                freqs[position]['freq'] = all_freqs[-1][ipos]
+                freqs[position]['freq_lo_err'], freqs[position]['freq_hi_err'] = all_lo[-1][ipos], all_hi[-1][ipos]
 
             self.freqs[gene] = freqs
 
@@ -142,21 +228,21 @@ class MuteFreqer(object):
         if not self.finalized:
             self.finalize()
 
-        for gene in self.counts:
-            gcounts, freqs = self.counts[gene], self.freqs[gene]
+        for gene in self.get_genes():
+            gcounts, freqs = self.get_count_array(gene), self.freqs[gene]
             outfname = outdir + '/' + utils.sanitize_name(gene) + '.csv'
             with opener('w')(outfname) as outfile:
                 nuke_header = [n + xtra for n in utils.nukes for xtra in ('', '_obs', '_lo_err', '_hi_err')]
                 writer = csv.DictWriter(outfile, ('position', 'mute_freq', 'lo_err', 'hi_err') + tuple(nuke_header))
                 writer.writeheader()
-                for position in sorted(gcounts.keys()):
+                for position in sorted(freqs.keys()):
                     row = {'position':position,
                            'mute_freq':freqs[position]['freq'],
                            'lo_err':freqs[position]['freq_lo_err'],
                            'hi_err':freqs[position]['freq_hi_err']}
-                    for nuke in utils.nukes:
+                    for inuke, nuke in enumerate(utils.nukes):
                         row[nuke] = freqs[position][nuke]
-                        row[nuke + '_obs'] = gcounts[position][nuke]
+                        row[nuke + '_obs'] = gcounts[position, inuke]
                         row[nuke + '_lo_err'] = freqs[position][nuke + '_lo_err']
                         row[nuke + '_hi_err'] = freqs[position][nuke + '_hi_err']
                     writer.writerow(row)
@@ -3,14 +3,79 @@ import os
 import csv
 import time
 import sys
+import numpy
+from collections import OrderedDict
 
 import utils
 import glutils
+import columnar
 from opener import opener
 import plotting
 from hist import Hist
 from mutefreqer import MuteFreqer
 
+# ----------------------------------------------------------------------------------------
+class IndexedCounts(object):
+    """
+    Counts for each of a set of keys (tuples of parameter values), stored as a numpy array with a dense index for each key.
+    Keys stay in the order in which we first saw them, and merge() appends any new keys from the other counts in their order, so merging the counts for
+    consecutive subsets of the sequences gives the same result as counting them all at once.
+    Has the parts of the dict interface that we use (iteritems(), keys(), [], len()).
+    """
+    def __init__(self, keys=None):
+        self.indices = OrderedDict()
+        self.counts = numpy.zeros(16, dtype=numpy.int64)
+        if keys is not None:
+            for key in keys:
+                self.get_index(key)
+
+    # ----------------------------------------------------------------------------------------
+    def get_index(self, key):
+        if key not in self.indices:
+            if len(self.indices) == len(self.counts):
+                self.counts = numpy.concatenate([self.counts, numpy.zeros(len(self.counts), dtype=numpy.int64)])
+            self.indices[key] = len(self.indices)
+        return self.indices[key]
+
+    # ----------------------------------------------------------------------------------------
+    def increment(self, key, n=1):
+        index = self.get_index(key)  # (have to do this first, since it can reallocate self.counts)
+        self.counts[index] += n
+
+    # ----------------------------------------------------------------------------------------
+    def increment_many(self, keys):
+        """ increment the count for each key in <keys> (repeats are fine) """
+        indices = numpy.array([self.get_index(k) for k in keys], dtype=numpy.int64)
+        if len(indices) > 0:
+            self.counts[: len(self.indices)] += numpy.bincount(indices, minlength=len(self.indices))
+
+    # ----------------------------------------------------------------------------------------
+    def merge(self, other):
+        indices = numpy.array([self.get_index(k) for k in other.indices], dtype=numpy.int64)
+        if len(indices) > 0:
+            self.counts[indices] += other.counts[: len(other.indices)]
+
+    # ----------------------------------------------------------------------------------------
+    def keys(self):
+        return self.indices.keys()
+
+    # ----------------------------------------------------------------------------------------
+    def iteritems(self):
+        for key, index in self.indices.iteritems():
+            yield key, int(self.counts[index])
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        return int(self.counts[self.indices[key]])
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self.indices
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.indices)
+
 # ----------------------------------------------------------------------------------------
 class ParameterCounter(object):
     """ class to keep track of how many times we've seen each gene version, erosion length,
@@ -21,13 +86,13 @@ class ParameterCounter(object):
         self.mfreqer = MuteFreqer(self.glfo)
         self.reco_total = 0  # total number of recombination events
         self.mute_total = 0  # total number of sequences
-        self.counts = {}
-        self.counts['all'] = {}
+        self.counts = OrderedDict()
+        self.counts['all'] = IndexedCounts()
         for column in utils.column_dependencies:
-            self.counts[column] = {}
+            self.counts[column] = IndexedCounts()
         for bound in utils.boundaries:
-            self.counts[bound + '_insertion_content'] = {n : 0 for n in utils.nukes}  # base content of each insertion
-        self.counts['seq_content'] = {n : 0 for n in utils.nukes}
+            self.counts[bound + '_insertion_content'] = IndexedCounts(keys=[(n, ) for n in utils.nukes])  # base content of each insertion
+        self.counts['seq_content'] = IndexedCounts(keys=[(n, ) for n in utils.nukes])
 
     # ----------------------------------------------------------------------------------------
     def get_index(self, info, deps):
@@ -42,43 +107,49 @@ class ParameterCounter(object):
         return tuple(index)
 
     # ----------------------------------------------------------------------------------------
-    def increment_all_params(self, info):
-        self.increment_per_sequence_params(info)
-        self.increment_per_family_params(info)
+    def increment_all_params(self, info, multiplicity=1):
+        self.increment_per_sequence_params(info, multiplicity=multiplicity)
+        self.increment_per_family_params(info, multiplicity=multiplicity)
 
     # ----------------------------------------------------------------------------------------
-    def increment_per_sequence_params(self, info):
-        """ increment parameters that differ for each sequence within the clonal family """
-        self.mute_total += 1
-        self.mfreqer.increment(info)
-        seq = info['seq']
-        for nuke in seq:
-            if nuke in utils.ambiguous_bases:
-                continue
-            self.counts['seq_content'][nuke] += 1
+    def increment_per_sequence_params(self, info, multiplicity=1):
+        """ increment parameters that differ for each sequence within the clonal family (<multiplicity> times, e.g. if <info> stands for several identical sequences) """
+        self.mute_total += multiplicity
+        self.mfreqer.increment(info, multiplicity=multiplicity)
+        self.increment_content('seq_content', info['seq'], multiplicity=multiplicity)
 
     # ----------------------------------------------------------------------------------------
-    def increment_per_family_params(self, info):
+    def increment_content(self, column, seq, multiplicity=1):
+        """ add the base content of <seq> to <column>'s counts (skipping ambiguous bases) """
+        if len(seq) == 0:
+            return
+        nuke_counts = numpy.bincount(numpy.frombuffer(seq, dtype=numpy.uint8), minlength=256)
+        for nuke in utils.nukes:
+            self.counts[column].increment((nuke, ), multiplicity * nuke_counts[ord(nuke)])
+        if nuke_counts.sum() != sum([nuke_counts[ord(n)] for n in utils.nukes + utils.ambiguous_bases]):
+            raise Exception('unexpected base in %s (expected one of %s)' % (seq, utils.nukes + utils.ambiguous_bases))
+
+    # ----------------------------------------------------------------------------------------
+    def increment_per_family_params(self, info, multiplicity=1):
         """ increment parameters that are the same for the entire clonal family """
-        self.reco_total += 1
+        self.reco_total += multiplicity
 
-        all_index = self.get_index(info, tuple(list(utils.index_columns) + ['cdr3_length', ]))
-        if all_index not in self.counts['all']:
-            self.counts['all'][all_index] = 0
-        self.counts['all'][all_index] += 1
+        self.counts['all'].increment(self.get_index(info, tuple(list(utils.index_columns) + ['cdr3_length', ])), multiplicity)
 
         for deps in utils.column_dependency_tuples:
-            column = deps[0]
-            index = self.get_index(info, deps)
-            if index not in self.counts[column]:
-                self.counts[column][index] = 0
-            self.counts[column][index] += 1
+            self.counts[deps[0]].increment(self.get_index(info, deps), multiplicity)
 
         for bound in utils.boundaries:
-            for nuke in info[bound + '_insertion']:
-                if nuke in utils.ambiguous_bases:
-                    continue
-                self.counts[bound + '_insertion_content'][nuke] += 1
+            self.increment_content(bound + '_insertion_content', info[bound + '_insertion'], multiplicity=multiplicity)
+
+    # ----------------------------------------------------------------------------------------
+    def merge(self, other):
+        """ add the counts from <other> (another ParameterCounter, e.g. for a different subset of the sequences) to ours """
+        self.reco_total += other.reco_total
+        self.mute_total += other.mute_total
+        self.mfreqer.merge(other.mfreqer)
+        for column in self.counts:
+            self.counts[column].merge(other.counts[column])
 
     # ----------------------------------------------------------------------------------------
     def clean_plots(self, plotdir, subset_by_gene):
@@ -159,12 +230,17 @@ class ParameterCounter(object):
         sys.stdout.flush()
         start = time.time()
 
-        utils.prep_dir(base_outdir, subdirs=('hmms', 'mute-freqs', 'germline-sets'), wildlings=('*.csv', '*.yaml', '*.fasta'))  # it's kind of hackey to specify the /hmms dir here, but as soon as we write the parameters below, the previous yamels are out of date, so it's pretty much necessary
+        wildlings = ('*.csv', '*.yaml', '*.fasta', '*.h5')
+        for subdir in ('mute-freqs', 'germline-sets'):  # NOTE we leave the /hmms dir alone: write_hmms() checks each hmm's inputs, and only rewrites the ones that are out of date
+            utils.prep_dir(base_outdir + '/' + subdir, wildlings=wildlings)
+        utils.prep_dir(base_outdir, wildlings=wildlings)
 
         self.mfreqer.write(base_outdir + '/mute-freqs', mean_freq_outfname=base_outdir + '/REGION-mean-mute-freqs.csv')  # REGION is replace by each region in the three output files)
         genes_with_counts = [g[0] for r in utils.regions for g in self.counts[r + '_gene'].keys()]
         glutils.write_glfo(base_outdir + '/' + glutils.glfo_dir, self.glfo, only_genes=genes_with_counts, debug=True)
 
+        columnar_fname = 'parameter-counts.h5'
+        first_table = True
         for column in self.counts:
             index = None
             outfname = None
@@ -194,4 +270,10 @@ class ParameterCounter(object):
                     line['count'] = count
                     out_data.writerow(line)
 
+            if self.args.columnar_parameter_counts:  # also write the same counts as a table in the columnar file (hmmwriter and friends still read the csvs)
+                keys = self.counts[column].keys()
+                table = OrderedDict([(index[ic], [key[ic] for key in keys]) for ic in range(len(index))] + [('count', [self.counts[column][key] for key in keys])])
+                columnar.write_table(base_outdir + '/' + columnar_fname, os.path.basename(outfname).replace('.csv', ''), table, mode='w' if first_table else 'a')
+                first_table = False
+
         print '(%.1f sec)' % (time.time()-start)
@@ -0,0 +1,116 @@
+import csv
+import copy
+from collections import OrderedDict
+
+import utils
+import paramutils
+from opener import opener
+from hist import Hist
+
+# ----------------------------------------------------------------------------------------
+class ParameterSet(object):
+    """
+    In-memory index of the info in parameter dir <indir>, so hmmwriter, recombinator and treegenerator don't have to re-open and re-scan the same csvs for every gene.
+    Each file is read (lazily) at most once, into tables keyed by gene: gene counts, erosion and insertion length counts, insertion content, per-position mute freqs, and mean mute freq hists.
+    NOTE the returned tables are shared between callers, so don't modify them (except for the hists, which are copies).
+    """
+    def __init__(self, indir):
+        self.indir = indir
+        self.gene_count_lines = {}  # for each region, list of (gene, count) in the same order as the gene probs file
+        self.gene_counts = {}  # for each region, count for each gene
+        self.gene_totals = {}  # total counts for each region
+        self.tables = {}  # for each column (e.g. v_3p_del), dict keyed by gene (or None if the column doesn't depend on gene) of {value : count}
+        self.insertion_contents = {}
+        self.mute_rows = {}  # rows from each gene's mute freq file
+        self.mute_info = {}  # combined mute freq info, keyed by tuple of approved genes
+        self.hists = {}
+        self.lines = {}
+
+    # ----------------------------------------------------------------------------------------
+    def read_lines(self, fname):
+        """ list of csv lines in file <fname> (relative to the parameter dir) """
+        if fname not in self.lines:
+            with opener('r')(self.indir + '/' + fname) as infile:
+                self.lines[fname] = list(csv.DictReader(infile))
+        return self.lines[fname]
+
+    # ----------------------------------------------------------------------------------------
+    def read_gene_counts(self, region):
+        if region not in self.gene_count_lines:
+            self.gene_count_lines[region] = [(line[region + '_gene'], int(line['count'])) for line in self.read_lines(region + '_gene-probs.csv')]  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
+            self.gene_counts[region] = {}
+            for gene, count in self.gene_count_lines[region]:
+                self.gene_counts[region][gene] = self.gene_counts[region].get(gene, 0) + count
+            self.gene_totals[region] = sum(self.gene_counts[region].values())
+            if self.gene_totals[region] < 1:
+                raise Exception('zero counts in %s' % self.indir + '/' + region + '_gene-probs.csv')
+
+    # ----------------------------------------------------------------------------------------
+    def get_genes(self, region):
+        """ genes that we observed in the parameter dir """
+        self.read_gene_counts(region)
+        return self.gene_counts[region].keys()
+
+    # ----------------------------------------------------------------------------------------
+    def get_gene_count(self, gene, normalize=False, expect_zero_counts=False):
+        """ same as utils.read_overall_gene_probs() with <only_gene> """
+        region = utils.get_region(gene)
+        self.read_gene_counts(region)
+        if gene not in self.gene_counts[region]:
+            if not expect_zero_counts:
+                print '      WARNING %s not found in overall gene probs, returning zero' % gene
+            return 0.0 if normalize else 0
+        if normalize:
+            return float(self.gene_counts[region][gene]) / self.gene_totals[region]
+        else:
+            return self.gene_counts[region][gene]
+
+    # ----------------------------------------------------------------------------------------
+    def find_replacement_genes(self, min_counts, gene_name=None, single_gene=False, debug=False, all_from_region=''):
+        """ same as utils.find_replacement_genes() """
+        region = utils.get_region(gene_name) if gene_name is not None else all_from_region
+        self.read_gene_counts(region)
+        return utils.choose_replacement_genes(self.gene_count_lines[region], min_counts, gene_name=gene_name, single_gene=single_gene, debug=debug, all_from_region=all_from_region, indir=self.indir)
+
+    # ----------------------------------------------------------------------------------------
+    def get_table(self, column):
+        """ counts for each value of <column> (e.g. v_3p_del or vd_insertion) for each gene (keyed by None if <column> doesn't depend on gene) """
+        if column not in self.tables:
+            deps = utils.column_dependencies[column]
+            gene_col = deps[0] if len(deps) > 0 and deps[0].find('_gene') > 0 else None
+            table = OrderedDict()
+            for line in self.read_lines(utils.get_parameter_fname(column=column, deps=deps)):
+                key = line[gene_col] if gene_col is not None else None
+                if key not in table:
+                    table[key] = OrderedDict()
+                val = int(line[column])
+                table[key][val] = table[key].get(val, 0.) + float(line['count'])
+            self.tables[column] = table
+        return self.tables[column]
+
+    # ----------------------------------------------------------------------------------------
+    def get_insertion_content(self, insertion):
+        """ counts for each base in <insertion> (fv or jf) """
+        if insertion not in self.insertion_contents:
+            self.insertion_contents[insertion] = OrderedDict([(line[insertion + '_insertion_content'], int(line['count'])) for line in self.read_lines(insertion + '_insertion_content.csv')])
+        return self.insertion_contents[insertion]
+
+    # ----------------------------------------------------------------------------------------
+    def get_mute_info(self, this_gene, approved_genes=None):
+        """ same as paramutils.read_mute_info() """
+        if approved_genes == None:
+            approved_genes = [this_gene,]
+        key = tuple(approved_genes)
+        if key not in self.mute_info:
+            for gene in approved_genes:
+                if gene not in self.mute_rows:
+                    self.mute_rows[gene] = paramutils.read_mute_rows(self.indir + '/mute-freqs/' + utils.sanitize_name(gene) + '.csv')
+            self.mute_info[key] = paramutils.combine_mute_info([self.mute_rows[g] for g in approved_genes])
+        return self.mute_info[key]
+
+    # ----------------------------------------------------------------------------------------
+    def get_mean_mute_hist(self, mtype):
+        """ copy of the hist of mean mute freqs for <mtype> ('all' or a region) """
+        if mtype not in self.hists:
+            self.hists[mtype] = Hist(fname=self.indir + '/' + mtype + '-mean-mute-freqs.csv')
+        return copy.deepcopy(self.hists[mtype])
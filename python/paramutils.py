@@ -20,30 +20,44 @@ def simplify_state_name(state_name):
 def read_mute_info(indir, this_gene, approved_genes=None):  # NOTE this would probably be more accurate if we made some effort to align the genes before combining all the approved ones
     if approved_genes == None:
         approved_genes = [this_gene,]
+    return combine_mute_info([read_mute_rows(indir + '/mute-freqs/' + utils.sanitize_name(gene) + '.csv') for gene in approved_genes])
+
+# ----------------------------------------------------------------------------------------
+def read_mute_rows(mutefname):
+    """ return list of (position, freq, lo_err, hi_err, {nuke : obs}) for each line in the mute freq file <mutefname> (None if it d.n.e.) """
+    if not os.path.exists(mutefname):
+        return None
+    rows = []
+    with opener('r')(mutefname) as mutefile:
+        reader = csv.DictReader(mutefile)
+        for line in reader:
+            pos = int(line['position'])
+            freq = float(line['mute_freq'])
+            lo_err = float(line['lo_err'])  # NOTE lo_err in the file is really the lower *bound*
+            hi_err = float(line['hi_err'])  #   same deal
+            assert freq >= 0.0 and lo_err >= 0.0 and hi_err >= 0.0  # you just can't be too careful
+            rows.append((pos, freq, lo_err, hi_err, {n : int(line[n + '_obs']) for n in utils.nukes}))
+    return rows
+
+# ----------------------------------------------------------------------------------------
+def combine_mute_info(rows_list):
+    """ combine the mute freq info from the rows (from read_mute_rows()) for each gene in <rows_list> """
     observed_freqs, observed_counts = {}, {}
     total_counts = 0
     # add an observation for each position, for each gene where we observed that position
-    for gene in approved_genes:
-        mutefname = indir + '/mute-freqs/' + utils.sanitize_name(gene) + '.csv'
-        if not os.path.exists(mutefname):
+    for rows in rows_list:
+        if rows is None:
             continue
-        with opener('r')(mutefname) as mutefile:
-            reader = csv.DictReader(mutefile)
-            for line in reader:
-                pos = int(line['position'])
-                freq = float(line['mute_freq'])
-                lo_err = float(line['lo_err'])  # NOTE lo_err in the file is really the lower *bound*
-                hi_err = float(line['hi_err'])  #   same deal
-                assert freq >= 0.0 and lo_err >= 0.0 and hi_err >= 0.0  # you just can't be too careful
-                if freq < utils.eps or abs(1.0 - freq) < utils.eps:  # if <freq> too close to 0 or 1, replace it with the midpoint of its uncertainty band
-                    freq = 0.5 * (lo_err + hi_err)
-                if pos not in observed_freqs:
-                    observed_freqs[pos] = []
-                    observed_counts[pos] = {n : 0 for n in utils.nukes}
-                observed_freqs[pos].append({'freq':freq, 'err':max(abs(freq-lo_err), abs(freq-hi_err))})
-                for nuke in utils.nukes:
-                    observed_counts[pos][nuke] += int(line[nuke + '_obs'])
-                total_counts += int(line[nuke + '_obs'])
+        for pos, freq, lo_err, hi_err, obs in rows:
+            if freq < utils.eps or abs(1.0 - freq) < utils.eps:  # if <freq> too close to 0 or 1, replace it with the midpoint of its uncertainty band
+                freq = 0.5 * (lo_err + hi_err)
+            if pos not in observed_freqs:
+                observed_freqs[pos] = []
+                observed_counts[pos] = {n : 0 for n in utils.nukes}
+            observed_freqs[pos].append({'freq':freq, 'err':max(abs(freq-lo_err), abs(freq-hi_err))})
+            for nuke in utils.nukes:
+                observed_counts[pos][nuke] += obs[nuke]
+            total_counts += obs[nuke]
 
     # set final mute_freqs[pos] to the (inverse error-weighted) average over all the observations for each position
     mute_freqs = {}
@@ -7,6 +7,7 @@ import glob
 import csv
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
+import heapq
 from collections import OrderedDict
 from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
 import copy
@@ -16,11 +17,16 @@ from Bio import SeqIO
 import utils
 import glutils
 from opener import opener
-from seqfileopener import get_seqfile_info
+from seqfileopener import read_seqfile
 from glomerator import Glomerator
 from clusterpath import ClusterPath
+from bcrhamworkers import BcrhamWorkerPool
+from cachestore import CacheStore, is_cachestore_fname
+import columnar
+from uidregistry import registry
 from waterer import Waterer
 from parametercounter import ParameterCounter
+from parameterset import ParameterSet
 from performanceplotter import PerformancePlotter
 from hist import Hist
 
@@ -36,21 +42,26 @@ class PartitionDriver(object):
         glutils.write_glfo(self.my_datadir, self.glfo)  # need a copy on disk for vdjalign and bcrham (note that what we write to <self.my_datadir> in general differs from what's in <initial_datadir>)
 
         self.input_info, self.reco_info = None, None
+        self.input_stream = None  # queries from --infname that we haven't read yet
+        self.seq_representatives = {}  # with --collapse-duplicate-sequences, the query we're using for each sequence (any others with the same sequence go in its input info's 'duplicates')
+        self.duplicate_info, self.duplicate_reco_info = OrderedDict(), OrderedDict()  # input (and, for simulation, reco) info for the duplicate queries, which aren't in <self.input_info> or <self.reco_info>
         if self.args.infname is not None:
-            self.input_info, self.reco_info = get_seqfile_info(self.args.infname, self.args.is_data, self.glfo, self.args.n_max_queries, self.args.queries, self.args.reco_ids,
-                                                               name_column=self.args.name_column, seq_column=self.args.seq_column, seed_unique_id=self.args.seed_unique_id,
-                                                               abbreviate_names=self.args.abbreviate)
-            if len(self.input_info) > 1000:
-                if self.args.n_procs == 1:
-                    print '  note:! running on %d sequences spread over %d processes. This will be kinda slow, so it might be a good idea to set --n-procs N to the number of processors on your local machine, or look into non-local parallelization with --slurm.\n' % (len(self.input_info), self.args.n_procs)
-                if self.args.outfname is None and self.current_action != 'cache-parameters':
-                    print '  note: running on a lot of sequences without setting --outfname. Which is ok! But there\'ll be no persistent record of the results'
+            self.input_info = OrderedDict()
+            self.reco_info = None if self.args.is_data else OrderedDict()
+            self.input_stream = read_seqfile(self.args.infname, self.args.is_data, self.glfo, self.args.n_max_queries, self.args.queries, self.args.reco_ids,
+                                             name_column=self.args.name_column, seq_column=self.args.seq_column, seed_unique_id=self.args.seed_unique_id,
+                                             abbreviate_names=self.args.abbreviate)
+            if self.current_action not in ('cache-parameters', 'run-viterbi', 'run-forward', 'partition') or self.args.persistent_cachefname is not None:  # otherwise the first thing we do is smith-waterman, which reads the queries as it goes
+                self.read_input()
         elif self.current_action != 'view-annotations' and self.current_action != 'view-partitions':
             raise Exception('--infname is required for action \'%s\'' % args.action)
 
         self.sw_info = None
         self.bcrham_proc_info = None
+        self.hmm_step_time = None  # wall time of the most recent run_hmm()
+        self.predicted_proc_costs = None  # estimated cost of each process's input from split_input(), to compare to what they actually took
         self.bcrham_failed_queries = set()
+        self.bcrham_pool = None  # only used with --persistent-bcrham-workers
 
         self.unseeded_clusters = set()  # all the queries that we *didn't* cluster with the seed uid
         self.time_to_remove_unseeded_clusters = False
@@ -82,10 +93,17 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def __del__(self):
+        if self.bcrham_pool is not None:
+            self.bcrham_pool.close()
         glutils.remove_glfo_files(self.my_datadir, self.args.chain)
 
         # merge persistent and current cache files into the persistent cache file
-        if self.args.persistent_cachefname is not None:
+        if self.args.persistent_cachefname is not None and is_cachestore_fname(self.args.persistent_cachefname):
+            store = CacheStore(self.args.persistent_cachefname, self.partition_cachefile_headers)
+            n_lines = store.add_from_csv(self.hmm_cachefname)
+            print '  added %d cache lines to %s (now %d clusters)' % (n_lines, self.args.persistent_cachefname, len(store))
+            store.close()
+        elif self.args.persistent_cachefname is not None:
             lockfname = self.args.persistent_cachefname + '.lock'
             while os.path.exists(lockfname):
                 print '  waiting for lock on %s' % lockfname
@@ -104,11 +122,94 @@ class PartitionDriver(object):
         except OSError:
             raise Exception('workdir (%s) not empty: %s' % (self.args.workdir, ' '.join(os.listdir(self.args.workdir))))  # hm... you get weird recursive exceptions if you get here. Oh, well, it still works
 
+    # ----------------------------------------------------------------------------------------
+    def stream_input(self):
+        """ yield the ids of queries from --infname as we read them (adding them to <self.input_info> and <self.reco_info>), so smith-waterman can get started on the first ones while we're still reading the rest """
+        if self.input_stream is None:
+            return
+        for unique_id, input_line, reco_line in self.input_stream:
+            registry.get_index(unique_id)  # give each query its integer index in the order we read them (partitions are stored as arrays of these)
+            if self.args.collapse_duplicate_sequences:
+                representative = self.seq_representatives.get(input_line['seq'])
+                if representative is not None and unique_id != self.args.seed_unique_id:  # only run on the first query with each sequence (but always keep the seed)
+                    self.input_info[representative]['duplicates'].append(unique_id)
+                    self.duplicate_info[unique_id] = input_line
+                    if self.reco_info is not None:
+                        self.duplicate_reco_info[unique_id] = reco_line
+                    continue
+                self.seq_representatives[input_line['seq']] = unique_id
+                input_line['duplicates'] = []
+            self.input_info[unique_id] = input_line
+            if self.reco_info is not None:
+                self.reco_info[unique_id] = reco_line
+            yield unique_id
+        self.input_stream = None
+        self.seq_representatives = {}
+
+        if self.args.collapse_duplicate_sequences:
+            print '  collapsed %d duplicate %s into %d unique ones' % (len(self.duplicate_info), utils.plural_str('sequence', len(self.duplicate_info)), len(self.input_info))
+
+        if len(self.input_info) > 1000:
+            if self.args.n_procs == 1:
+                print '  note:! running on %d sequences spread over %d processes. This will be kinda slow, so it might be a good idea to set --n-procs N to the number of processors on your local machine, or look into non-local parallelization with --slurm.\n' % (len(self.input_info), self.args.n_procs)
+            if self.args.outfname is None and self.current_action != 'cache-parameters':
+                print '  note: running on a lot of sequences without setting --outfname. Which is ok! But there\'ll be no persistent record of the results'
+
+    # ----------------------------------------------------------------------------------------
+    def read_input(self):
+        """ read all the queries from --infname that we haven't read yet """
+        for _ in self.stream_input():
+            pass
+
+    # ----------------------------------------------------------------------------------------
+    def get_duplicates(self, uid):
+        """ queries with the same sequence as <uid> that we collapsed into it (empty unless --collapse-duplicate-sequences) """
+        return self.input_info[uid].get('duplicates', []) if uid in self.input_info else []
+
+    # ----------------------------------------------------------------------------------------
+    def get_full_reco_info(self):
+        """ reco info including any duplicate queries """
+        if self.reco_info is None or len(self.duplicate_reco_info) == 0:
+            return self.reco_info
+        return OrderedDict(self.reco_info.items() + self.duplicate_reco_info.items())
+
+    # ----------------------------------------------------------------------------------------
+    def expand_duplicates(self, line):
+        """ return a copy of annotation <line> in which each query is followed by its duplicates, which get copies of all its per-sequence info """
+        uids = line['unique_ids']
+        if sum([len(self.get_duplicates(uid)) for uid in uids]) == 0:
+            return line
+        iseqs = [iseq for iseq in range(len(uids)) for _ in range(1 + len(self.get_duplicates(uids[iseq])))]  # index in the original line of each query in the new one
+        expanded_line = copy.deepcopy(line)
+        for column in [c for c in utils.xcolumns['multi_per_seq'] + ('padlefts', 'padrights') if c in line and line[c] is not None and len(line[c]) == len(uids)]:
+            expanded_line[column] = [copy.deepcopy(line[column][iseq]) for iseq in iseqs]
+        expanded_line['unique_ids'] = [uid for iseq in range(len(uids)) for uid in [uids[iseq], ] + self.get_duplicates(uids[iseq])]
+        return expanded_line
+
+    # ----------------------------------------------------------------------------------------
+    def expand_duplicates_in_partitions(self, cpath):
+        """ return a copy of <cpath> in which each cluster also includes the duplicates of each of its queries """
+        if len(self.duplicate_info) == 0:
+            return cpath
+        expanded_cpath = ClusterPath(initial_path_index=cpath.initial_path_index, seed_unique_id=cpath.seed_unique_id)
+        for ipart in range(len(cpath.partitions)):
+            partition = [[uid for quid in cluster for uid in [quid, ] + self.get_duplicates(quid)] for cluster in cpath.partitions[ipart]]
+            expanded_cpath.add_partition(partition, cpath.logprobs[ipart], cpath.n_procs[ipart], logweight=cpath.logweights[ipart])  # ccfs have to be recalculated with the duplicates included
+        return expanded_cpath
+
     # ----------------------------------------------------------------------------------------
     def deal_with_persistent_cachefile(self):
         if self.args.persistent_cachefname is None or not os.path.exists(self.args.persistent_cachefname):  # nothin' to do (ham'll initialize it)
             return
 
+        if is_cachestore_fname(self.args.persistent_cachefname):
+            store = CacheStore(self.args.persistent_cachefname, self.partition_cachefile_headers)
+            queries = None if self.input_info is None else self.input_info.keys()
+            n_written = store.write_csv(self.hmm_cachefname, queries=queries)
+            print '  read %d (of %d) cached clusters from %s' % (n_written, len(store), self.args.persistent_cachefname)
+            store.close()
+            return
+
         with open(self.args.persistent_cachefname) as cachefile:
             reader = csv.DictReader(cachefile)
             if set(reader.fieldnames) == set(self.annotation_headers):
@@ -148,7 +249,8 @@ class PartitionDriver(object):
             if len(expected_genes - genes_with_hmms) > 0:
                 print '  %s genes %s in glfo that don\'t have yamels in %s' % (utils.color('red', 'warning'), ' '.join(expected_genes - genes_with_hmms), parameter_dir)
 
-        waterer = Waterer(self.args, self.input_info, self.reco_info, self.glfo, self.my_datadir, parameter_dir, write_parameters=write_parameters, find_new_alleles=find_new_alleles)
+        waterer = Waterer(self.args, self.input_info, self.reco_info, self.glfo, self.my_datadir, parameter_dir, write_parameters=write_parameters, find_new_alleles=find_new_alleles,
+                          input_stream=self.stream_input() if self.input_stream is not None else None, duplicate_reco_info=self.duplicate_reco_info)
         waterer.run()
         self.sw_info = waterer.info
         print '        water time: %.1f' % (time.time()-start)
@@ -222,18 +324,19 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def view_existing_annotations(self):
-        with open(self.args.outfname) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for line in reader:
-                if line['v_gene'] == '':
-                    print '   %s failed' % line['unique_ids']
-                    continue
-                utils.process_input_line(line)
-                if self.args.infname is not None and self.reco_info is not None:
-                    utils.print_true_events(self.glfo, self.reco_info, line)
-                utils.add_implicit_info(self.glfo, line, multi_seq=True, existing_implicit_keys=('aligned_d_seqs', 'aligned_j_seqs', 'aligned_v_seqs', 'cdr3_length', 'naive_seq', 'in_frames', 'mutated_invariants', 'stops'))
-                print '    inferred:\n'
-                utils.print_reco_event(self.glfo['seqs'], line)
+        if columnar.is_columnar_fname(self.args.outfname):
+            lines = columnar.read_rows(self.args.outfname)
+        else:
+            lines = utils.read_typed_csv(self.args.outfname)
+        for line in lines:
+            if line['v_gene'] in ('', None):
+                print '   %s failed' % ':'.join(line['unique_ids'])
+                continue
+            if self.args.infname is not None and self.reco_info is not None:
+                utils.print_true_events(self.glfo, self.reco_info, line)
+            utils.add_implicit_info(self.glfo, line, multi_seq=True, existing_implicit_keys=('aligned_d_seqs', 'aligned_j_seqs', 'aligned_v_seqs', 'cdr3_length', 'naive_seq', 'in_frames', 'mutated_invariants', 'stops'))
+            print '    inferred:\n'
+            utils.print_reco_event(self.glfo['seqs'], line)
 
     # ----------------------------------------------------------------------------------------
     def view_existing_partitions(self):
@@ -261,12 +364,13 @@ class PartitionDriver(object):
         n_proc_list = []
         start = time.time()
         while n_procs > 0:
-            print '--> %d clusters with %d procs' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs)  # write_hmm_input uses the best-minus-ten partition
+            n_clusters = len(cpath.partitions[cpath.i_best_minus_x])  # write_hmm_input uses the best-minus-ten partition
+            print '--> %d clusters with %d procs' % (n_clusters, n_procs)
             cpath = self.run_hmm('forward', self.args.parameter_dir, n_procs=n_procs, cpath=cpath)
             n_proc_list.append(n_procs)
             if n_procs == 1:
                 break
-            n_procs = self.get_next_n_procs(n_procs, n_proc_list, cpath)
+            n_procs = self.get_next_n_procs(n_procs, n_proc_list, n_clusters, cpath)
 
         print '      loop time: %.1f' % (time.time()-start)
 
@@ -291,18 +395,40 @@ class PartitionDriver(object):
             self.write_clusterpaths(self.args.outfname, cpath)  # [last agglomeration step]
 
     # ----------------------------------------------------------------------------------------
-    def get_next_n_procs(self, n_procs, n_proc_list, cpath):
-        next_n_procs = n_procs
+    def get_next_n_procs(self, n_procs, n_proc_list, n_clusters_before, cpath):
+        """
+        Choose the number of processes for the next partition step from what we measured in the step we just ran (with <n_procs> processes on <n_clusters_before> clusters).
+        The calculations in each process go like the number of pairs of clusters it has, i.e. (n clusters / n procs)^2. Since clusters in different processes never get compared,
+        we want as few processes as we can keep busy: the most for which each process would still do at least --n-max-to-calc-per-process calculations, and would
+        spend at least as long calculating as the rest of the step (writing input, starting bcrham, reading output) takes.
+        """
+        min_factor, max_factor = 1.3, 3.  # when we reduce the number of procs, reduce by at least/at most this factor
+        min_merge_fraction = 0.05  # if fewer than this fraction of clusters merged, this number of procs has given us most of what it's going to
+        n_clusters = len(cpath.partitions[cpath.i_best_minus_x])
+        merge_fraction = 1. - float(n_clusters) / n_clusters_before
 
         n_calcd_per_process = self.get_n_calculated_per_process()
-        factor = 1.3
-
-        reduce_n_procs = False
-        if n_calcd_per_process < self.args.n_max_to_calc_per_process or n_proc_list.count(n_procs) > n_procs:  # if we didn't need to do that many calculations, or if we've already milked this number of procs for most of what it's worth
-            reduce_n_procs = True
-
-        if reduce_n_procs:
-            next_n_procs = int(next_n_procs / float(factor))
+        bcrham_times = [procinfo['time']['bcrham'] for procinfo in self.bcrham_proc_info]
+        mean_bcrham_time = sum(bcrham_times) / len(bcrham_times)
+        overhead_time = max(0., self.hmm_step_time - max(bcrham_times))
+        calcs_per_pair = n_calcd_per_process * (float(n_procs) / n_clusters_before)**2  # per-process calcs divided by (clusters per process)^2
+
+        bounds = {}
+        if calcs_per_pair > 0.:
+            bounds['calcs'] = n_clusters * math.sqrt(calcs_per_pair / self.args.n_max_to_calc_per_process)  # more procs than this and each would do fewer than --n-max-to-calc-per-process
+            if overhead_time > 0. and mean_bcrham_time > 0.:
+                secs_per_calc = mean_bcrham_time / n_calcd_per_process
+                bounds['time'] = n_clusters * math.sqrt(secs_per_calc * calcs_per_pair / overhead_time)  # more procs than this and each would spend less time calculating than the overhead
+        if len(bounds) > 0:
+            next_n_procs = int(min(bounds.values()))
+        else:  # no calculations, so no way to tell how many procs we could keep busy
+            next_n_procs = 0
+        next_n_procs = min(n_procs, max(next_n_procs, int(math.ceil(n_procs / max_factor))))
+        if next_n_procs == n_procs and merge_fraction < min_merge_fraction:  # could keep this many busy, but we've already milked it for most of what it's worth
+            next_n_procs = int(n_procs / min_factor)
+        next_n_procs = max(1, next_n_procs)
+        print '      next n procs %d  (merged %.2f of %d clusters, %.0f calcs and %.1fs per proc, %.1fs overhead%s)' % (next_n_procs, merge_fraction, n_clusters_before, n_calcd_per_process, mean_bcrham_time, overhead_time,
+                                                                                                                   ''.join(['  %s bound %.1f' % (k, v) for k, v in sorted(bounds.items())]))
 
         # time to remove unseeded clusters?
         if self.args.seed_unique_id is not None and (len(n_proc_list) > 2 or next_n_procs == 1):
@@ -366,17 +492,19 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def write_clusterpaths(self, outfname, cpath):
+        cpath = self.expand_duplicates_in_partitions(cpath)
+        reco_info = self.get_full_reco_info()
         outfile, writer = cpath.init_outfile(outfname, self.args.is_data)
         true_partition = None
         if not self.args.is_data:
-            true_partition = utils.get_true_partition(self.reco_info)
-        cpath.write_partitions(writer=writer, reco_info=self.reco_info, true_partition=true_partition, is_data=self.args.is_data, n_to_write=self.args.n_partitions_to_write, calc_missing_values='best')
+            true_partition = utils.get_true_partition(reco_info)
+        cpath.write_partitions(writer=writer, reco_info=reco_info, true_partition=true_partition, is_data=self.args.is_data, n_to_write=self.args.n_partitions_to_write, calc_missing_values='best')
         outfile.close()
 
         if self.args.presto_output:
             outstr = check_output(['mv', '-v', self.args.outfname, self.args.outfname + '.partis'])
             print '    backing up partis output before converting to presto: %s' % outstr.strip()
-            cpath.write_presto_partitions(self.args.outfname, self.input_info)
+            cpath.write_presto_partitions(self.args.outfname, OrderedDict(self.input_info.items() + self.duplicate_info.items()))
 
     # ----------------------------------------------------------------------------------------
     def cluster_with_naive_vsearch_or_swarm(self, parameter_dir):
@@ -577,8 +705,29 @@ class PartitionDriver(object):
     # ----------------------------------------------------------------------------------------
     def check_wait_times(self, wait_time):
         max_bcrham_time = max([procinfo['time']['bcrham'] for procinfo in self.bcrham_proc_info])
+        wall_times = [procinfo['time']['wall'] for procinfo in self.bcrham_proc_info]
+        if len(wall_times) > 1:
+            print '      per-proc wall time: min %.1f  mean %.1f  max %.1f' % (min(wall_times), sum(wall_times) / len(wall_times), max(wall_times))
         if max_bcrham_time > 0. and wait_time / max_bcrham_time > 1.5 and wait_time > 30.:  # if we were waiting for a lot longer than the slowest process took, and if it took long enough for us to care
             print '    spent much longer waiting for bcrham (%.1fs) than bcrham reported taking (max per-proc time %.1fs)' % (wait_time, max_bcrham_time)
+        if self.predicted_proc_costs is not None and len(self.predicted_proc_costs) == len(self.bcrham_proc_info):
+            self.check_predicted_costs()
+        self.predicted_proc_costs = None
+
+    # ----------------------------------------------------------------------------------------
+    def check_predicted_costs(self):
+        """ compare the per-process costs that split_input() predicted to the bcrham times each process reported (converting cost to seconds using the overall ratio) """
+        bcrham_times = [procinfo['time']['bcrham'] for procinfo in self.bcrham_proc_info]
+        if sum(bcrham_times) == 0. or sum(self.predicted_proc_costs) == 0.:
+            return
+        secs_per_cost = sum(bcrham_times) / sum(self.predicted_proc_costs)
+        predicted_times = [secs_per_cost * cost for cost in self.predicted_proc_costs]
+        mean_time = sum(bcrham_times) / len(bcrham_times)
+        print '      predicted bcrham time: max/mean %.2f   observed: max/mean %.2f' % (max(predicted_times) / mean_time, max(bcrham_times) / mean_time)
+        if self.args.debug:
+            print '          iproc   predicted   observed'
+            for iproc in range(len(bcrham_times)):
+                print '          %3d      %7.1f    %7.1f' % (iproc, predicted_times[iproc], bcrham_times[iproc])
 
     # ----------------------------------------------------------------------------------------
     def execute(self, cmd_str, n_procs):
@@ -597,25 +746,20 @@ class PartitionDriver(object):
         sys.stdout.flush()
         start = time.time()
 
-        # start all the procs for the first time
-        procs, n_tries, = [], []
-        self.bcrham_proc_info = []
-        for iproc in range(n_procs):
-            # print get_cmd_str(iproc)
-            # sys.exit()
-            procs.append(utils.run_cmd(get_cmd_str(iproc), self.subworkdir(iproc, n_procs)))
-            n_tries.append(1)
-            self.bcrham_proc_info.append({})
-
-        # keep looping over the procs until they're all done
-        while procs.count(None) != len(procs):  # we set each proc to None when it finishes
+        self.bcrham_proc_info = [{} for _ in range(n_procs)]
+        if self.args.persistent_bcrham_workers and not (self.args.slurm or utils.auto_slurm(n_procs)):  # keep bcrham processes around between steps (only for local processes)
+            if self.bcrham_pool is None:
+                self.bcrham_pool = BcrhamWorkerPool(self.args.workdir)
+            batches = []
             for iproc in range(n_procs):
-                if procs[iproc] is None:  # already finished
-                    continue
-                if procs[iproc].poll() is not None:  # it's finished
-                    utils.finish_process(iproc, procs, n_tries, self.subworkdir(iproc, n_procs), get_outfname(iproc), get_cmd_str(iproc), self.bcrham_proc_info[iproc])
-            sys.stdout.flush()
-            time.sleep(1)
+                cachefname = self.hmm_cachefname.replace(self.args.workdir, self.subworkdir(iproc, n_procs)) if '--cachefile' in cmd_str.split() else None
+                batches.append((self.hmm_infname.replace(self.args.workdir, self.subworkdir(iproc, n_procs)), get_outfname(iproc), cachefname))
+            wall_times = self.bcrham_pool.run(cmd_str, batches, self.bcrham_proc_info)
+        else:
+            cmdfos = [{'cmd_str' : get_cmd_str(iproc), 'workdir' : self.subworkdir(iproc, n_procs), 'outfname' : get_outfname(iproc), 'info' : self.bcrham_proc_info[iproc]} for iproc in range(n_procs)]
+            wall_times = utils.run_cmds(cmdfos)
+        for iproc in range(n_procs):
+            self.bcrham_proc_info[iproc]['time']['wall'] = wall_times[iproc]
 
         print '      time waiting for bcrham: %.1f' % (time.time()-start)
         self.check_wait_times(time.time()-start)
@@ -646,7 +790,8 @@ class PartitionDriver(object):
         self.execute(cmd_str, n_procs)
 
         new_cpath = self.read_hmm_output(algorithm, n_procs, count_parameters, parameter_out_dir, precache_all_naive_seqs)
-        print '      hmm step time: %.1f' % (time.time()-start)
+        self.hmm_step_time = time.time()-start
+        print '      hmm step time: %.1f' % self.hmm_step_time
         return new_cpath
 
     # ----------------------------------------------------------------------------------------
@@ -720,6 +865,40 @@ class PartitionDriver(object):
                 raise Exception('zero-length naive sequence found for ' + str(query))
         return naive_seqs
 
+    # ----------------------------------------------------------------------------------------
+    def get_cluster_cost(self, line, cachefo):
+        """
+        Rough estimate of how much bcrham time the cluster in hmm input line <line> will take: each gene's trellis is about the sequence length times the
+        number of (k_v, k_d) combinations (the product of the sizes of the [min, max) ranges), and we need one for each sequence and each gene in only_genes.
+        If the cluster's already in the cache file we won't need to recalculate its own viterbi/forward, but it still takes part in merges (when partitioning).
+        """
+        n_seqs = len(line['names'].split(':'))
+        seq_len = float(sum([len(s) for s in line['seqs'].split(':')])) / n_seqs
+        n_genes = len(line['only_genes'].split(':'))
+        n_k = max(1, int(line['k_v_max']) - int(line['k_v_min'])) * max(1, int(line['k_d_max']) - int(line['k_d_min']))
+        cost = n_seqs * seq_len * n_genes * n_k
+        if line['names'] in cachefo:
+            cost *= 0.25
+        return cost
+
+    # ----------------------------------------------------------------------------------------
+    def divvy_by_cost(self, costs, initial_costs):
+        """
+        Assign each of <costs> to one of len(<initial_costs>) processes, such that the largest per-process total is about as small as possible (longest processing time first: take
+        the costs from largest to smallest, giving each to the process with the smallest total so far).
+        Returns the process index for each of <costs>, and the total cost for each process.
+        """
+        totals = list(initial_costs)
+        heap = [(totals[iproc], iproc) for iproc in range(len(totals))]
+        heapq.heapify(heap)
+        iprocs = [None for _ in costs]
+        for icost in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+            _, iproc = heapq.heappop(heap)
+            iprocs[icost] = iproc
+            totals[iproc] += costs[icost]
+            heapq.heappush(heap, (totals[iproc], iproc))
+        return iprocs, totals
+
     # ----------------------------------------------------------------------------------------
     def split_input(self, n_procs, infname):
 
@@ -767,27 +946,33 @@ class PartitionDriver(object):
             get_writer(sub_outfile).writeheader()
             sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
 
-        # self.get_expected_number_of_forward_calculations(info, 'names', 'seqs')  # I think this didn't work that well
-
-        seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
-        for iproc in range(n_procs):
-            sub_outfile = get_sub_outfile(iproc, 'a')
-            writer = get_writer(sub_outfile)
+        cachefo = self.read_cachefile()
 
-            # first deal with the seeded clusters
-            if separate_seeded_clusters:  # write the seed info line to each file
+        # first deal with the seeded clusters (write a seed info line to each file)
+        seed_lines = [[] for _ in range(n_procs)]
+        if separate_seeded_clusters:
+            seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
+            for iproc in range(n_procs):
                 if len(seed_clusters_to_write) > 0:
                     if iproc < n_procs - 1:  # if we're not on the last proc, pop off and write the first one
-                        writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                        seed_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                     else:
                         while len(seed_clusters_to_write) > 0:  # keep adding 'em until we run out
-                            writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                            seed_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                 else:  # if we don't have any more that we *need* to write (i.e. that have other seqs in them), just write the shortest one (which will frequently be a singleton)
-                    writer.writerow(seeded_clusters[smallest_seed_cluster_str])
+                    seed_lines[iproc].append(seeded_clusters[smallest_seed_cluster_str])
 
-            # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
+        # then divvy up the non-seeded clusters
+        initial_costs = [sum([self.get_cluster_cost(line, cachefo) for line in seed_lines[iproc]]) for iproc in range(n_procs)]
+        iprocs, self.predicted_proc_costs = self.divvy_by_cost([self.get_cluster_cost(line, cachefo) for line in info], initial_costs)
+
+        for iproc in range(n_procs):
+            sub_outfile = get_sub_outfile(iproc, 'a')
+            writer = get_writer(sub_outfile)
+            for line in seed_lines[iproc]:
+                writer.writerow(line)
+            for iquery in range(len(info)):  # keep the (shuffled) order from the single input file
+                if iprocs[iquery] != iproc:
                     continue
                 writer.writerow(info[iquery])
             sub_outfile.close()
@@ -894,15 +1079,39 @@ class PartitionDriver(object):
         print '  writing hmms',
         start = time.time()
 
-        from hmmwriter import HmmWriter
+        import hmmwriter
         hmm_dir = parameter_dir + '/hmms'
-        utils.prep_dir(hmm_dir, '*.yaml')
-
-        for region in utils.regions:
-            for gene in self.glfo['seqs'][region]:
-                writer = HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args)
+        utils.prep_dir(hmm_dir)
+
+        # only rewrite hmms whose inputs (germline seq, parameter file lines, etc.) have changed since we last wrote them
+        genes = [g for r in utils.regions for g in self.glfo['seqs'][r]]
+        for fname in glob.glob(hmm_dir + '/*.yaml'):  # remove hmms for genes that are no longer in the germline set
+            if utils.unsanitize_name(os.path.splitext(os.path.basename(fname))[0]) not in genes:
+                os.remove(fname)
+        hasher = hmmwriter.InputHasher(parameter_dir, self.glfo, self.args)
+        old_hashes = hmmwriter.read_input_hashes(hmm_dir)
+        new_hashes = {g : hasher.get_hash(g) for g in genes}
+        genes_to_write = [g for g in genes if new_hashes[g] != old_hashes.get(g) or not os.path.exists(hmm_dir + '/' + utils.sanitize_name(g) + '.yaml')]
+
+        n_procs = min(self.args.n_procs, multiprocessing.cpu_count(), len(genes_to_write))
+        if n_procs > 1:
+            pool = multiprocessing.Pool(n_procs, initializer=hmmwriter.init_worker, initargs=(parameter_dir, hmm_dir, self.glfo, self.args))
+            try:
+                pool.map(hmmwriter.write_gene_hmm, genes_to_write, chunksize=max(1, len(genes_to_write) / (4 * n_procs)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            pset = ParameterSet(parameter_dir)
+            for gene in genes_to_write:
+                writer = hmmwriter.HmmWriter(parameter_dir, hmm_dir, gene, self.glfo, self.args, pset=pset)
                 writer.write()
+        hmmwriter.write_input_hashes(hmm_dir, new_hashes)
 
+        print '(wrote %d, skipped %d unchanged)' % (len(genes_to_write), len(genes) - len(genes_to_write)),
         print '(%.1f sec)' % (time.time()-start)
 
     # ----------------------------------------------------------------------------------------
@@ -1165,6 +1374,79 @@ class PartitionDriver(object):
 
         os.remove(annotation_fname)
 
+    # ----------------------------------------------------------------------------------------
+    def process_annotation_line(self, padded_line, boundary_error_queries):
+        """ add implicit info, etc., to bcrham output line <padded_line>, returning the line we should use (or None) and its status: 'ok', 'failed' (bcrham failed), or 'invalid' """
+        failed = self.check_did_bcrham_fail(padded_line, boundary_error_queries)
+        if failed:
+            return None, 'failed'
+
+        uids = padded_line['unique_ids']
+        uidstr = ':'.join(uids)
+        padded_line['indelfos'] = [self.sw_info['indels'].get(uid, utils.get_empty_indel()) for uid in uids]
+
+        utils.add_implicit_info(self.glfo, padded_line, multi_seq=True, aligned_gl_seqs=self.aligned_gl_seqs)
+        utils.process_per_gene_support(padded_line)  # switch per-gene support from log space to normalized probabilities
+        if padded_line['invalid']:
+            if self.args.debug:
+                print '      %s padded line invalid' % uidstr
+                utils.print_reco_event(self.glfo['seqs'], padded_line, extra_str='    ', label='invalid:')
+            return None, 'invalid'
+
+        if len(uids) > 1:  # if there's more than one sequence, we need to use the padded line
+            line_to_use = padded_line
+        else:  # otherwise, the eroded line is kind of simpler to look at
+            # get a new dict in which we have edited the sequences to swap Ns on either end (after removing fv and jf insertions) for v_5p and j_3p deletions
+            eroded_line = utils.reset_effective_erosions_and_effective_insertions(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs)  #, padfo=self.sw_info)
+            if eroded_line['invalid']:  # not really sure why the eroded line is sometimes invalid when the padded line is not, but it's very rare and I don't really care, either
+                return None, 'invalid'
+            line_to_use = eroded_line
+
+        return line_to_use, 'ok'
+
+    # ----------------------------------------------------------------------------------------
+    def count_annotation_parameters(self, line_to_use, pcounter, true_pcounter):
+        """ NOTE each query counts once for each of its duplicates (if we collapsed any), and for single-sequence annotations (i.e. when caching parameters) so do the per-family parameters """
+        uids = line_to_use['unique_ids']
+        family_uids = [uids[0], ] + (self.get_duplicates(uids[0]) if len(uids) == 1 else [])  # NOTE doesn't matter which id you pass it, since they all have the same reco parameters
+        if pcounter is not None:
+            pcounter.increment_per_family_params(line_to_use, multiplicity=len(family_uids))
+        if true_pcounter is not None:
+            for uid in family_uids:
+                true_pcounter.increment_per_family_params(self.reco_info[uid] if uid in self.reco_info else self.duplicate_reco_info[uid])
+        for iseq in range(len(uids)):
+            if pcounter is not None:
+                pcounter.increment_per_sequence_params(utils.synthesize_single_seq_line(line_to_use, iseq), multiplicity=1 + len(self.get_duplicates(uids[iseq])))
+            if true_pcounter is not None:
+                true_pcounter.increment_per_sequence_params(self.reco_info[uids[iseq]])
+                for uid in self.get_duplicates(uids[iseq]):
+                    true_pcounter.increment_per_sequence_params(self.duplicate_reco_info[uid])
+
+    # ----------------------------------------------------------------------------------------
+    def deal_with_annotation(self, line_to_use, annotations, outfo, perfplotter):
+        """ everything we do with each (valid) annotation from read_annotation_output(), apart from counting parameters """
+        uids = line_to_use['unique_ids']
+        uidstr = ':'.join(uids)
+        if self.args.debug:
+            print '      %s' % uidstr
+            if not self.args.is_data:
+                print '   %d' % utils.from_same_event(self.reco_info, uids),
+            print ''
+            self.print_hmm_output(line_to_use, print_true=True)
+
+        if annotations is not None:
+            assert uidstr not in annotations
+            annotations[uidstr] = line_to_use
+        if outfo is not None:
+            self.write_annotation(outfo, line_to_use)
+
+        if perfplotter is not None:
+            for iseq in range(len(uids)):
+                if uids[iseq] in self.sw_info['indels']:
+                    print '    skipping performance evaluation of %s because of indels' % uids[iseq]  # I just have no idea how to handle naive hamming fraction when there's indels
+                else:
+                    perfplotter.evaluate(self.reco_info[uids[iseq]], utils.synthesize_single_seq_line(line_to_use, iseq), self.sw_info[uids[iseq]]['padded'])
+
     # ----------------------------------------------------------------------------------------
     def read_annotation_output(self, annotation_fname, outfname=None, count_parameters=False, parameter_out_dir=None):
         """ Read bcrham annotation output """
@@ -1175,72 +1457,53 @@ class PartitionDriver(object):
         true_pcounter = ParameterCounter(self.glfo, self.args) if (count_parameters and not self.args.is_data) else None
         perfplotter = PerformancePlotter(self.glfo, 'hmm') if self.args.plot_performance else None
 
-        n_lines_read, n_seqs_processed, n_events_processed, n_invalid_events = 0, 0, 0, 0
-        annotations = OrderedDict()
+        counts = {'n_lines_read' : 0, 'n_seqs_processed' : 0, 'n_events_processed' : 0, 'n_invalid_events' : 0}
+        annotations = OrderedDict() if self.args.annotation_clustering is not None else None  # we only keep all the annotations in memory if we need them for annotation clustering
+        outfo = self.open_annotation_output(outfname) if outfname is not None else None
         boundary_error_queries = []
-        with opener('r')(annotation_fname) as hmm_csv_outfile:
-            reader = csv.DictReader(hmm_csv_outfile)
-            for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
-
-                utils.process_input_line(padded_line)
-                n_lines_read += 1
 
-                failed = self.check_did_bcrham_fail(padded_line, boundary_error_queries)
-                if failed:
+        def process_lines(padded_lines, pcounter, true_pcounter, boundary_error_queries, counts):
+            """ process, and count parameters for, each of <padded_lines> (N-padded such that all the seqs are the same length), yielding the valid ones """
+            for padded_line in padded_lines:
+                counts['n_lines_read'] += 1
+                line_to_use, status = self.process_annotation_line(padded_line, boundary_error_queries)
+                if status == 'invalid':
+                    counts['n_invalid_events'] += 1
+                if status != 'ok':
                     continue
+                self.count_annotation_parameters(line_to_use, pcounter, true_pcounter)
+                counts['n_events_processed'] += 1
+                counts['n_seqs_processed'] += len(line_to_use['unique_ids'])
+                yield line_to_use
 
-                uids = padded_line['unique_ids']
-                uidstr = ':'.join(uids)
-                padded_line['indelfos'] = [self.sw_info['indels'].get(uid, utils.get_empty_indel()) for uid in uids]
-
-                utils.add_implicit_info(self.glfo, padded_line, multi_seq=True, aligned_gl_seqs=self.aligned_gl_seqs)
-                utils.process_per_gene_support(padded_line)  # switch per-gene support from log space to normalized probabilities
-                if padded_line['invalid']:
-                    n_invalid_events += 1
-                    if self.args.debug:
-                        print '      %s padded line invalid' % uidstr
-                        utils.print_reco_event(self.glfo['seqs'], padded_line, extra_str='    ', label='invalid:')
-                    continue
-
-                if len(uids) > 1:  # if there's more than one sequence, we need to use the padded line
-                    line_to_use = padded_line
-                else:  # otherwise, the eroded line is kind of simpler to look at
-                    # get a new dict in which we have edited the sequences to swap Ns on either end (after removing fv and jf insertions) for v_5p and j_3p deletions
-                    eroded_line = utils.reset_effective_erosions_and_effective_insertions(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs)  #, padfo=self.sw_info)
-                    if eroded_line['invalid']:  # not really sure why the eroded line is sometimes invalid when the padded line is not, but it's very rare and I don't really care, either
-                        n_invalid_events += 1
-                        continue
-                    line_to_use = eroded_line
-
-                if self.args.debug:
-                    print '      %s' % uidstr
-                    if not self.args.is_data:
-                        print '   %d' % utils.from_same_event(self.reco_info, uids),
-                    print ''
-                    self.print_hmm_output(line_to_use, print_true=True)
-
-                assert uidstr not in annotations
-                annotations[uidstr] = line_to_use
-
-                n_events_processed += 1
-
-                if pcounter is not None:
-                    pcounter.increment_per_family_params(line_to_use)
-                if true_pcounter is not None:
-                    true_pcounter.increment_per_family_params(self.reco_info[uids[0]])  # NOTE doesn't matter which id you pass it, since they all have the same reco parameters
-
-                for iseq in range(len(uids)):
-                    singlefo = utils.synthesize_single_seq_line(line_to_use, iseq)
-                    if pcounter is not None:
-                        pcounter.increment_per_sequence_params(singlefo)
-                    if true_pcounter is not None:
-                        true_pcounter.increment_per_sequence_params(self.reco_info[uids[iseq]])
-                    if perfplotter is not None:
-                        if uids[iseq] in self.sw_info['indels']:
-                            print '    skipping performance evaluation of %s because of indels' % uids[iseq]  # I just have no idea how to handle naive hamming fraction when there's indels
-                        else:
-                            perfplotter.evaluate(self.reco_info[uids[iseq]], singlefo, self.sw_info[uids[iseq]]['padded'])
-                    n_seqs_processed += 1
+        n_count_procs = min(self.args.n_procs, multiprocessing.cpu_count())
+        with opener('r')(annotation_fname) as hmm_csv_outfile:
+            if count_parameters and n_count_procs > 1 and not self.args.debug:  # process and count the lines in shards in <n_count_procs> worker processes (everything else happens here, in order, so the results are the same as in serial)
+                keep_lines = annotations is not None or outfo is not None or perfplotter is not None
+                headerstr = hmm_csv_outfile.readline()
+                def process_shard(shard):
+                    shardfo = {'pcounter' : ParameterCounter(self.glfo, self.args) if pcounter is not None else None,
+                               'true_pcounter' : ParameterCounter(self.glfo, self.args) if true_pcounter is not None else None,
+                               'boundary_error_queries' : [], 'counts' : {k : 0 for k in counts}}
+                    lines = process_lines(utils.typed_csv_reader([headerstr, ] + shard), shardfo['pcounter'], shardfo['true_pcounter'], shardfo['boundary_error_queries'], shardfo['counts'])
+                    shardfo['lines'] = [line_to_use for line_to_use in lines if keep_lines]  # (still have to run through the lines even if we don't keep them)
+                    shardfo['bcrham_failed_queries'] = self.bcrham_failed_queries  # (in the worker process, so only the ones we added above, plus any that were already there)
+                    return shardfo
+                shard_size = 1000 if keep_lines else 5000  # if we're sending back the lines, use smaller shards, so we don't have too many in memory at once
+                for shardfo in utils.map_shards(process_shard, utils.iter_shards(hmm_csv_outfile, shard_size), n_count_procs):  # NOTE assumes no newlines within csv fields (true for bcrham output)
+                    for counter, partial_counter in ((pcounter, shardfo['pcounter']), (true_pcounter, shardfo['true_pcounter'])):
+                        if counter is not None:
+                            counter.merge(partial_counter)
+                    self.bcrham_failed_queries |= shardfo['bcrham_failed_queries']
+                    boundary_error_queries += shardfo['boundary_error_queries']
+                    for key in counts:
+                        counts[key] += shardfo['counts'][key]
+                    if keep_lines:
+                        for line_to_use in shardfo['lines']:
+                            self.deal_with_annotation(line_to_use, annotations, outfo, perfplotter)
+            else:
+                for line_to_use in process_lines(utils.typed_csv_reader(hmm_csv_outfile), pcounter, true_pcounter, boundary_error_queries, counts):
+                    self.deal_with_annotation(line_to_use, annotations, outfo, perfplotter)
 
         # parameter and performance writing/plotting
         if pcounter is not None:
@@ -1254,9 +1517,9 @@ class PartitionDriver(object):
         if perfplotter is not None:
             perfplotter.plot(self.args.plotdir + '/hmm', only_csv=self.args.only_csv_plots)
 
-        print '        %d lines:  processed %d sequences in %d events' % (n_lines_read, n_seqs_processed, n_events_processed)
-        if n_invalid_events > 0:
-            print '          %s skipped %d invalid events' % (utils.color('red', 'warning'), n_invalid_events),
+        print '        %d lines:  processed %d sequences in %d events' % (counts['n_lines_read'], counts['n_seqs_processed'], counts['n_events_processed'])
+        if counts['n_invalid_events'] > 0:
+            print '          %s skipped %d invalid events' % (utils.color('red', 'warning'), counts['n_invalid_events']),
         print ''
         if len(self.bcrham_failed_queries) > 0:
             print '          %s no valid paths: %s' % (utils.color('red', 'warning'), ':'.join(self.bcrham_failed_queries))
@@ -1265,9 +1528,9 @@ class PartitionDriver(object):
             if self.args.debug:
                 print '                %s' % ', '.join(boundary_error_queries)
 
-        # write output file
-        if outfname is not None:
-            self.write_annotations(annotations, outfname)  # [0] takes the best annotation... if people want other ones later it's easy to change
+        # finish output file
+        if outfo is not None:
+            self.close_annotation_output(outfo)
 
         # annotation (VJ CDR3) clustering
         if self.args.annotation_clustering is not None:
@@ -1294,7 +1557,7 @@ class PartitionDriver(object):
         for uidstr, line in annotations.items():
             if len(line['seqs']) > 1:
                 raise Exception('can\'t handle multiple seqs')
-            annotations_for_vollmers[uidstr] = utils.synthesize_single_seq_line(line, iseq)
+            annotations_for_vollmers[uidstr] = utils.synthesize_single_seq_line(line, iseq=0)
 
         # perform annotation clustering for each threshold and write to file
         import annotationclustering
@@ -1331,59 +1594,69 @@ class PartitionDriver(object):
         print '   %4d%4d' % tuple([len(line[bound+'_insertion']) - len(true_line[bound+'_insertion']) for bound in utils.boundaries])
 
     # ----------------------------------------------------------------------------------------
-    def write_annotations(self, annotations, outfname):
+    def open_annotation_output(self, outfname):
+        """
+        Open <outfname> for annotation output, which we then write one line at a time with write_annotation() (so we don't need to keep all the annotations in memory), and finish with close_annotation_output().
+        With --presto-output, the partis-format output goes to <outfname>.partis, and the presto version to <outfname>.
+        """
         outpath = outfname
         if outpath[0] != '/':  # if full output path wasn't specified on the command line, write to current directory
             outpath = os.getcwd() + '/' + outpath
 
-        with open(outpath, 'w') as outfile:
-            writer = csv.DictWriter(outfile, self.annotation_headers)
+        outfo = {'missing_input_keys' : set(self.input_info.keys()), 'files' : {}, 'writers' : {}}  # <missing_input_keys> is all the keys we originially read from the file (so we can see if there's any that we're missing)
+        partis_outpath = outpath
+        if self.args.presto_output:
+            partis_outpath = outpath + '.partis'
+            print '    writing partis output to %s before converting to presto' % partis_outpath
+        outfo['columnar'] = columnar.is_columnar_fname(partis_outpath)
+        if outfo['columnar']:
+            outfo['writers']['partis'] = columnar.ColumnarWriter(partis_outpath, self.annotation_headers)
+            outfo['files']['partis'] = outfo['writers']['partis']  # so it gets closed along with any other files
+        else:
+            outfo['files']['partis'] = open(partis_outpath, 'w')
+            outfo['writers']['partis'] = csv.DictWriter(outfo['files']['partis'], self.annotation_headers)
+        if self.args.presto_output:
+            outfo['files']['presto'] = open(outpath, 'w')
+            outfo['writers']['presto'] = csv.DictWriter(outfo['files']['presto'], utils.presto_headers.values())
+        for writer in outfo['writers'].values():
             writer.writeheader()
-            missing_input_keys = set(self.input_info.keys())  # all the keys we originially read from the file
-            for full_line in annotations.values():
-                outline = copy.deepcopy(full_line)  # in case we modify it
 
-                for uid in outline['unique_ids']:  # make a note that we have an annotation for these uids (so we can see if there's any that we're missing)
-                    missing_input_keys.remove(uid)
+        return outfo
 
-                outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
-                outline = {k : v for k, v in outline.items() if k in self.annotation_headers}  # remove the columns we don't want to output
-
-                writer.writerow(outline)
-
-            # and write empty lines for seqs that failed either in sw or the hmm
-            if len(missing_input_keys) > 0:
-                print 'missing %d input keys' % len(missing_input_keys)
-                for uid in missing_input_keys:
-                    col = 'unique_ids'
-                    writer.writerow({col : uid})
+    # ----------------------------------------------------------------------------------------
+    def write_annotation(self, outfo, full_line):
+        for uid in full_line['unique_ids']:  # make a note that we have an annotation for these uids
+            outfo['missing_input_keys'].remove(uid)
+        full_line = self.expand_duplicates(full_line)
 
-        if self.args.presto_output:
-            outstr = check_output(['mv', '-v', self.args.outfname, self.args.outfname + '.partis'])
-            print '    backing up partis output before converting to presto: %s' % outstr.strip()
+        if outfo['columnar']:  # columnar output keeps the python types, so no need to convert to strings
+            outline = {k : v for k, v in full_line.items() if k in self.annotation_headers}
+        else:
+            outline = copy.deepcopy(full_line)  # in case we modify it
+            outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
+            outline = {k : v for k, v in outline.items() if k in self.annotation_headers}  # remove the columns we don't want to output
+        outfo['writers']['partis'].writerow(outline)
 
+        if 'presto' in outfo['writers']:
             prestoheader = utils.presto_headers.values()
-            with open(outpath, 'w') as outfile:
-                writer = csv.DictWriter(outfile, prestoheader)
-                writer.writeheader()
-
-                for full_line in annotations.values():
-                    outline = copy.deepcopy(full_line)  # in case we modify it
+            outline = copy.deepcopy(full_line)
+            utils.remove_all_implicit_info(outline, multi_seq=True)
+            utils.add_implicit_info(self.glfo, outline, multi_seq=True, aligned_gl_seqs=self.aligned_gl_seqs)
+            outline = utils.convert_to_presto_headers(outline, multi_seq=True)
+            outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
+            outline = {k : v for k, v in outline.items() if k in prestoheader}  # remove the columns we don't want to output
+            outfo['writers']['presto'].writerow(outline)
 
-                    utils.remove_all_implicit_info(outline, multi_seq=True)
-                    utils.add_implicit_info(self.glfo, outline, multi_seq=True, aligned_gl_seqs=self.aligned_gl_seqs)
-
-                    outline = utils.convert_to_presto_headers(outline, multi_seq=True)
-
-                    outline = utils.get_line_for_output(outline)  # convert lists to colon-separated strings and whatnot
-                    outline = {k : v for k, v in outline.items() if k in prestoheader}  # remove the columns we don't want to output
-
-                    writer.writerow(outline)
-
-                # and write empty lines for seqs that failed either in sw or the hmm
-                if len(missing_input_keys) > 0:  # NOTE assumes it's already been set by the first loop
-                    print 'missing %d input keys' % len(missing_input_keys)
-                    for uid in missing_input_keys:
-                        col = utils.presto_headers['unique_id']
-                        writer.writerow({col : uid})
+    # ----------------------------------------------------------------------------------------
+    def close_annotation_output(self, outfo):
+        # write empty lines for seqs that failed either in sw or the hmm
+        if len(outfo['missing_input_keys']) > 0:
+            print 'missing %d input keys' % len(outfo['missing_input_keys'])
+            for uid in [u for quid in outfo['missing_input_keys'] for u in [quid, ] + self.get_duplicates(quid)]:
+                outfo['writers']['partis'].writerow({'unique_ids' : [uid, ] if outfo['columnar'] else uid})
+                if 'presto' in outfo['writers']:
+                    outfo['writers']['presto'].writerow({utils.presto_headers['unique_id'] : uid})
+
+        for outfile in outfo['files'].values():
+            outfile.close()
 
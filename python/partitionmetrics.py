@@ -0,0 +1,172 @@
+""" partition accuracy metrics (ccfs, adjusted mutual information, cluster overlaps), calculated from arrays of integer cluster labels and contingency tables, so each partition takes time linear in the number of sequences """
+import math
+import numpy
+import scipy.sparse
+from scipy.special import gammaln
+
+from uidregistry import registry
+
+# ----------------------------------------------------------------------------------------
+def pack_partition(partition):
+    """ list of packed clusters (see uidregistry) for the clusters of uids in <partition> """
+    return [registry.pack_cluster(cluster) for cluster in partition]
+
+# ----------------------------------------------------------------------------------------
+def get_labels(packed_partition):
+    """ uid index, and cluster label (index in <packed_partition>), for each uid in each cluster. NOTE uids that are in more than one cluster appear more than once """
+    uids = numpy.frombuffer(''.join(packed_partition), dtype=numpy.intc)
+    sizes = numpy.array([len(pc) for pc in packed_partition], dtype=numpy.int64) // numpy.dtype(numpy.intc).itemsize
+    return uids, numpy.repeat(numpy.arange(len(packed_partition)), sizes)
+
+# ----------------------------------------------------------------------------------------
+def get_pair_counts(labels_a, labels_b):
+    """ for each element, the number of elements with the same pair of labels in <labels_a> and <labels_b> (i.e. its entry in the contingency table). Labels can be -1 """
+    keys = (labels_a.astype(numpy.int64) + 1) * (int(labels_b.max()) + 2) + (labels_b + 1)
+    _, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+    return counts[inverse]
+
+# ----------------------------------------------------------------------------------------
+def get_group_labels(groups):
+    """ array with the index of the group in <groups> (lists of uids, e.g. the true partition) that each uid index is in (-1 if it isn't in any), and the size of each group """
+    uids, labels = get_labels(pack_partition(groups))
+    lookup = numpy.full(len(registry), -1, dtype=numpy.int64)
+    lookup[uids] = labels
+    return lookup, numpy.bincount(labels, minlength=len(groups))
+
+# ----------------------------------------------------------------------------------------
+class RecoLabels(object):
+    """ integer label for the reco id of each uid index, filled in from <reco_info> as we need them """
+    def __init__(self, reco_info):
+        self.reco_info = reco_info
+        self.reco_id_labels = {}
+        self.labels = numpy.zeros(0, dtype=numpy.int64)
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, uids):
+        """ make sure we have labels for each of the uid indices <uids>, and return the full label array """
+        if len(self.labels) < len(registry):
+            self.labels = numpy.concatenate([self.labels, numpy.full(len(registry) - len(self.labels), -1, dtype=numpy.int64)])
+        for iuid in numpy.unique(uids[self.labels[uids] < 0]):
+            reco_id = self.reco_info[registry.uids[iuid]]['reco_id']
+            self.labels[iuid] = self.reco_id_labels.setdefault(reco_id, len(self.reco_id_labels))
+        return self.labels
+
+# ----------------------------------------------------------------------------------------
+def ccfs(packed_partition, scored_uids, true_labels, true_sizes, reco_labels):
+    """
+    Return (ccf_under, ccf_over) for <packed_partition>: the mean, over each uid index in <scored_uids>, of the fraction of its inferred cluster that's really clonal with it (has the same
+    label in <reco_labels>), and of the fraction of its true cluster (label in <true_labels>, with sizes <true_sizes>) that's in its inferred cluster.
+    NOTE if a uid is in more than one inferred cluster, we use the first one.
+    """
+    if len(scored_uids) == 0:
+        raise Exception('no uids to calculate ccfs for')
+    uids, cluster_labels = get_labels(packed_partition)
+    cluster_sizes = numpy.bincount(cluster_labels, minlength=len(packed_partition))
+    if (reco_labels[uids] < 0).any():
+        raise Exception('no reco id for %s' % registry.uids[uids[reco_labels[uids] < 0][0]])
+
+    unique_uids, first_occurrences, n_occurrences = numpy.unique(uids, return_index=True, return_counts=True)
+    iscored = numpy.minimum(numpy.searchsorted(unique_uids, scored_uids), len(unique_uids) - 1)
+    missing = unique_uids[iscored] != scored_uids
+    if missing.any():
+        raise Exception('%d true uids missing from partition (e.g. %s)' % (numpy.count_nonzero(missing), registry.uids[scored_uids[missing][0]]))
+    for iuid in scored_uids[n_occurrences[iscored] != 1]:
+        print 'WARNING %s in multiple clusters' % registry.uids[iuid]
+
+    occurrences = first_occurrences[iscored]  # where each scored uid's (first) inferred cluster is in <uids>
+    clonal_fractions = get_pair_counts(cluster_labels, reco_labels[uids])[occurrences] / cluster_sizes[cluster_labels[occurrences]].astype(numpy.float64)
+    fractions_present = get_pair_counts(cluster_labels, true_labels[uids])[occurrences] / true_sizes[true_labels[scored_uids]].astype(numpy.float64)
+    return float(clonal_fractions.mean()), float(fractions_present.mean())
+
+# ----------------------------------------------------------------------------------------
+def path_ccfs(packed_partitions, reco_info, seed_unique_id=None):
+    """
+    Yield (ccf_under, ccf_over) for each of <packed_partitions> (e.g. every partition in a cluster path), where each partition's true partition is the reco ids of its uids.
+    If <seed_unique_id> is set, only score the seed.
+    """
+    reco_labels = RecoLabels(reco_info)
+    for packed_partition in packed_partitions:
+        uids = numpy.unique(get_labels(packed_partition)[0])
+        labels = reco_labels.get(uids)
+        if seed_unique_id is None:
+            scored_uids = uids
+        else:
+            seed_index = registry.get_index(seed_unique_id)
+            scored_uids = uids[uids == seed_index]
+        yield ccfs(packed_partition, scored_uids, labels, numpy.bincount(labels[uids]), labels)
+
+# ----------------------------------------------------------------------------------------
+def partition_ccfs(partition, true_partition, reco_info, seed_unique_id=None):
+    """ (ccf_under, ccf_over) for the clusters of uids in <partition>, scoring each uid in <true_partition> (or only the seed, if <seed_unique_id> is set) """
+    packed_partition = pack_partition(partition)
+    true_labels, true_sizes = get_group_labels(true_partition)
+    reco_labels = RecoLabels(reco_info).get(numpy.unique(get_labels(packed_partition)[0]))
+    scored_uids = numpy.flatnonzero(true_labels >= 0)
+    if seed_unique_id is not None:
+        scored_uids = scored_uids[scored_uids == registry.get_index(seed_unique_id)]
+    return ccfs(packed_partition, scored_uids, true_labels, true_sizes, reco_labels)
+
+# ----------------------------------------------------------------------------------------
+def entropy(sizes):
+    n = float(sizes.sum())
+    return -numpy.sum(sizes / n * numpy.log(sizes / n))
+
+# ----------------------------------------------------------------------------------------
+def expected_mutual_information(sizes_a, sizes_b):
+    """ expected mutual information between two random partitions of the same elements with cluster sizes <sizes_a> and <sizes_b>. Only depends on the distinct sizes, so we loop over those """
+    n = int(sizes_a.sum())
+    a_vals, a_counts = numpy.unique(sizes_a, return_counts=True)
+    b_vals, b_counts = numpy.unique(sizes_b, return_counts=True)
+    emi = 0.
+    for a, a_count in zip(a_vals.tolist(), a_counts.tolist()):
+        for b, b_count in zip(b_vals.tolist(), b_counts.tolist()):
+            nij = numpy.arange(max(1, a + b - n), min(a, b) + 1, dtype=numpy.float64)  # possible sizes of the intersection
+            log_probs = gammaln(a + 1) + gammaln(b + 1) + gammaln(n - a + 1) + gammaln(n - b + 1) - gammaln(n + 1) - gammaln(nij + 1) - gammaln(a - nij + 1) - gammaln(b - nij + 1) - gammaln(n - a - b + nij + 1)  # hypergeometric
+            emi += a_count * b_count * numpy.sum(nij / n * (numpy.log(n * nij) - math.log(a * b)) * numpy.exp(log_probs))
+    return emi
+
+# ----------------------------------------------------------------------------------------
+def adjusted_mutual_information(labels_a, labels_b):
+    """ adjusted mutual information between two labelings (arrays of cluster labels) of the same elements, normalized (like sklearn) by the mean of the two entropies """
+    n = len(labels_a)
+    ia, ib = numpy.unique(labels_a, return_inverse=True)[1], numpy.unique(labels_b, return_inverse=True)[1]
+    sizes_a, sizes_b = numpy.bincount(ia), numpy.bincount(ib)
+    if len(sizes_a) == len(sizes_b) and len(sizes_a) in (1, n):  # both trivial, i.e. identical
+        return 1.
+    pair_keys, nij = numpy.unique(ia.astype(numpy.int64) * len(sizes_b) + ib, return_counts=True)  # nonzero entries in the contingency table
+    ai, bj = sizes_a[pair_keys // len(sizes_b)], sizes_b[pair_keys % len(sizes_b)]
+    mi = numpy.sum(nij / float(n) * (numpy.log(nij) + math.log(n) - numpy.log(ai) - numpy.log(bj)))
+    emi = expected_mutual_information(sizes_a, sizes_b)
+    denominator = 0.5 * (entropy(sizes_a) + entropy(sizes_b)) - emi
+    eps = numpy.finfo(numpy.float64).eps
+    denominator = min(denominator, -eps) if denominator < 0 else max(denominator, eps)
+    return float((mi - emi) / denominator)
+
+# ----------------------------------------------------------------------------------------
+def partition_adjusted_mutual_information(partition_a, partition_b):
+    """ adjusted mutual information between two partitions (lists of clusters of uids) of the same uids """
+    return adjusted_mutual_information(*get_partition_label_arrays(partition_a, partition_b))
+
+# ----------------------------------------------------------------------------------------
+def get_partition_label_arrays(partition_a, partition_b):
+    """ cluster label in each of <partition_a> and <partition_b> for each uid (which must be in both, and in only one cluster in each) """
+    uids_a, labels_a = get_labels(pack_partition(partition_a))
+    uids_b, labels_b = get_labels(pack_partition(partition_b))
+    for uids, name in ((uids_a, 'first'), (uids_b, 'second')):
+        if len(numpy.unique(uids)) != len(uids):
+            raise Exception('some uids are in more than one cluster in %s partition' % name)
+    order_a, order_b = numpy.argsort(uids_a), numpy.argsort(uids_b)
+    if len(uids_a) != len(uids_b) or (uids_a[order_a] != uids_b[order_b]).any():
+        raise Exception('partitions don\'t have the same uids')
+    return labels_a[order_a], labels_b[order_b]
+
+# ----------------------------------------------------------------------------------------
+def overlap_matrix(clusters_a, clusters_b):
+    """ array whose ij^th entry is the number of uids in <clusters_a>[i] that are also in <clusters_b>[j] """
+    uids_a, labels_a = get_labels(pack_partition(clusters_a))
+    uids_b, labels_b = get_labels(pack_partition(clusters_b))
+    n_uids = len(registry)
+    incidence_a = scipy.sparse.csr_matrix((numpy.ones(len(uids_a)), (uids_a, labels_a)), shape=(n_uids, len(clusters_a)))  # duplicates are summed, so this counts each time a uid appears in a cluster
+    incidence_b = scipy.sparse.csr_matrix((numpy.ones(len(uids_b)), (uids_b, labels_b)), shape=(n_uids, len(clusters_b)))
+    incidence_b.data[:] = 1.  # ...whereas for b we just want to know whether it's there
+    return numpy.rint((incidence_a.T * incidence_b).toarray()).astype(numpy.int64)
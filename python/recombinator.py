@@ -15,9 +15,9 @@ from Bio import SeqIO, Phylo
 import dendropy
 
 from opener import opener
-import paramutils
 import utils
 import glutils
+from parameterset import ParameterSet
 from event import RecombinationEvent
 
 #----------------------------------------------------------------------------------------
@@ -51,6 +51,7 @@ class Recombinator(object):
                 self.mute_models[region][model] = {}
 
         self.glfo = glutils.read_glfo(self.args.initial_datadir, self.args.chain, only_genes=self.args.only_genes)
+        self.pset = ParameterSet(parameter_dir)  # read each parameter file once, and then look things up in memory
 
         self.allowed_genes = self.get_allowed_genes(parameter_dir)  # set of genes a) for which we read per-position mutation information and b) from which we choose when running partially from scratch
         self.version_freq_table = self.read_vdj_version_freqs(parameter_dir)  # list of the probabilities with which each VDJ combo (plus other rearrangement parameters) appears in data
@@ -69,7 +70,7 @@ class Recombinator(object):
                 parameter_name = parameters[2]
                 assert model in self.mute_models[region]
                 self.mute_models[region][model][parameter_name] = line['value']
-        treegen = treegenerator.TreeGenerator(args, parameter_dir, seed=seed)
+        treegen = treegenerator.TreeGenerator(args, parameter_dir, seed=seed, pset=self.pset)
         self.treefname = self.workdir + '/trees.tre'
         treegen.generate_trees(seed, self.treefname)
         with opener('r')(self.treefname) as treefile:  # read in the trees (and other info) that we just generated
@@ -88,18 +89,13 @@ class Recombinator(object):
 
         insertion_content_probs = {}
         for bound in utils.boundaries:
-            insertion_content_probs[bound] = {}
-            with opener('r')(parameter_dir + '/' + bound + '_insertion_content.csv') as icfile:
-                reader = csv.DictReader(icfile)
-                total = 0
-                for line in reader:
-                    insertion_content_probs[bound][line[bound + '_insertion_content']] = int(line['count'])
-                    total += int(line['count'])
-                for nuke in utils.nukes:
-                    if nuke not in insertion_content_probs[bound]:
-                        print '    %s not in insertion content probs, adding with zero' % nuke
-                        insertion_content_probs[bound][nuke] = 0
-                    insertion_content_probs[bound][nuke] /= float(total)
+            insertion_content_probs[bound] = dict(self.pset.get_insertion_content(bound))
+            total = sum(insertion_content_probs[bound].values())
+            for nuke in utils.nukes:
+                if nuke not in insertion_content_probs[bound]:
+                    print '    %s not in insertion content probs, adding with zero' % nuke
+                    insertion_content_probs[bound][nuke] = 0
+                insertion_content_probs[bound][nuke] /= float(total)
 
             assert utils.is_normed(insertion_content_probs[bound])
 
@@ -115,14 +111,14 @@ class Recombinator(object):
     # ----------------------------------------------------------------------------------------
     def read_mute_freq_stuff(self, gene_or_insert_name):
         if gene_or_insert_name[:2] in utils.boundaries:
-            replacement_genes = utils.find_replacement_genes(self.parameter_dir, min_counts=-1, all_from_region='v')
-            self.all_mute_freqs[gene_or_insert_name], _ = paramutils.read_mute_info(self.parameter_dir, this_gene=gene_or_insert_name, approved_genes=replacement_genes)
+            replacement_genes = self.pset.find_replacement_genes(min_counts=-1, all_from_region='v')
+            self.all_mute_freqs[gene_or_insert_name], _ = self.pset.get_mute_info(this_gene=gene_or_insert_name, approved_genes=replacement_genes)
         else:
-            gene_counts = utils.read_overall_gene_probs(self.parameter_dir, only_gene=gene_or_insert_name, normalize=False, expect_zero_counts=True)
+            gene_counts = self.pset.get_gene_count(gene_or_insert_name, expect_zero_counts=True)
             replacement_genes = None
             if gene_counts < self.args.min_observations_to_write:  # if we didn't see it enough, average over all the genes that find_replacement_genes() gives us NOTE if <gene_or_insert_name> isn't in the dict, it's because it's <args.datadir> but not in the parameter dir UPDATE not using datadir like this any more, so previous statement may not be true
-                replacement_genes = utils.find_replacement_genes(self.parameter_dir, min_counts=self.args.min_observations_to_write, gene_name=gene_or_insert_name, single_gene=False)
-            self.all_mute_freqs[gene_or_insert_name], _ = paramutils.read_mute_info(self.parameter_dir, this_gene=gene_or_insert_name, approved_genes=replacement_genes)
+                replacement_genes = self.pset.find_replacement_genes(min_counts=self.args.min_observations_to_write, gene_name=gene_or_insert_name, single_gene=False)
+            self.all_mute_freqs[gene_or_insert_name], _ = self.pset.get_mute_info(this_gene=gene_or_insert_name, approved_genes=replacement_genes)
 
     # ----------------------------------------------------------------------------------------
     def combine(self, initial_irandom):
@@ -176,12 +172,7 @@ class Recombinator(object):
     def get_parameter_dir_genes(self, parameter_dir):
         parameter_dir_genes = set()
         for region in utils.regions:
-            col = region + '_gene'
-            column_and_deps = [col, ] + utils.column_dependencies[col]
-            with open(parameter_dir + '/' + utils.get_parameter_fname(column_and_deps=column_and_deps)) as infile:
-                reader = csv.DictReader(infile)
-                for line in reader:
-                    parameter_dir_genes.add(line[region + '_gene'])
+            parameter_dir_genes |= set(self.pset.get_genes(region))
         return parameter_dir_genes
 
     # ----------------------------------------------------------------------------------------
@@ -214,24 +205,22 @@ class Recombinator(object):
             return None
 
         version_freq_table = {}
-        with opener('r')(parameter_dir + '/' + utils.get_parameter_fname('all')) as infile:
-            in_data = csv.DictReader(infile)
-            total = 0.0
-            for line in in_data:  # NOTE do *not* assume the file is sorted
-                skip = False
-                for region in utils.regions:
-                    if line[region + '_gene'] not in self.allowed_genes[region]:
-                        skip = True
-                        break
-                if skip:
-                    continue
-                total += float(line['count'])
-                index = self.freqtable_index(line)
-                assert index not in version_freq_table
-                version_freq_table[index] = float(line['count'])
+        total = 0.0
+        for line in self.pset.read_lines(utils.get_parameter_fname('all')):  # NOTE do *not* assume the file is sorted
+            skip = False
+            for region in utils.regions:
+                if line[region + '_gene'] not in self.allowed_genes[region]:
+                    skip = True
+                    break
+            if skip:
+                continue
+            total += float(line['count'])
+            index = self.freqtable_index(line)
+            assert index not in version_freq_table
+            version_freq_table[index] = float(line['count'])
 
         if len(version_freq_table) == 0:
-            raise Exception('didn\'t find any gene combinations in %s' % fname)
+            raise Exception('didn\'t find any gene combinations in %s' % (parameter_dir + '/' + utils.get_parameter_fname('all')))
 
         # then normalize
         test_total = 0.0
@@ -1,13 +1,6 @@
-import bz2
-import gzip
-import copy
 import os
-import sys
 import csv
 from collections import OrderedDict
-import random
-import re
-from Bio import SeqIO
 import string
 import itertools
 
@@ -38,8 +31,58 @@ def abbreviate(used_names, potential_names, unique_id):
     return new_id
 
 # ----------------------------------------------------------------------------------------
-def get_seqfile_info(fname, is_data, glfo=None, n_max_queries=-1, queries=None, reco_ids=None, name_column=None, seq_column=None, seed_unique_id=None, abbreviate_names=False):
-    """ return list of sequence info from files of several types """
+def open_seqfile(fname):
+    """ return (open file, file type), where the type (csv, tsv, fasta, or fastq) comes from <fname>'s extension (ignoring any .gz or .bz2 compression suffix, which opener() takes care of) """
+    base, suffix = os.path.splitext(fname)
+    if suffix in ('.gz', '.bz2'):
+        suffix = os.path.splitext(base)[1]
+    ftypes = {'.csv' : 'csv', '.tsv' : 'tsv', '.fasta' : 'fasta', '.fa' : 'fasta', '.fastq' : 'fastq', '.fq' : 'fastq'}
+    if suffix not in ftypes:
+        raise Exception('couldn\'t handle file extension for %s' % fname)
+    return opener('r')(fname), ftypes[suffix]
+
+# ----------------------------------------------------------------------------------------
+def read_fasta(seqfile):
+    """ yield (name, seq) for each record in <seqfile>, where (like Bio.SeqIO) the name is the first word of the header line """
+    name, seqlines = None, []
+    for line in seqfile:
+        if line[0] == '>':
+            if name is not None:
+                yield name, ''.join(seqlines)
+            words = line[1:].split()
+            name, seqlines = words[0] if len(words) > 0 else '', []
+        elif name is not None:
+            seqlines.append(line.strip().replace(' ', ''))
+    if name is not None:
+        yield name, ''.join(seqlines)
+
+# ----------------------------------------------------------------------------------------
+def read_fastq(seqfile):
+    """ yield (name, seq) for each record in <seqfile> (sequence and quality can each be split over several lines) """
+    lines = (line.rstrip('\r\n') for line in seqfile)
+    for line in lines:
+        if line == '':
+            continue
+        if line[0] != '@':
+            raise Exception('expected fastq header beginning with \'@\' but got %s' % line)
+        words = line[1:].split()
+        name = words[0] if len(words) > 0 else ''
+        seq = ''
+        for line in lines:
+            if line[:1] == '+':
+                break
+            seq += line.strip()
+        n_qual = 0
+        while n_qual < len(seq):
+            n_qual += len(next(lines).strip())
+        yield name, seq
+
+# ----------------------------------------------------------------------------------------
+def read_seqfile(fname, is_data, glfo=None, n_max_queries=-1, queries=None, reco_ids=None, name_column=None, seq_column=None, seed_unique_id=None, abbreviate_names=False):
+    """
+    Generator version of get_seqfile_info(), which reads <fname> as it goes (rather than all at once).
+    Yields (unique_id, input info, reco info (None for data)) for each query we want. Raises the same exceptions as get_seqfile_info() if we don't find anything, or don't find the seed.
+    """
 
     # WARNING defaults for <name_column> and <seq_column> also set in partis (since we call this from places other than partis, but we also want people to be able set them from the partis command line)
     internal_name_column = 'unique_id'  # key we use in the internal dictionaries
@@ -48,102 +91,112 @@ def get_seqfile_info(fname, is_data, glfo=None, n_max_queries=-1, queries=None,
         name_column = internal_name_column
     if seq_column is None:
         seq_column = internal_seq_column
+    if queries is not None:
+        queries = set(queries)
+    if reco_ids is not None:
+        reco_ids = set(reco_ids)
 
     if not is_data and glfo is None:
         print '  WARNING glfo is None, so not adding implicit info'
 
-    suffix = os.path.splitext(fname)[1]
-    if len(re.findall('\.[ct]sv', suffix)) > 0:
-        if suffix == '.csv':
-            delimiter = ','
-        elif suffix == '.tsv':
-            delimiter = '\t'
-        else:
-            assert False
-        seqfile = opener('r')(fname)
-        reader = csv.DictReader(seqfile, delimiter=delimiter)
-    else:
-        if suffix == '.fasta' or suffix == '.fa':
-            ftype = 'fasta'
-        elif suffix == '.fastq' or suffix == '.fq':
-             ftype = 'fastq'
-        else:
-            raise Exception('couldn\'t handle file extension for %s' % fname)
-        reader = []
-        n_fasta_queries = 0
-        for seq_record in SeqIO.parse(fname, ftype):
-
-            # if command line specified query or reco ids, skip other ones (can't have/don't allow simulation info in a fast[aq])
-            if queries is not None and seq_record.name not in queries:
-                continue
+    seqfile, ftype = open_seqfile(fname)
+    if ftype in ('csv', 'tsv'):
+        reader = csv.DictReader(seqfile, delimiter=',' if ftype == 'csv' else '\t')
+    else:  # can't have/don't allow simulation info in a fast[aq]
+        read_fcn = read_fasta if ftype == 'fasta' else read_fastq
+        reader = ({name_column : name, seq_column : seq.upper()} for name, seq in read_fcn(seqfile))
 
-            reader.append({})
-            reader[-1][name_column] = seq_record.name
-            reader[-1][seq_column] = str(seq_record.seq).upper()
-            n_fasta_queries += 1
-            if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
-                break
-
-    input_info = OrderedDict()
-    reco_info = None
-    if not is_data:
-        reco_info = OrderedDict()
     n_queries = 0
+    found_ids = set()
     found_seed = False
     used_names = set()  # for abbreviating
     if abbreviate_names:
         potential_names = list(string.ascii_lowercase)
     iname = None  # line number -- used as sequence id if there isn't a <name_column>
-    for line in reader:
-        if seq_column not in line:
-            raise Exception('mandatory header \'%s\' not present in %s (you can set column names with --name-column and --seq-column)' % (seq_column, fname))
-        if name_column not in line and iname is None:
-            iname = 0
-        if name_column != internal_name_column or seq_column != internal_seq_column:
-            if iname is not None:
-                line[internal_name_column] = '%09d' % iname
-                iname += 1
-            translate_columns(line, {name_column : internal_name_column, seq_column: internal_seq_column})
-        utils.process_input_line(line)
-        unique_id = line[internal_name_column]
-        if any(fc in unique_id for fc in utils.forbidden_characters):
-            raise Exception('found a forbidden character (one of %s) in sequence id \'%s\' -- sorry, you\'ll have to replace it with something else' % (' '.join(["'" + fc + "'" for fc in utils.forbidden_characters]), unique_id))
-
-        if abbreviate_names:
-            unique_id = abbreviate(used_names, potential_names, unique_id)
-
-        # if command line specified query or reco ids, skip other ones
-        if queries is not None and unique_id not in queries:
-            continue
-        if reco_ids is not None and line['reco_id'] not in reco_ids:
-            continue
+    try:
+        for line in reader:
+            if seq_column not in line:
+                raise Exception('mandatory header \'%s\' not present in %s (you can set column names with --name-column and --seq-column)' % (seq_column, fname))
+            if name_column not in line and iname is None:
+                iname = 0
+            if name_column != internal_name_column or seq_column != internal_seq_column:
+                if iname is not None:
+                    line[internal_name_column] = '%09d' % iname
+                    iname += 1
+                translate_columns(line, {name_column : internal_name_column, seq_column: internal_seq_column})
+            utils.process_input_line(line)
+            unique_id = line[internal_name_column]
+            if any(fc in unique_id for fc in utils.forbidden_characters):
+                raise Exception('found a forbidden character (one of %s) in sequence id \'%s\' -- sorry, you\'ll have to replace it with something else' % (' '.join(["'" + fc + "'" for fc in utils.forbidden_characters]), unique_id))
+
+            if abbreviate_names:
+                unique_id = abbreviate(used_names, potential_names, unique_id)
+
+            # if command line specified query or reco ids, skip other ones
+            if queries is not None and unique_id not in queries:
+                continue
+            if reco_ids is not None and line['reco_id'] not in reco_ids:
+                continue
 
-        if unique_id in input_info:
-            raise Exception('found id %s twice in file %s' % (unique_id, fname))
+            if unique_id in found_ids:
+                raise Exception('found id %s twice in file %s' % (unique_id, fname))
+            found_ids.add(unique_id)
 
-        if seed_unique_id is not None and unique_id == seed_unique_id:
-            found_seed = True
+            if seed_unique_id is not None and unique_id == seed_unique_id:
+                found_seed = True
 
-        input_info[unique_id] = {'unique_id' : unique_id, 'seq' : line[internal_seq_column]}
+            if n_queries == 0 and is_data and 'v_gene' in line:
+                print '  note: found simulation info in %s -- are you sure you didn\'t mean to set --is-simu?' % fname
 
-        if n_queries == 0 and is_data and 'v_gene' in line:
-            print '  note: found simulation info in %s -- are you sure you didn\'t mean to set --is-simu?' % fname
+            reco_line = None
+            if not is_data:
+                if 'v_gene' not in line:
+                    raise Exception('simulation info not found in %s' % fname)
+                reco_line = line  # it's a new dict for every line, so no need to copy it
+                reco_line['unique_id'] = unique_id  # in case we're abbreviating
+                if glfo is not None:
+                    utils.add_implicit_info(glfo, reco_line, multi_seq=False, existing_implicit_keys=('cdr3_length', ))  # single seqs, since each seq is on its own line in the file
 
-        if not is_data:
-            if 'v_gene' not in line:
-                raise Exception('simulation info not found in %s' % fname)
-            reco_info[unique_id] = copy.deepcopy(line)
-            reco_info[unique_id]['unique_id'] = unique_id  # in case we're abbreviating
-            if glfo is not None:
-                utils.add_implicit_info(glfo, reco_info[unique_id], multi_seq=False, existing_implicit_keys=('cdr3_length', ))  # single seqs, since each seq is on its own line in the file
+            yield unique_id, {'unique_id' : unique_id, 'seq' : line[internal_seq_column]}, reco_line
 
-        n_queries += 1
-        if n_max_queries > 0 and n_queries >= n_max_queries:
-            break
+            n_queries += 1
+            if n_max_queries > 0 and n_queries >= n_max_queries:
+                break
+            if queries is not None and len(found_ids) == len(queries):  # found all of them, so no need to read the rest of the file
+                break
+    finally:
+        seqfile.close()
 
-    if len(input_info) == 0:
+    if n_queries == 0:
         raise Exception('didn\'t end up pulling any input info out of %s while looking for queries: %s reco_ids: %s\n' % (fname, str(queries), str(reco_ids)))
     if seed_unique_id is not None and not found_seed:
         raise Exception('couldn\'t find seed %s in %s' % (seed_unique_id, fname))
 
+# ----------------------------------------------------------------------------------------
+def read_seqfile_chunks(fname, is_data, chunk_size=10000, **kwargs):
+    """ same as read_seqfile(), but yield (input_info, reco_info) for chunks of (up to) <chunk_size> queries at a time (<kwargs> are passed to read_seqfile()) """
+    seqinfo = read_seqfile(fname, is_data, **kwargs)
+    while True:
+        input_info, reco_info = OrderedDict(), None if is_data else OrderedDict()
+        for unique_id, input_line, reco_line in itertools.islice(seqinfo, chunk_size):
+            input_info[unique_id] = input_line
+            if reco_info is not None:
+                reco_info[unique_id] = reco_line
+        if len(input_info) == 0:
+            break
+        yield input_info, reco_info
+
+# ----------------------------------------------------------------------------------------
+def get_seqfile_info(fname, is_data, glfo=None, n_max_queries=-1, queries=None, reco_ids=None, name_column=None, seq_column=None, seed_unique_id=None, abbreviate_names=False):
+    """ return list of sequence info from files of several types """
+    input_info = OrderedDict()
+    reco_info = None
+    if not is_data:
+        reco_info = OrderedDict()
+    for unique_id, input_line, reco_line in read_seqfile(fname, is_data, glfo=glfo, n_max_queries=n_max_queries, queries=queries, reco_ids=reco_ids, name_column=name_column, seq_column=seq_column,
+                                                         seed_unique_id=seed_unique_id, abbreviate_names=abbreviate_names):
+        input_info[unique_id] = input_line
+        if reco_info is not None:
+            reco_info[unique_id] = reco_line
+
     return (input_info, reco_info)
@@ -0,0 +1,152 @@
+""" run vdjalign's smith-waterman kernel (sw.ig_align) in this process, parsing its sam output as it comes out (rather than going through samtools, a bam file, and pysam) """
+import os
+import sys
+import re
+import glob
+import threading
+import contextlib
+
+# ----------------------------------------------------------------------------------------
+def import_sw(ighutil_dir):
+    """ return vdjalign's compiled sw module, or None if we can't find it (first on the regular path, then under <ighutil_dir>) """
+    try:
+        from vdjalign import sw
+        return sw
+    except ImportError:
+        pass
+    for sitedir in glob.glob(ighutil_dir + '/lib/python2*/site-packages'):
+        if sitedir not in sys.path:
+            sys.path.append(sitedir)
+    try:
+        from vdjalign import sw
+        return sw
+    except ImportError:
+        return None
+
+# ----------------------------------------------------------------------------------------
+class SamRecord(object):
+    """ one line of ig_align's sam output, with the same attributes that waterer uses from pysam's AlignedRead """
+    def __init__(self, line, reference_indices):
+        fields = line.split('\t')
+        self.qname = fields[0]
+        self.is_secondary = bool(int(fields[1]) & 256)
+        self.tid = reference_indices[fields[2]]
+        self.pos = int(fields[3]) - 1  # zero-indexed start of the match in the reference
+        self.cigarstring = fields[5]
+        self.seq = fields[9] if fields[9] != '*' else None  # only set for the primary alignment
+        self.tags = []
+        for tagstr in fields[11:]:
+            tag, tagtype, val = tagstr.split(':', 2)
+            self.tags.append((tag, int(val) if tagtype == 'i' else val))
+
+        cigars = [(code, int(length)) for length, code in re.findall('([0-9]+)([MIDNSHP=X])', self.cigarstring)]
+        self.qstart = cigars[0][1] if len(cigars) > 0 and cigars[0][0] == 'S' else 0  # query bounds exclude soft clipping
+        self.qend = self.qstart + sum([length for code, length in cigars if code in 'MI=X'])
+        self.aend = self.pos + sum([length for code, length in cigars if code in 'MDN=X'])  # one past the end of the match in the reference
+
+# ----------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def redirected_stderr(errfname):
+    """ send anything written to file descriptor 2 (e.g. ig_align's progress messages) to <errfname>, and print it if something goes wrong. <errfname> is removed when we're done """
+    sys.stderr.flush()
+    saved_stderr = os.dup(2)
+    errfd = os.open(errfname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(errfd, 2)
+    os.close(errfd)
+    try:
+        yield
+    except:
+        with open(errfname) as errfile:
+            print errfile.read()
+        raise
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stderr)
+        os.remove(errfname)
+
+# ----------------------------------------------------------------------------------------
+def ig_align_records(sw, queries, ref_path, extra_ref_paths, **kwargs):
+    """
+    Align <queries> (list of (name, seq) pairs) to the germline genes in <ref_path> (V) and <extra_ref_paths> (D, J) with <sw>.ig_align(), which is passed <kwargs> (match, mismatch, n_threads, etc.).
+    Yields (reference names, list of SamRecords) for each query that has any matches.
+    ig_align() only deals in file paths, so we give it pipes: the queries go in one from a separate thread, and we read and parse the sam coming out the other while it's still aligning (it releases the gil, and aligns with <n_threads> threads).
+    NOTE it writes progress messages to stderr, so you probably want to call this within redirected_stderr().
+    """
+    for fname in [ref_path, ] + extra_ref_paths:
+        if not os.path.exists(fname):  # ig_align asserts that it can open the files, which would kill our whole process
+            raise Exception('germline file %s d.n.e.' % fname)
+
+    qry_rfd, qry_wfd = os.pipe()
+    sam_rfd, sam_wfd = os.pipe()
+    errors = []
+
+    def write_queries():
+        try:
+            with os.fdopen(qry_wfd, 'w') as qryfile:
+                for name, seq in queries:
+                    qryfile.write('>%s\n%s\n' % (name, seq))
+        except Exception as e:
+            errors.append(e)
+
+    def run_aligner():
+        try:
+            sw.ig_align(ref_path, '/dev/fd/%d' % qry_rfd, '/dev/fd/%d' % sam_wfd, extra_ref_paths=extra_ref_paths, **kwargs)
+        except Exception as e:
+            errors.append(e)
+        finally:  # closing our copies of these is what tells the reader that the output is finished
+            os.close(qry_rfd)
+            os.close(sam_wfd)
+
+    threads = [threading.Thread(target=write_queries), threading.Thread(target=run_aligner)]
+    for thread in threads:
+        thread.start()
+
+    samfile = os.fdopen(sam_rfd)
+    try:
+        references, reference_indices = [], {}
+        records = []
+        for line in samfile:
+            if line[0] == '@':
+                if line.startswith('@SQ'):
+                    name = line.split('\t')[1][3:]  # strip off the 'SN:'
+                    reference_indices[name] = len(references)
+                    references.append(name)
+                continue
+            record = SamRecord(line.rstrip('\n'), reference_indices)
+            if len(records) > 0 and record.qname != records[0].qname:  # all the matches for each query come out together
+                yield references, records
+                records = []
+            records.append(record)
+        if len(records) > 0:
+            yield references, records
+    finally:
+        for _ in samfile:  # if we stopped early, drain the pipe so the aligner can finish
+            pass
+        samfile.close()
+        for thread in threads:
+            thread.join()
+
+    if len(errors) > 0:
+        raise Exception('in-process vdjalign failed with %s' % errors[0])
+
+# ----------------------------------------------------------------------------------------
+def align_concurrently(sw, jobs):
+    """ run ig_align_records() for each of <jobs> (list of kwarg dicts) at the same time, returning a list of the (references, records) for each query """
+    results = [None for _ in jobs]
+    errors = []
+
+    def run_job(ijob):
+        try:
+            results[ijob] = list(ig_align_records(sw, **jobs[ijob]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_job, args=(ijob, )) for ijob in range(len(jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return [alignment for result in results for alignment in result]
@@ -15,6 +15,7 @@ from Bio import Phylo
 from opener import opener
 from hist import Hist
 import utils
+from parameterset import ParameterSet
 
 
 # ----------------------------------------------------------------------------------------
@@ -39,8 +40,9 @@ def rescale_tree(treestr, factor):
 
 # ----------------------------------------------------------------------------------------
 class TreeGenerator(object):
-    def __init__(self, args, parameter_dir, seed):
+    def __init__(self, args, parameter_dir, seed, pset=None):
         self.args = args
+        self.pset = pset if pset is not None else ParameterSet(parameter_dir)
         self.tree_generator = 'TreeSim'  # other option: ape
         self.branch_lengths = {}
         self.branch_lengths = self.read_mute_freqs(parameter_dir)  # for each region (and 'all'), a list of branch lengths and a list of corresponding probabilities (i.e. two lists: bin centers and bin contents). Also, the mean of the hist.
@@ -71,7 +73,7 @@ class TreeGenerator(object):
         #     for val in length_vals:
         #         hist.fill(val)
         # else:
-        hist = Hist(fname=parameter_dir + '/' + mtype + '-mean-mute-freqs.csv')
+        hist = self.pset.get_mean_mute_hist(mtype)  # (a copy, since we normalize it below)
 
         return hist
 
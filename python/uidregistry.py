@@ -0,0 +1,49 @@
+""" dense integer index for each sequence id, so clusters and partitions can be stored and compared as arrays of ints rather than lists of (possibly very long) uid strings """
+import array
+
+# ----------------------------------------------------------------------------------------
+class UidRegistry(object):
+    """
+    Index for each uid we've seen, in the order we first saw them.
+    Clusters are packed into strings of 32-bit indices (see pack_cluster()), which take up four bytes per uid, hash and compare quickly, and can be used as dict keys.
+    NOTE there's one registry per process (<registry> below), so don't pass packed clusters between processes.
+    """
+    def __init__(self):
+        self.uids = []  # uid for each index
+        self.indices = {}  # index for each uid
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.uids)
+
+    # ----------------------------------------------------------------------------------------
+    def get_index(self, uid):
+        """ index for <uid> (adding it if we haven't seen it) """
+        if uid not in self.indices:
+            self.indices[uid] = len(self.uids)
+            self.uids.append(uid)
+        return self.indices[uid]
+
+    # ----------------------------------------------------------------------------------------
+    def get_indices(self, uids):
+        return array.array('i', [self.get_index(uid) for uid in uids])
+
+    # ----------------------------------------------------------------------------------------
+    def get_uids(self, indices):
+        return [self.uids[i] for i in indices]
+
+    # ----------------------------------------------------------------------------------------
+    def pack_cluster(self, cluster):
+        """ string of packed indices for the uids in <cluster> """
+        return self.get_indices(cluster).tostring()
+
+    # ----------------------------------------------------------------------------------------
+    def unpack_indices(self, packed_cluster):
+        return array.array('i', packed_cluster)
+
+    # ----------------------------------------------------------------------------------------
+    def unpack_cluster(self, packed_cluster):
+        """ list of uids in <packed_cluster> """
+        return self.get_uids(array.array('i', packed_cluster))
+
+registry = UidRegistry()
@@ -5,17 +5,23 @@ import sys
 import os
 import random
 import ast
+import cPickle
+import gc
 import math
 import glob
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import csv
-from subprocess import check_output, CalledProcessError, Popen
+from subprocess import check_output, CalledProcessError, Popen, PIPE
+import select
+import time
 import multiprocessing
 import copy
 
 from opener import opener
 import seqfileopener
 import glutils
+import hamming
+import partitionmetrics
 
 #----------------------------------------------------------------------------------------
 # NOTE I also have an eps defined in hmmwriter. Simplicity is the hobgoblin of... no, wait, that's just plain ol' stupid to have two <eps>s defined
@@ -1206,27 +1212,37 @@ def find_replacement_genes(indir, min_counts, gene_name=None, single_gene=False,
     if gene_name != None:
         assert all_from_region == ''
         region = get_region(gene_name)
+    else:
+        assert all_from_region in regions
+        region = all_from_region
+    gene_counts = []
+    with opener('r')(indir + '/' + region + '_gene-probs.csv') as infile:  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
+        reader = csv.DictReader(infile)
+        for line in reader:
+            gene_counts.append((line[region + '_gene'], int(line['count'])))
+    return choose_replacement_genes(gene_counts, min_counts, gene_name=gene_name, single_gene=single_gene, debug=debug, all_from_region=all_from_region, indir=indir)
+
+# ----------------------------------------------------------------------------------------
+def choose_replacement_genes(gene_counts, min_counts, gene_name=None, single_gene=False, debug=False, all_from_region='', indir=''):
+    """ guts of find_replacement_genes(), given the list of (gene, count) pairs from the gene probs file (<indir> is just for error messages) """
+    if gene_name != None:
+        assert all_from_region == ''
     else:
         assert all_from_region in regions
         assert single_gene == False
         assert min_counts == -1
-        region = all_from_region
     lists = OrderedDict()  # we want to try alleles first, then primary versions, then everything and it's mother
     lists['allele'] = []  # list of genes that are alleles of <gene_name>
     lists['primary_version'] = []  # same primary version as <gene_name>
     lists['all'] = []  # give up and return everything
-    with opener('r')(indir + '/' + region + '_gene-probs.csv') as infile:  # NOTE note this ignores correlations... which I think is actually ok, but it wouldn't hurt to think through it again at some point
-        reader = csv.DictReader(infile)
-        for line in reader:
-            gene = line[region + '_gene']
-            count = int(line['count'])
-            vals = {'gene':gene, 'count':count}
-            if all_from_region == '':
-                if are_alleles(gene, gene_name):
-                    lists['allele'].append(vals)
-                if are_same_primary_version(gene, gene_name):
-                    lists['primary_version'].append(vals)
-            lists['all'].append(vals)
+    for gene, count in gene_counts:
+        vals = {'gene':gene, 'count':count}
+        if all_from_region == '':
+            if are_alleles(gene, gene_name):
+                lists['allele'].append(vals)
+            if are_same_primary_version(gene, gene_name):
+                lists['primary_version'].append(vals)
+        lists['all'].append(vals)
 
     if single_gene:
         for list_type in lists:
@@ -1263,38 +1279,8 @@ def find_replacement_genes(indir, min_counts, gene_name=None, single_gene=False,
 
 # ----------------------------------------------------------------------------------------
 def hamming_fraction(seq1, seq2, return_len_excluding_ambig=False, extra_bases=None):
-    assert len(seq1) == len(seq2)
-    if len(seq1) == 0:
-        if return_len_excluding_ambig:
-            return 0., 0
-        else:
-            return 0.
-
-    alphabet = nukes + ambiguous_bases
-
-    if extra_bases is not None:
-        alphabet += extra_bases
-
-    for ch in seq1 + seq2:  # check that all characters are in the expected alphabet
-        if ch not in alphabet:
-            raise Exception('unexpected character \'%s\' not among %s in hamming_fraction() with input:\n  %s\n  %s' % (ch, alphabet, seq1, seq2))
-
-    distance, len_excluding_ambig = 0, 0
-    for ch1, ch2 in zip(seq1, seq2):
-        if ch1 in ambiguous_bases or ch2 in ambiguous_bases:
-            continue
-
-        len_excluding_ambig += 1
-        if ch1 != ch2:
-            distance += 1
-
-    fraction = 0.
-    if len_excluding_ambig > 0:
-        fraction = distance / float(len_excluding_ambig)
-    if return_len_excluding_ambig:
-        return fraction, len_excluding_ambig
-    else:
-        return fraction
+    """ see hamming.py (which also has one-vs-many and all-pairs versions) """
+    return hamming.hamming_fraction(seq1, seq2, return_len_excluding_ambig=return_len_excluding_ambig, extra_bases=extra_bases)
 
 # ----------------------------------------------------------------------------------------
 def get_key(names):
@@ -1353,12 +1339,82 @@ def useful_bool(bool_str):
         raise Exception('couldn\'t convert \'%s\' to bool' % bool_str)
 
 # ----------------------------------------------------------------------------------------
-def process_input_line(info):
+def splitstrpair(pairstr):
+    pairlist = pairstr.split(':')
+    if len(pairlist) != 2:
+        raise Exception('couldn\'t split %s into two pieces with \':\'' % (pairstr))
+    return (pairlist[0], float(pairlist[1]))
+
+# ----------------------------------------------------------------------------------------
+literal_cache = {}  # pickled value for each literal string we've seen (see cached_literal_eval())
+max_literal_cache_size = 10000
+def cached_literal_eval(valstr):
+    """ ast.literal_eval() is really slow, and most lines have one of a few values (e.g. no indels), so we keep the pickled result for each string (unpickling gives each line its own copy) """
+    if valstr not in literal_cache:
+        if len(literal_cache) >= max_literal_cache_size:
+            literal_cache.clear()
+        literal_cache[valstr] = cPickle.dumps(ast.literal_eval(valstr), cPickle.HIGHEST_PROTOCOL)
+    return cPickle.loads(literal_cache[valstr])
+
+# ----------------------------------------------------------------------------------------
+column_converters = {}  # compiled conversion functions, one for each column that we've seen (see get_column_converter())
+column_formatters = {}  # and the same for output
+
+# ----------------------------------------------------------------------------------------
+def get_column_converter(key):
     """
-    Attempt to convert all the keys and values in <info> according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc).
+    Return the function that converts <key>'s (string) value to its python value, according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc).
+    We only work this out once for each column, so per-row conversion is just one function call per value.
     """
+    if key in column_converters:
+        return column_converters[key]
 
     ccfg = column_configs  # shorten the name a bit
+    convert_fcn = pass_fcn  # dummy fcn, just returns the argument
+    if key in ccfg['ints']:
+        convert_fcn = int
+    elif key in ccfg['floats']:
+        convert_fcn = float
+    elif key in ccfg['bools']:
+        convert_fcn = useful_bool
+    elif key in ccfg['literals']:
+        convert_fcn = cached_literal_eval
+
+    if key in ccfg['lists']:
+        if key in ccfg['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
+            converter = lambda valstr: OrderedDict(splitstrpair(convert_fcn(pairstr)) for pairstr in valstr.split(';'))
+        elif convert_fcn is pass_fcn:
+            converter = lambda valstr: valstr.split(':')
+        else:
+            converter = lambda valstr: [convert_fcn(val) for val in valstr.split(':')]
+    else:
+        converter = convert_fcn
+
+    column_converters[key] = converter
+    return converter
+
+# ----------------------------------------------------------------------------------------
+def get_column_formatter(key):
+    """ Reverse of get_column_converter(): function that converts <key>'s python value to the string we write to csv """
+    if key in column_formatters:
+        return column_formatters[key]
+
+    if key in column_configs['lists']:
+        if key in column_configs['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
+            formatter = lambda val: ';'.join([k + ':' + str(v) for k, v in val.items()])
+        else:
+            formatter = lambda val: ':'.join([str(v) for v in val])
+    else:
+        formatter = str
+
+    column_formatters[key] = formatter
+    return formatter
+
+# ----------------------------------------------------------------------------------------
+def process_input_line(info):
+    """
+    Attempt to convert all the keys and values in <info> according to the specifications in <column_configs> (e.g. splitting lists, casting to int/float, etc).
+    """
 
     # translate old column names (for backwards compatibility on old simulation files)
     for key in info.keys():
@@ -1369,46 +1425,78 @@ def process_input_line(info):
     for key in info:
         if key is None:
             continue
-
-        convert_fcn = pass_fcn  # dummy fcn, just returns the argument
-        if key in ccfg['ints']:
-            convert_fcn = int
-        elif key in ccfg['floats']:
-            convert_fcn = float
-        elif key in ccfg['bools']:
-            convert_fcn = useful_bool
-        elif key in ccfg['literals']:
-            convert_fcn = ast.literal_eval
-
-        if key in ccfg['lists']:
-            if key in ccfg['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
-
-                def splitstrpair(pairstr):
-                    pairlist = pairstr.split(':')
-                    if len(pairlist) != 2:
-                        raise Exception('couldn\'t split %s into two pieces with \':\'' % (pairstr))
-                    return (pairlist[0], float(pairlist[1]))
-
-                info[key] = [convert_fcn(val) for val in info[key].split(';')]
-                info[key] = OrderedDict(splitstrpair(pairstr) for pairstr in info[key])
-            else:
-                info[key] = [convert_fcn(val) for val in info[key].split(':')]
-        else:
-            info[key] = convert_fcn(info[key])
+        info[key] = get_column_converter(key)(info[key])
 
 # ----------------------------------------------------------------------------------------
 def get_line_for_output(info):
     """ Reverse the action of process_input_line() """
-    outfo = {}
-    for key in info:
-        if key in column_configs['lists']:
-            if key in column_configs['lists-of-string-float-pairs']:  # ok, that's getting a little hackey
-                outfo[key] = ';'.join([k + ':' + str(v) for k, v in info[key].items()])
-            else:
-                outfo[key] = ':'.join([str(v) for v in info[key]])
-        else:
-            outfo[key] = str(info[key])
-    return outfo
+    return {key : get_column_formatter(key)(val) for key, val in info.items()}
+
+# ----------------------------------------------------------------------------------------
+def get_empty_converter(convert):
+    """
+    Return the function (of no arguments) that gives the value for an empty csv cell in a column with converter <convert>. This is the same as what process_input_line() gives (e.g. [''] for lists of strings),
+    except for columns in which that raises an exception (e.g. ints, which are empty in failed lines), where we leave it as an empty string.
+    """
+    try:
+        convert('')
+    except Exception:
+        return lambda: ''
+    return lambda: convert('')  # call it each time, so each row gets its own list
+
+# ----------------------------------------------------------------------------------------
+def get_csv_colinfo(reader, columns):
+    """ read the header line from csv.reader <reader>, and return a list of (column, index in row, converter, empty value function) for each of <columns> (default: all columns), or None if the file is empty """
+    try:
+        header = [translation_columns.get(h, h) for h in reader.next()]
+    except StopIteration:  # empty file
+        return None
+    if columns is None:
+        columns = header
+    for column in columns:
+        if column not in header:
+            raise Exception('column \'%s\' not among headers %s' % (column, header))
+    return [(column, header.index(column), get_column_converter(column), get_empty_converter(get_column_converter(column))) for column in columns]
+
+# ----------------------------------------------------------------------------------------
+def typed_csv_reader(infile, columns=None):
+    """
+    Faster replacement for csv.DictReader + process_input_line(): yields a dict of converted values for each row in the (open) csv file <infile>.
+    The converters are looked up once for the header, rather than for every value. If <columns> is set, we only convert (and return) those columns.
+    NOTE empty values are converted as in process_input_line() (e.g. to [''] for lists of strings), except that they're left as empty strings where that would fail (see get_empty_converter()).
+    """
+    reader = csv.reader(infile)
+    colinfo = get_csv_colinfo(reader, columns)
+    if colinfo is None:
+        return
+    for row in reader:
+        yield {column : (convert(row[icol]) if row[icol] != '' else empty()) for column, icol, convert, empty in colinfo}
+
+# ----------------------------------------------------------------------------------------
+def read_typed_csv(fname, columns=None, as_columns=False):
+    """
+    Bulk read of csv file <fname>, converting values as in typed_csv_reader(). Returns a list of rows (dicts), or if <as_columns> is set, an OrderedDict of lists of values keyed by column.
+    NOTE we turn off the cyclic garbage collector while reading, since otherwise it keeps rescanning all the (non-cyclic) objects we've created, which takes about as long as the actual reading.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with opener('r')(fname) as infile:
+            if not as_columns:
+                return list(typed_csv_reader(infile, columns=columns))
+            reader = csv.reader(infile)
+            colinfo = get_csv_colinfo(reader, columns)
+            if colinfo is None:
+                return OrderedDict([(column, []) for column in (columns if columns is not None else [])])
+            coldata = OrderedDict([(column, []) for column, _, _, _ in colinfo])
+            appenders = [(coldata[column].append, icol, convert, empty) for column, icol, convert, empty in colinfo]
+            for row in reader:
+                for append, icol, convert, empty in appenders:
+                    append(convert(row[icol]) if row[icol] != '' else empty())
+            return coldata
+    finally:
+        if gc_was_enabled:
+            gc.enable()
 
 # ----------------------------------------------------------------------------------------
 def merge_csvs(outfname, csv_list, cleanup=True):
@@ -1450,27 +1538,127 @@ def get_mutation_rate(line, restrict_to_region='', return_len_excluding_ambig=Fa
 
 # ----------------------------------------------------------------------------------------
 def run_cmd(cmd_str, workdir):
+    """ start <cmd_str>, with stderr going to <workdir>/err and stdout to a pipe (which we use to find out, without polling, when the process has exited) """
     # print cmd_str
     # sys.exit()
-    proc = Popen(cmd_str + ' 1>' + workdir + '/out' + ' 2>' + workdir + '/err', shell=True)
+    proc = Popen(cmd_str + ' 2>' + workdir + '/err', shell=True, stdout=PIPE, close_fds=True)  # close_fds so that no process inherits the other processes' pipes (otherwise we wouldn't see eof until they'd *all* finished)
     return proc
 
 # ----------------------------------------------------------------------------------------
-# deal with a process once it's finished (i.e. check if it failed, and restart if so)
-def finish_process(iproc, procs, n_tries, workdir, outfname, cmd_str, info=None):
-    procs[iproc].communicate()
-    process_out_err('', '', extra_str='' if len(procs) == 1 else str(iproc), info=info, subworkdir=workdir)
-    if procs[iproc].returncode == 0 and os.path.exists(outfname):  # TODO also check cachefile, if necessary
-        procs[iproc] = None  # job succeeded
-    elif n_tries[iproc] > 5:
-        raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s' % (cmd_str, workdir))
-    else:
-        print '    rerunning proc %d (exited with %d' % (iproc, procs[iproc].returncode),
-        if not os.path.exists(outfname):
-            print ', output %s d.n.e.' % outfname,
-        print ')'
-        procs[iproc] = run_cmd(cmd_str, workdir)
+def split_into_shards(items, n_shards):
+    """ split list <items> into (at most) <n_shards> contiguous, nearly equal-sized shards """
+    n_shards = max(1, min(n_shards, len(items)))
+    bounds = [int(round(float(ishard) * len(items) / n_shards)) for ishard in range(n_shards + 1)]
+    return [items[bounds[ishard] : bounds[ishard + 1]] for ishard in range(n_shards)]
+
+# ----------------------------------------------------------------------------------------
+def iter_shards(items, shard_size):
+    """ yield lists of (up to) <shard_size> consecutive items from the iterable <items> (e.g. an open file), without reading the whole thing into memory """
+    shard = []
+    for item in items:
+        shard.append(item)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if len(shard) > 0:
+        yield shard
+
+# ----------------------------------------------------------------------------------------
+shard_info = {}  # set by map_shards() before it forks the worker processes, so they inherit the function (which then doesn't have to be picklable)
+
+def run_shard(shard):
+    return shard_info['fcn'](shard)
+
+def map_shards(fcn, shards, n_procs, max_in_flight=None):
+    """
+    Yield <fcn>(shard) for each of <shards> (a list, or any iterable, e.g. a generator reading from a file), in order, running them in a pool of <n_procs> worker processes (or in this process, if <n_procs> is 1).
+    Only the shards and return values get pickled, so <fcn> can be e.g. a closure over the caller's state. The point is for the caller to reduce the results in order (e.g. merging partial parameter counts), so the result doesn't depend on <n_procs>.
+    We only pull shards from <shards> up to <max_in_flight> (default 2 * <n_procs>) ahead of the last one we yielded, so memory use doesn't depend on how many shards there are.
+    """
+    if n_procs < 2 or (isinstance(shards, list) and len(shards) < 2):
+        for shard in shards:
+            yield fcn(shard)
+        return
+    if max_in_flight is None:
+        max_in_flight = 2 * n_procs
+    if len(shard_info) > 0:
+        raise Exception('map_shards() isn\'t reentrant')
+    shard_info['fcn'] = fcn
+    pool = multiprocessing.Pool(n_procs)
+    try:
+        pending = deque()  # results for shards we've sent off, in order
+        for shard in shards:
+            pending.append(pool.apply_async(run_shard, (shard, )))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shard_info.clear()
+
+# ----------------------------------------------------------------------------------------
+def run_cmds(cmdfos, n_max_tries=5):
+    """
+    Run each command in <cmdfos> (list of dicts with keys 'cmd_str', 'workdir', 'outfname', and optionally 'info') and return once they've all finished.
+    Failed processes (nonzero exit, or missing <outfname>) are rerun up to <n_max_tries> times.
+    Instead of polling, we block on the processes' stdout pipes, which hit eof as soon as the process exits.
+    Returns list of wall times (in seconds, for the last try) for each process.
+    """
+    procs = [None for _ in cmdfos]
+    n_tries = [0 for _ in cmdfos]
+    outstrs = ['' for _ in cmdfos]
+    start_times = [None for _ in cmdfos]
+    wall_times = [None for _ in cmdfos]
+    fd_procs = {}  # map from stdout file descriptor to index of still-running processes
+
+    def start_proc(iproc):
+        procs[iproc] = run_cmd(cmdfos[iproc]['cmd_str'], cmdfos[iproc]['workdir'])
         n_tries[iproc] += 1
+        outstrs[iproc] = ''
+        start_times[iproc] = time.time()
+        fd_procs[procs[iproc].stdout.fileno()] = iproc
+
+    for iproc in range(len(cmdfos)):
+        start_proc(iproc)
+
+    while len(fd_procs) > 0:
+        readable, _, _ = select.select(fd_procs.keys(), [], [])
+        for fd in readable:
+            iproc = fd_procs[fd]
+            chunk = os.read(fd, 65536)
+            if chunk != '':  # still running
+                outstrs[iproc] += chunk
+                continue
+
+            # it's finished
+            del fd_procs[fd]
+            procs[iproc].stdout.close()
+            procs[iproc].wait()
+            wall_times[iproc] = time.time() - start_times[iproc]
+            cmdfo = cmdfos[iproc]
+            errfname = cmdfo['workdir'] + '/err'
+            with open(errfname) as errfile:
+                err = errfile.read()
+            os.remove(errfname)
+            process_out_err(outstrs[iproc], err, extra_str='' if len(cmdfos) == 1 else str(iproc), info=cmdfo.get('info'))
+            if procs[iproc].returncode == 0 and os.path.exists(cmdfo['outfname']):  # TODO also check cachefile, if necessary
+                procs[iproc] = None  # job succeeded
+            elif n_tries[iproc] > n_max_tries:
+                raise Exception('exceeded max number of tries for command\n    %s\nlook for output in %s' % (cmdfo['cmd_str'], cmdfo['workdir']))
+            else:
+                print '    rerunning proc %d (exited with %d' % (iproc, procs[iproc].returncode),
+                if not os.path.exists(cmdfo['outfname']):
+                    print ', output %s d.n.e.' % cmdfo['outfname'],
+                print ')'
+                start_proc(iproc)
+        sys.stdout.flush()
+
+    return wall_times
 
 # ----------------------------------------------------------------------------------------
 def process_out_err(out, err, extra_str='', info=None, subworkdir=None):
@@ -1584,47 +1772,10 @@ def get_cluster_ids(uids, partition):
 
 # ----------------------------------------------------------------------------------------
 def new_ccfs_that_need_better_names(partition, true_partition, reco_info, seed_unique_id=None):
+    """ Return (ccf_under, ccf_over), i.e. the mean over uids of the fraction of each uid's inferred cluster which is really clonal, and of the fraction of its true clonemates which are in its inferred cluster (see partitionmetrics.ccfs()) """
     if seed_unique_id is None:
         check_intersection_and_complement(partition, true_partition)
-    reco_ids = {uid : reco_info[uid]['reco_id'] for cluster in partition for uid in cluster}  # just a teensy lil' optimization
-    uids = set([uid for cluster in partition for uid in cluster])
-    clids = get_cluster_ids(uids, partition)  # inferred cluster ids
-
-    def get_clonal_fraction(uid, inferred_cluster):
-        """ Return the fraction of seqs in <uid>'s inferred cluster which are really clonal. """
-        n_clonal = 0
-        for tmpid in inferred_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if reco_ids[tmpid] == reco_ids[uid]:
-                n_clonal += 1
-        return float(n_clonal) / len(inferred_cluster)
-
-    def get_fraction_present(inferred_cluster, true_cluster):
-        """ Return the fraction of the true clonemates in <true_cluster> which appear in <inferred_cluster>. """
-        n_present = 0
-        for tmpid in true_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if tmpid in inferred_cluster:
-                n_present += 1
-        return float(n_present) / len(true_cluster)
-
-    mean_clonal_fraction, mean_fraction_present = 0., 0.
-    n_uids = 0
-    for true_cluster in true_partition:
-        if seed_unique_id is not None and seed_unique_id not in true_cluster:
-            continue
-        for uid in true_cluster:
-            if seed_unique_id is not None and uid != seed_unique_id:
-                continue
-            if len(clids[uid]) != 1:
-                print 'WARNING %s in multiple clusters' % uid
-            inferred_cluster = partition[clids[uid][0]]
-            mean_clonal_fraction += get_clonal_fraction(uid, inferred_cluster)
-            mean_fraction_present += get_fraction_present(inferred_cluster, true_cluster)
-            n_uids += 1
-
-    if n_uids > 1e6:
-        raise Exception('you should start worrying about numerical precision if you\'re going to run on this many queries')
-
-    return mean_clonal_fraction / n_uids, mean_fraction_present / n_uids
+    return partitionmetrics.partition_ccfs(partition, true_partition, reco_info, seed_unique_id=seed_unique_id)
 
 # ----------------------------------------------------------------------------------------
 def correct_cluster_fractions(partition, true_partition, debug=False):
@@ -1679,13 +1830,6 @@ def correct_cluster_fractions(partition, true_partition, debug=False):
 # ----------------------------------------------------------------------------------------
 def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_biggest_clusters, debug=False):
     """ Return matrix whose ij^th entry is the size of the intersection between <partition_a>'s i^th biggest cluster and <partition_b>'s j^th biggest """
-    def intersection_size(cl_1, cl_2):
-        isize = 0
-        for uid in cl_1:
-            if uid in cl_2:
-                isize += 1
-        return isize
-
     # n_biggest_clusters = 10
     def sort_within_clusters(part):
         for iclust in range(len(part)):
@@ -1697,19 +1841,20 @@ def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_bigg
     sort_within_clusters(partition_b)
     a_clusters = sorted(sorted(partition_a), key=len, reverse=True)[ : n_biggest_clusters]  # i.e. the n biggest clusters
     b_clusters = sorted(sorted(partition_b), key=len, reverse=True)[ : n_biggest_clusters]
+    intersections = partitionmetrics.overlap_matrix(a_clusters, b_clusters)
 
     smatrix = []
     pair_info = []  # list of full pair info (e.g. [0.8, ick)
     max_pair_info = 5
-    for clust_a in a_clusters:
+    for ia, clust_a in enumerate(a_clusters):
         # if debug:
         #     print clust_a
         smatrix.append([])
-        for clust_b in b_clusters:
+        for ib, clust_b in enumerate(b_clusters):
             # norm_factor = 1.  # don't normalize
             norm_factor = 0.5 * (len(clust_a) + len(clust_b))  # mean size
             # norm_factor = min(len(clust_a), len(clust_b))  # smaller size
-            intersection = intersection_size(clust_a, clust_b)
+            intersection = int(intersections[ia, ib])
             isize = float(intersection) / norm_factor
             # if debug:
             #     print '    %.2f  %5d   %5d %5d' % (isize, intersection, len(clust_a), len(clust_b))
@@ -1767,27 +1912,28 @@ def check_intersection_and_complement(part_a, part_b):
 # ----------------------------------------------------------------------------------------
 def get_cluster_list_for_sklearn(part_a, part_b):
     # convert from partition format {cl_1 : [seq_a, seq_b], cl_2 : [seq_c]} to [cl_1, cl_1, cl_2]
-    # NOTE this will be really slow for larger partitions
+    iclusts_b = {uid : jclust for jclust in range(len(part_b)) for uid in part_b[jclust]}
 
     # first make sure that <part_a> has every uid in <part_b> (the converse is checked below)
-    for jclust in range(len(part_b)):
-        for uid in part_b[jclust]:
-            find_uid_in_partition(uid, part_a)  # raises exception if not found
+    uids_a = set([uid for cluster in part_a for uid in cluster])
+    for uid in iclusts_b:
+        if uid not in uids_a:
+            raise Exception('couldn\'t find %s in %s\n' % (uid, part_a))
 
     # then make the cluster lists
     clusts_a, clusts_b = [], []
     for iclust in range(len(part_a)):
         for uid in part_a[iclust]:
+            if uid not in iclusts_b:
+                raise Exception('couldn\'t find %s in %s\n' % (uid, part_b))
             clusts_a.append(iclust)
-            clusts_b.append(find_uid_in_partition(uid, part_b))
+            clusts_b.append(iclusts_b[uid])
 
     return clusts_a, clusts_b
 
 # ----------------------------------------------------------------------------------------
 def adjusted_mutual_information(partition_a, partition_b):
-    return -1.  # not using it any more, and it's really slow
-    # clusts_a, clusts_b = get_cluster_list_for_sklearn(partition_a, partition_b)
-    # return sklearn.metrics.cluster.adjusted_mutual_info_score(clusts_a, clusts_b)
+    return partitionmetrics.partition_adjusted_mutual_information(partition_a, partition_b)
 
 # ----------------------------------------------------------------------------------------
 def add_missing_uids_as_singletons_to_inferred_partition(partition_with_missing_uids, true_partition=None, all_ids=None, debug=True):
@@ -1797,12 +1943,11 @@ def add_missing_uids_as_singletons_to_inferred_partition(partition_with_missing_
         true_partition = [[uid, ] for uid in all_ids]
 
     partition_with_uids_added = copy.deepcopy(partition_with_missing_uids)
+    uids_present = set([uid for cluster in partition_with_missing_uids for uid in cluster])
     missing_ids = []
     for cluster in true_partition:
         for uid in cluster:
-            try:
-                find_uid_in_partition(uid, partition_with_missing_uids)
-            except:
+            if uid not in uids_present:
                 partition_with_uids_added.append([uid, ])
                 missing_ids.append(uid)
     if debug:
@@ -1812,15 +1957,15 @@ def add_missing_uids_as_singletons_to_inferred_partition(partition_with_missing_
 # ----------------------------------------------------------------------------------------
 def remove_missing_uids_from_true_partition(true_partition, partition_with_missing_uids, debug=True):
     """ return a copy of <true_partition> which has had any uids which do not occur in <partition_with_missing_uids> removed """
+    uids_present = set([uid for cluster in partition_with_missing_uids for uid in cluster])
     true_partition_with_uids_removed = []
     missing_ids = []
     for cluster in true_partition:
         new_cluster = []
         for uid in cluster:
-            try:
-                find_uid_in_partition(uid, partition_with_missing_uids)
+            if uid in uids_present:
                 new_cluster.append(uid)
-            except:
+            else:
                 missing_ids.append(uid)
         if len(new_cluster) > 0:
             true_partition_with_uids_removed.append(new_cluster)
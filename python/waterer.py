@@ -6,11 +6,13 @@ import re
 import os
 import itertools
 import operator
-import pysam
 import contextlib
+import multiprocessing
 from collections import OrderedDict
 
 import utils
+import glutils
+import swalign
 from opener import opener
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
@@ -19,7 +21,7 @@ from allelefinder import AlleleFinder
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
-    def __init__(self, args, input_info, reco_info, glfo, my_datadir, parameter_dir, write_parameters=False, find_new_alleles=False):
+    def __init__(self, args, input_info, reco_info, glfo, my_datadir, parameter_dir, write_parameters=False, find_new_alleles=False, input_stream=None, duplicate_reco_info=None):
         self.parameter_dir = parameter_dir.rstrip('/')
         self.args = args
         self.debug = self.args.debug if self.args.sw_debug is None else self.args.sw_debug
@@ -28,13 +30,24 @@ class Waterer(object):
         self.absolute_max_insertion_length = 200  # just ignore them if it's longer than this
 
         self.input_info = input_info
+        self.input_stream = input_stream  # if set, yields the names of queries as they're read from the input file (and added to <input_info>), so we can start aligning before we've read all of them
         self.remaining_queries = set([q for q in self.input_info.keys()])  # we remove queries from this set when we're satisfied with the current output (in general we may have to rerun some queries with different match/mismatch scores)
         self.new_indels = 0  # number of new indels that were kicked up this time through
 
         self.match_mismatch = copy.deepcopy(self.args.initial_match_mismatch)  # don't want to modify it!
+        self.query_match_mismatch = {}  # match/mismatch scores for queries that we're rerunning (they depend on why each query failed)
+        self.rerun_score_changes = {  # how much to add to a query's [match, mismatch] scores when we rerun it, for each reason it might've failed
+            'unproductive' : (0, 1),  # usually a screwed up annotation rather than a really unproductive sequence, so same as no-match
+            'no-match' : (0, 1),  # (usually d) more mismatch penalty shortens the v and j matches, which leaves more of the sequence for the d
+            'nonsense-bounds' : (0, 2),  # neighboring matches overlap too much to apportion, so shorten them more aggressively
+            'weird-annot.' : (1, 0),  # very long insertion, i.e. the neighboring matches stopped short, so reward matches to extend them through mutations
+            'invalid-codon' : (1, 0),  # conserved codon off the end of the sequence (or too-short cdr3), i.e. a short spurious v or j match, so favor longer ones
+        }
+        self.candidate_genes = {}  # genes that sw reported for each query on the first try (i.e. against the full germline set), so we only need to realign against these when rerunning
         self.gap_open_penalty = self.args.gap_open_penalty  # not modifying it now, but just to make sure we don't in the future
 
         self.reco_info = reco_info
+        self.duplicate_reco_info = duplicate_reco_info  # reco info for queries with the same sequence as one of ours (which are in the 'duplicates' in their input info)
         self.glfo = glfo
         self.info = {}
         self.info['queries'] = []  # list of queries that *passed* sw, i.e. for which we have information
@@ -57,6 +70,7 @@ class Waterer(object):
                 self.true_pcounter = ParameterCounter(self.glfo, self.args)
         if self.args.plot_performance:
             self.perfplotter = PerformancePlotter(self.glfo, 'sw')
+        self.queries_to_count = []  # queries for which we've got a final annotation, in the order in which we got them
 
         if not os.path.exists(self.args.ighutil_dir + '/bin/vdjalign'):
             raise Exception('ERROR ighutil path d.n.e: ' + self.args.ighutil_dir + '/bin/vdjalign')
@@ -69,19 +83,69 @@ class Waterer(object):
         sys.stdout.flush()
 
         n_procs = self.args.n_fewer_procs
-        initial_queries_per_proc = float(len(self.remaining_queries)) / n_procs
-        while len(self.remaining_queries) > 0:  # we remove queries from <self.remaining_queries> as we're satisfied with their output
-            if self.nth_try > 1 and float(len(self.remaining_queries)) / n_procs < initial_queries_per_proc:
-                n_procs = int(max(1., float(len(self.remaining_queries)) / initial_queries_per_proc))
-            self.write_vdjalign_input(base_infname, n_procs)
-            self.execute_commands(base_infname, base_outfname, n_procs)
-            self.read_output(base_outfname, n_procs)
+        sw = None  # if we can import vdjalign's sw module, we align within this process, using a thread for each proc
+        if not self.args.slurm and not utils.auto_slurm(n_procs):
+            sw = swalign.import_sw(self.args.ighutil_dir)
+        if self.input_stream is not None and sw is None:  # have to write all the queries to file before running vdjalign, so we need to finish reading them
+            self.remaining_queries |= set(self.input_stream)
+            self.input_stream = None
+        while self.input_stream is not None or len(self.remaining_queries) > 0:  # we remove queries from <self.remaining_queries> as we're satisfied with their output
+            initial_queries_per_proc = float(len(self.input_info)) / n_procs  # only used after the first try, by which time we've read all the queries
+            if self.input_stream is not None:  # first try: align queries as they're read from the input file
+                jobs = [{'queries' : self.stream_queries(), 'match_mismatch' : self.match_mismatch, 'gldir' : self.my_datadir, 'n_procs' : n_procs}]
+            else:
+                jobs = self.get_sw_jobs(n_procs, initial_queries_per_proc)
+            if sw is not None:
+                self.align_in_process(sw, jobs)
+            else:
+                procs = self.split_sw_jobs(jobs)
+                self.write_vdjalign_input(base_infname, procs)
+                self.execute_commands(base_infname, base_outfname, procs)
+                self.read_output(base_outfname, len(procs))
+            for job in jobs:
+                if job['gldir'] != self.my_datadir:
+                    glutils.remove_glfo_files(job['gldir'], self.args.chain)
             if self.nth_try > 3:
                 break
             self.nth_try += 1  # it's set to 1 before we begin the first try, and increases to 2 just before we start the second try
 
         self.finalize()
 
+    # ----------------------------------------------------------------------------------------
+    def stream_queries(self):
+        """ yield queries from <self.input_stream>, adding each to <self.remaining_queries> """
+        for query_name in self.input_stream:
+            self.remaining_queries.add(query_name)
+            yield query_name
+        self.input_stream = None
+
+    # ----------------------------------------------------------------------------------------
+    def count_parameters(self):
+        """ increment allele finder and parameter counters for all the annotated queries, in shards in --n-procs worker processes, then merge the shards' counts (in order, so it's the same as counting them all here) """
+        if len(self.queries_to_count) == 0:
+            return
+        def count_shard(queries):
+            alfinder = AlleleFinder(self.glfo, self.args) if self.alfinder is not None else None
+            pcounter = ParameterCounter(self.glfo, self.args) if self.pcounter is not None else None
+            true_pcounter = ParameterCounter(self.glfo, self.args) if self.true_pcounter is not None else None
+            for query_name in queries:
+                duplicates = self.input_info[query_name].get('duplicates', [])  # identical sequences that we're only aligning once (with --collapse-duplicate-sequences)
+                if alfinder is not None:
+                    alfinder.increment(self.info[query_name], multiplicity=1 + len(duplicates))
+                if pcounter is not None:
+                    pcounter.increment_all_params(self.info[query_name], multiplicity=1 + len(duplicates))
+                if true_pcounter is not None:
+                    true_pcounter.increment_all_params(self.reco_info[query_name])
+                    for uid in duplicates:
+                        true_pcounter.increment_all_params(self.duplicate_reco_info[uid])
+            return alfinder, pcounter, true_pcounter
+        n_procs = min(self.args.n_procs, multiprocessing.cpu_count())
+        for partial_counters in utils.map_shards(count_shard, utils.split_into_shards(self.queries_to_count, n_procs), n_procs):
+            for counter, partial_counter in zip((self.alfinder, self.pcounter, self.true_pcounter), partial_counters):
+                if counter is not None:
+                    counter.merge(partial_counter)
+        self.queries_to_count = []
+
     # ----------------------------------------------------------------------------------------
     def finalize(self):
         if self.perfplotter is not None:
@@ -110,6 +174,7 @@ class Waterer(object):
             print 'true annotations for remaining events:'
             for qry in self.remaining_queries:
                 utils.print_reco_event(self.glfo['seqs'], self.reco_info[qry], extra_str='      ', label='true:')
+        self.count_parameters()
         if self.alfinder is not None:
             self.alfinder.finalize(debug=self.args.debug_new_allele_finding)
             self.info['new-alleles'] = self.alfinder.new_allele_info
@@ -138,30 +203,19 @@ class Waterer(object):
             return self.args.workdir + '/sw-' + str(iproc)
 
     # ----------------------------------------------------------------------------------------
-    def execute_commands(self, base_infname, base_outfname, n_procs):
+    def execute_commands(self, base_infname, base_outfname, procs):
+        n_procs = len(procs)
         # ----------------------------------------------------------------------------------------
         def get_outfname(iproc):
             return self.subworkdir(iproc, n_procs) + '/' + base_outfname
         # ----------------------------------------------------------------------------------------
         def get_cmd_str(iproc):
-            return self.get_vdjalign_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, n_procs)
+            return self.get_vdjalign_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, procs[iproc]['match_mismatch'], procs[iproc]['gldir'], n_procs)
 
-        # start all procs for the first time
-        procs, n_tries = [], []
-        for iproc in range(n_procs):
-            procs.append(utils.run_cmd(get_cmd_str(iproc), self.subworkdir(iproc, n_procs)))
-            n_tries.append(1)
-            time.sleep(0.1)
-
-        # keep looping over the procs until they're all done
-        while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-            for iproc in range(n_procs):
-                if procs[iproc] is None:  # already finished
-                    continue
-                if procs[iproc].poll() is not None:  # it's finished
-                    utils.finish_process(iproc, procs, n_tries, self.subworkdir(iproc, n_procs), get_outfname(iproc), get_cmd_str(iproc))
-            sys.stdout.flush()
-            time.sleep(1)
+        cmdfos = [{'cmd_str' : get_cmd_str(iproc), 'workdir' : self.subworkdir(iproc, n_procs), 'outfname' : get_outfname(iproc)} for iproc in range(n_procs)]
+        wall_times = utils.run_cmds(cmdfos)
+        if n_procs > 1:
+            print '      per-proc wall time: min %.1f  max %.1f' % (min(wall_times), max(wall_times))
 
         for iproc in range(n_procs):
             os.remove(self.subworkdir(iproc, n_procs) + '/' + base_infname)
@@ -169,39 +223,99 @@ class Waterer(object):
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
-    def write_vdjalign_input(self, base_infname, n_procs):
-        n_remaining = len(self.remaining_queries)
-        queries_per_proc = float(n_remaining) / n_procs
-        n_queries_per_proc = int(math.ceil(queries_per_proc))
+    def write_vdjalign_input(self, base_infname, procs):
         written_queries = set()  # make sure we actually write each query TODO remove this when you work out where they're disappearing to
-        if n_procs == 1:  # double check for rounding problems or whatnot
-            assert n_queries_per_proc == n_remaining
-        for iproc in range(n_procs):
-            workdir = self.subworkdir(iproc, n_procs)
-            if n_procs > 1:
+        for iproc in range(len(procs)):
+            workdir = self.subworkdir(iproc, len(procs))
+            if len(procs) > 1:
                 utils.prep_dir(workdir)
             with opener('w')(workdir + '/' + base_infname) as sub_infile:
-                iquery = 0
-                for query_name in self.remaining_queries:  # NOTE this is wasteful to loop of all the remaining queries for each process... but maybe not that wasteful
-                    if iquery >= n_remaining:
-                        break
-                    if iquery < iproc*n_queries_per_proc or iquery >= (iproc + 1)*n_queries_per_proc:  # not for this process
-                        iquery += 1
-                        continue
+                for query_name in procs[iproc]['queries']:
                     sub_infile.write('>' + query_name + ' NUKES\n')
-
-                    seq = self.input_info[query_name]['seq']
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    sub_infile.write(seq + '\n')
+                    sub_infile.write(self.get_query_seq(query_name) + '\n')
                     written_queries.add(query_name)
-                    iquery += 1
         not_written = self.remaining_queries - written_queries
         if len(not_written) > 0:
             raise Exception('didn\'t write %s to %s' % (':'.join(not_written), self.args.workdir))
 
     # ----------------------------------------------------------------------------------------
-    def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, n_procs=None):
+    def get_query_seq(self, query_name):
+        if query_name in self.info['indels']:
+            return self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+        return self.input_info[query_name]['seq']
+
+    # ----------------------------------------------------------------------------------------
+    def get_sw_jobs(self, n_procs, initial_queries_per_proc):
+        """
+        Group the remaining queries by their current match/mismatch scores, and for reruns restrict each group's germline set to the genes that were candidates for its queries on the first try.
+        Returns a list of jobs (each with its queries, scores, germline dir, and number of procs), which we then run at the same time.
+        """
+        groups = OrderedDict()
+        for query_name in self.remaining_queries:
+            match_mismatch = tuple(self.query_match_mismatch.get(query_name, self.match_mismatch))
+            if match_mismatch not in groups:
+                groups[match_mismatch] = []
+            groups[match_mismatch].append(query_name)
+
+        jobs = []
+        for match_mismatch, queries in groups.items():
+            gldir = self.my_datadir
+            job_n_procs = n_procs
+            if self.nth_try > 1:
+                gldir = self.args.workdir + '/sw-germlines-' + str(len(jobs))
+                self.write_candidate_germlines(gldir, queries)
+                job_n_procs = int(min(n_procs, max(1., len(queries) / initial_queries_per_proc)))  # don't want a proc for every few queries
+            jobs.append({'queries' : queries, 'match_mismatch' : list(match_mismatch), 'gldir' : gldir, 'n_procs' : job_n_procs})
+        return jobs
+
+    # ----------------------------------------------------------------------------------------
+    def write_candidate_germlines(self, outdir, queries):
+        """ write the genes that were candidates for any of <queries> to <outdir> (except for regions in which any of them didn't have any candidates, for which we write all the genes) """
+        genes = set()
+        for region in utils.regions:
+            region_genes = set()
+            for query_name in queries:
+                if query_name not in self.candidate_genes or len(self.candidate_genes[query_name][region]) == 0:
+                    region_genes = set(self.glfo['seqs'][region])
+                    break
+                region_genes |= self.candidate_genes[query_name][region]
+            genes |= region_genes
+        glutils.write_glfo(outdir, self.glfo, only_genes=genes)
+
+    # ----------------------------------------------------------------------------------------
+    def split_sw_jobs(self, jobs):
+        """ split each job into its number of procs (for running vdjalign as a subprocess) """
+        procs = []
+        for job in jobs:
+            n_queries_per_proc = int(math.ceil(float(len(job['queries'])) / job['n_procs']))
+            for istart in range(0, len(job['queries']), n_queries_per_proc):
+                procs.append({'queries' : job['queries'][istart : istart + n_queries_per_proc], 'match_mismatch' : job['match_mismatch'], 'gldir' : job['gldir']})
+        return procs
+
+    # ----------------------------------------------------------------------------------------
+    def align_in_process(self, sw, jobs):
+        """ same as write_vdjalign_input() + execute_commands() + read_output(), but calling vdjalign's alignment function directly, so there's no fasta, sam, or bam files """
+        # large gap-opening penalty: we want *no* gaps in the middle of the alignments
+        # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
+        start = time.time()
+        def get_kwargs(job):
+            gldir = job['gldir'] + '/' + self.args.chain
+            match, mismatch = job['match_mismatch']
+            return {'queries' : ((query_name, self.get_query_seq(query_name)) for query_name in job['queries']),  # NOTE for the first try this reads the queries from the input file as ig_align_records() writes them
+                    'ref_path' : gldir + '/ig' + self.args.chain + 'v.fasta',
+                    'extra_ref_paths' : [gldir + '/ig' + self.args.chain + r + '.fasta' for r in ('d', 'j') if r != 'd' or self.args.chain == 'h'],  # has to be in order d, j (and light chains don't have d)
+                    'match' : match, 'mismatch' : mismatch, 'gap_open' : self.gap_open_penalty, 'max_drop' : 50, 'n_threads' : min(job['n_procs'], 255)}
+
+        with swalign.redirected_stderr(self.args.workdir + '/vdjalign.err'):
+            if len(jobs) == 1:  # process the output as it comes out
+                self.process_output(swalign.ig_align_records(sw, **get_kwargs(jobs[0])))
+            else:
+                self.process_output(swalign.align_concurrently(sw, [get_kwargs(job) for job in jobs]))
+        if self.debug:
+            print '      in-process sw time: %.1f' % (time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, match_mismatch, gldir, n_procs=None):
         """
         Run smith-waterman alignment (from Connor's ighutils package) on the seqs in <base_infname>, and toss all the top matches into <base_outfname>.
         """
@@ -212,16 +326,37 @@ class Waterer(object):
             cmd_str = 'srun ' + cmd_str
         cmd_str += ' --locus ' + 'IG' + self.args.chain.upper()
         cmd_str += ' --max-drop 50'
-        match, mismatch = self.match_mismatch
+        match, mismatch = match_mismatch
         cmd_str += ' --match ' + str(match) + ' --mismatch ' + str(mismatch)
         cmd_str += ' --gap-open ' + str(self.gap_open_penalty)
-        cmd_str += ' --vdj-dir ' + self.my_datadir + '/' + self.args.chain
+        cmd_str += ' --vdj-dir ' + gldir + '/' + self.args.chain
         cmd_str += ' --samtools-dir ' + self.args.partis_dir + '/packages/samtools'
         cmd_str += ' ' + workdir + '/' + base_infname + ' ' + workdir + '/' + base_outfname
         return cmd_str
 
     # ----------------------------------------------------------------------------------------
     def read_output(self, base_outfname, n_procs=1):
+        import pysam  # only needed if we're running vdjalign as a subprocess
+
+        def get_alignments():
+            for iproc in range(n_procs):
+                outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
+                with contextlib.closing(pysam.Samfile(outfname)) as bam:
+                    grouped = itertools.groupby(iter(bam), operator.attrgetter('qname'))
+                    for _, reads in grouped:  # loop over query sequences
+                        yield bam.references, list(reads)
+
+        self.process_output(get_alignments())
+
+        for iproc in range(n_procs):
+            workdir = self.subworkdir(iproc, n_procs)
+            os.remove(workdir + '/' + base_outfname)
+            if n_procs > 1:  # still need the top-level workdir
+                os.rmdir(workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def process_output(self, alignments):
+        """ process the (references, reads) for each query in <alignments>, and decide what to rerun """
         queries_to_rerun = OrderedDict()  # This is to keep track of every query that we don't add to self.info (i.e. it does *not* include unproductive queries that we ignore/skip entirely because we were told to by a command line argument)
                                           # ...whereas <self.unproductive_queries> is to keep track of the queries that were definitively unproductive (i.e. we removed them from self.remaining_queries) when we were told to skip unproductives by a command line argument
         for reason in ['unproductive', 'no-match', 'weird-annot.', 'nonsense-bounds', 'invalid-codon']:
@@ -230,13 +365,9 @@ class Waterer(object):
         self.new_indels = 0
         n_processed = 0
         self.tmp_queries_read_from_file = set()  # TODO remove this
-        for iproc in range(n_procs):
-            outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
-            with contextlib.closing(pysam.Samfile(outfname)) as bam:
-                grouped = itertools.groupby(iter(bam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    self.process_query(bam.references, list(reads), queries_to_rerun)
-                    n_processed += 1
+        for references, reads in alignments:  # loop over query sequences
+            self.process_query(references, reads, queries_to_rerun)
+            n_processed += 1
 
         not_read = self.remaining_queries - self.tmp_queries_read_from_file
         if len(not_read) > 0:
@@ -257,22 +388,25 @@ class Waterer(object):
             if n_to_rerun + self.new_indels != len(self.remaining_queries):
                 print ''
                 raise Exception('numbers don\'t add up in sw output reader (n_to_rerun + new_indels != remaining_queries): %d + %d != %d   (look in %s)' % (n_to_rerun, self.new_indels, len(self.remaining_queries), self.args.workdir))
-            if self.nth_try < 2 or self.new_indels == 0:  # increase the mismatch score if it's the first try, or if there's no new indels
-                print '            increasing mismatch score (%d --> %d) and rerunning them' % (self.match_mismatch[1], self.match_mismatch[1] + 1)
-                self.match_mismatch[1] += 1
-            elif self.new_indels > 0:  # if there were some indels, rerun with the same parameters (but when the input is written the indel will be "reversed' in the sequences that's passed to ighutil)
-                print '            rerunning for indels'
-                self.new_indels = 0
-            else:  # shouldn't get here
-                assert False
+            self.update_match_mismatch(queries_to_rerun)
         else:
             print '        all done'
 
-        for iproc in range(n_procs):
-            workdir = self.subworkdir(iproc, n_procs)
-            os.remove(workdir + '/' + base_outfname)
-            if n_procs > 1:  # still need the top-level workdir
-                os.rmdir(workdir)
+    # ----------------------------------------------------------------------------------------
+    def update_match_mismatch(self, queries_to_rerun):
+        """
+        Set the scores for each query's next try: queries that failed get their scores changed according to the reason they failed (see <self.rerun_score_changes>),
+        while queries with new indels are rerun with the same scores (but when the input is written the indel will be "reversed" in the sequence that we pass to vdjalign).
+        """
+        n_changed = OrderedDict()
+        for reason in queries_to_rerun:
+            for query_name in queries_to_rerun[reason]:
+                match, mismatch = self.query_match_mismatch.get(query_name, self.match_mismatch)
+                dmatch, dmismatch = self.rerun_score_changes[reason]
+                self.query_match_mismatch[query_name] = [match + dmatch, mismatch + dmismatch]
+                n_changed[reason] = n_changed.get(reason, 0) + 1
+        print '            rerunning with new scores: %s%s' % ('  '.join(['%s %d' % (reason, n) for reason, n in n_changed.items()]), ('   (and %d for indels)' % self.new_indels) if self.new_indels > 0 else '')
+        self.new_indels = 0
 
     # ----------------------------------------------------------------------------------------
     def get_indel_info(self, query_name, cigarstr, qrseq, glseq, gene):
@@ -342,6 +476,11 @@ class Waterer(object):
         query_seq = primary.seq
         query_name = primary.qname
         self.tmp_queries_read_from_file.add(query_name)
+        if query_name not in self.candidate_genes:  # first try, i.e. against all the genes
+            self.candidate_genes[query_name] = {r : set() for r in utils.regions}
+            for read in reads:
+                gene = references[read.tid]
+                self.candidate_genes[query_name][utils.get_region(gene)].add(gene)
         first_match_query_bounds = None  # since sw excises its favorite v match, we have to know this match's boundaries in order to calculate k_d for all the other matches
         all_match_names = {}
         warnings = {}  # ick, this is a messy way to pass stuff around
@@ -575,12 +714,8 @@ class Waterer(object):
                 utils.print_reco_event(self.glfo['seqs'], self.reco_info[query_name], extra_str='      ', label='true:')
             utils.print_reco_event(self.glfo['seqs'], self.info[query_name], extra_str='      ', label='inferred:')
 
-        if self.alfinder is not None:
-            self.alfinder.increment(self.info[query_name])
-        if self.pcounter is not None:
-            self.pcounter.increment_all_params(self.info[query_name])
-            if self.true_pcounter is not None:
-                self.true_pcounter.increment_all_params(self.reco_info[query_name])
+        if self.alfinder is not None or self.pcounter is not None:
+            self.queries_to_count.append(query_name)  # we count them all at once at the end (in count_parameters())
         if self.perfplotter is not None:
             if query_name in self.info['indels']:
                 print '    skipping performance evaluation of %s because of indels' % query_name  # I just have no idea how to handle naive hamming fraction when there's indels
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" checks for Glomerator.naive_seq_glomerate() (run with e.g. python -m unittest discover -s test -p 'test_*.py' from the main partis dir) """
+import os
+import sys
+import math
+import random
+import unittest
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../python')
+
+from glomerator import Glomerator
+
+# ----------------------------------------------------------------------------------------
+def mutate(seq, n_mutations, rng):
+    seq = list(seq)
+    for ipos in rng.sample(range(len(seq)), n_mutations):
+        seq[ipos] = rng.choice([nuke for nuke in 'ACGT' if nuke != seq[ipos]])
+    return ''.join(seq)
+
+# ----------------------------------------------------------------------------------------
+class NaiveSeqGlomerateTest(unittest.TestCase):
+    # ----------------------------------------------------------------------------------------
+    def glomerate(self, naive_seqs, n_clusters):
+        clusters = Glomerator().naive_seq_glomerate(naive_seqs, n_clusters)
+        self.assertEqual(sorted([uid for cluster in clusters for uid in cluster]), sorted(naive_seqs))  # every uid exactly once
+        self.assertEqual(len(clusters), min(n_clusters, len(naive_seqs)))
+        return clusters
+
+    # ----------------------------------------------------------------------------------------
+    def test_identical_seqs_get_split(self):
+        """ more clusters than distinct sequences: identical sequences have to be split up, respecting the size cap """
+        naive_seqs = {'s%d' % i : 'ACGTACGT' for i in range(10)}
+        naive_seqs['t'] = 'TTTTTTTT'
+        clusters = self.glomerate(naive_seqs, 5)
+        self.assertEqual(sorted([len(cl) for cl in clusters]), [2, 2, 2, 2, 3])
+
+        self.assertEqual(sorted(self.glomerate({'a' : 'ACGT', 'b' : 'ACGT'}, 2)), [['a'], ['b']])
+
+        naive_seqs = {'s%d' % i : 'ACGT' for i in range(9)}
+        clusters = self.glomerate(naive_seqs, 4)
+        self.assertTrue(max([len(cl) for cl in clusters]) <= int(math.ceil(9. / 4)))
+
+    # ----------------------------------------------------------------------------------------
+    def test_many_identical_seqs_in_nearby_families(self):
+        """ families A/a and B/b, with A and a (and B and b) three mutations apart, and lots of copies of each (more than the number of nearest neighbors we look at) """
+        rng = random.Random(2)
+        seq_a = ''.join([rng.choice('ACGT') for _ in range(300)])
+        seq_b = ''.join([rng.choice('ACGT') for _ in range(300)])
+        family_seqs = {'A' : seq_a, 'a' : mutate(seq_a, 3, rng), 'B' : seq_b, 'b' : mutate(seq_b, 3, rng)}
+        for n_copies in (25, 60):
+            naive_seqs = {family + str(icopy) : seq for family, seq in family_seqs.items() for icopy in range(n_copies)}
+            clusters = self.glomerate(naive_seqs, 2)
+            self.assertEqual(sorted([''.join(sorted(set([uid[0] for uid in cl]))) for cl in clusters]), ['Aa', 'Bb'])
+
+    # ----------------------------------------------------------------------------------------
+    def test_disconnected_neighbor_graph(self):
+        """ families with more distinct sequences than the number of nearest neighbors, so the neighbor graph has no edges between them """
+        rng = random.Random(3)
+        naive_seqs = {}
+        for ipair in range(2):
+            root = ''.join([rng.choice('ACGT') for _ in range(300)])
+            for family, family_seq in (('%da' % ipair, mutate(root, 2, rng)), ('%db' % ipair, mutate(root, 30, rng))):
+                for iseq in range(40):
+                    naive_seqs['%s-%d' % (family, iseq)] = mutate(family_seq, 1, rng) if iseq > 0 else family_seq
+        clusters = self.glomerate(naive_seqs, 2)
+        self.assertEqual(sorted([sorted(set([uid.split('-')[0] for uid in cl])) for cl in clusters]), [['0a', '0b'], ['1a', '1b']])
+
+if __name__ == '__main__':
+    unittest.main()